@@ -0,0 +1,289 @@
+import argparse
+import base64
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from urllib.parse import unquote
+from codec_registry import COMPRESSION_WBITS, compress_content
+from encoder import stream_encoding_layer, write_chunks, encode_base64, encode_unicode, encode_uri_all_chars, escape_unicode_per_char, escape_uri_per_char, base64_wrap_in_html, unicode_wrap_in_html, uri_wrap_in_html, gzip_content, random_encoding, choose_encoding_steps, predict_first_layer_sizes, make_rng
+from decoder import decode_random_encoding, decode_unicode, decode_uri, unescape_unicode_per_match, scan_decoded_content, scan_content
+
+SUITE_SEED = 1337
+SUITE_SIZES = '1KB,1MB,10MB'
+LARGE_FILE_SIZES = '500MB'
+LAYER_STEPS = 'base64,uri,base64,unicode'
+LARGE_FILE_STEPS = 'base64,uri,base64'
+# Rough output/input ratio of each layer, used to size the innermost document of a large-file sample
+LAYER_EXPANSION = {'base64': 4 / 3, 'uri': 3, 'unicode': 6}
+PEAK_RSS_MODES = {
+    'in-memory': "decoded_content, encoding_steps = decode_layers(extract_script_content(sys.argv[1]))\nwrite_file(sys.argv[2], decoded_content, encoding='utf-8')",
+    'large-file': "encoding_steps = decode_large_file(sys.argv[1], sys.argv[2])",
+}
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark the encoder and decoder hot paths')
+    parser.add_argument('benchmark', nargs='?', choices=['layers', 'encoders', 'decoders', 'compression', 'suite', 'large-file'], default='layers', help='Benchmark to run')
+    parser.add_argument('--input-file', type=str, default='example.html', help='HTML file used as the innermost layer')
+    parser.add_argument('--max-layers', type=int, default=10, help='Largest number of layers to benchmark')
+    parser.add_argument('--steps', type=str, help=f'Comma separated encoding steps, {LAYER_STEPS} repeated up to --max-layers by default and {LARGE_FILE_STEPS} for large-file')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per measurement, the fastest is reported')
+    parser.add_argument('--sizes', type=str, help=f'Comma separated input sizes, 1MB,10MB,100MB by default, {SUITE_SIZES} for the suite and {LARGE_FILE_SIZES} for large-file')
+    parser.add_argument('--max-reference-size', type=str, default='10MB', help='Largest input the per-character reference encoders are run on')
+    parser.add_argument('--seed', type=int, default=SUITE_SEED, help='Seed for the synthetic corpus and the random encodings in the suite')
+    parser.add_argument('--max-expansion', type=float, default=8, help='Largest output/input ratio allowed for the random encodings in the suite')
+    parser.add_argument('--output', type=str, help='Save the suite results as JSON to this file')
+    parser.add_argument('--baseline', type=str, help='JSON results of an earlier suite run to compare against')
+    parser.add_argument('--levels', type=str, default='1,6,9', help='Comma separated compression levels for the compression benchmark')
+    parser.add_argument('--threshold', type=float, default=1.25, help='Flag a benchmark as slower when it takes this many times its baseline time')
+    return parser.parse_args()
+
+def build_layered_sample(content, encoding_steps):
+    html_content = content.decode('utf-8')
+    for encoding_type in encoding_steps:
+        if encoding_type == 'base64':
+            html_content = base64_wrap_in_html(encode_base64(html_content.encode('utf-8')))
+        elif encoding_type == 'unicode':
+            html_content = unicode_wrap_in_html(encode_unicode(html_content))
+        else:
+            html_content = uri_wrap_in_html(encode_uri_all_chars(html_content))
+    return html_content
+
+def parse_size(size):
+    units = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+    size = size.strip().upper()
+    for unit, factor in units.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * factor)
+    return int(size)
+
+def synthetic_text(content, size):
+    text = content.decode('utf-8')
+    return (text * (size // len(text) + 1))[:size]
+
+def synthetic_html(size, seed):
+    # A seeded block of varied markup (text, scripts, data URIs, non-ASCII) repeated up to the requested size
+    rng = random.Random(seed)
+    words = ['invoice', 'account', 'verify', 'password', 'payment', 'secure', 'login', 'update', 'café', 'naïve', '中文', 'résumé']
+    blocks = ['<!DOCTYPE html>\n<html lang="en">\n<head>\n<meta charset="UTF-8">\n<title>Synthetic sample</title>\n</head>\n<body>\n']
+    while sum(len(block) for block in blocks) < 64 * 1024:
+        kind = rng.random()
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(5, 40)))
+        if kind < 0.6:
+            blocks.append(f'<p class="c{rng.randint(0, 99)}">{text}</p>\n')
+        elif kind < 0.8:
+            blocks.append(f'<script>var v{rng.randint(0, 9999)} = "{text}"; console.log(v{rng.randint(0, 9999)});</script>\n')
+        elif kind < 0.9:
+            payload = base64.b64encode(rng.randbytes(rng.randint(16, 256))).decode('ascii')
+            blocks.append(f'<img src="data:image/png;base64,{payload}" alt="{text[:20]}">\n')
+        else:
+            blocks.append(f'<form action="https://example.com/{rng.randint(0, 999)}"><input name="q" value="{text[:30]}"></form>\n')
+    unit = ''.join(blocks)
+    return (unit * (size // len(unit) + 1))[:size]
+
+def best_time(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def bench_decode_layers(content, steps, max_layers, repeat):
+    print(f"{'layers':>6} {'sample bytes':>14} {'peeled bytes':>14} {'time (ms)':>10} {'ns/byte':>8}")
+    for layers in range(1, max_layers + 1):
+        encoding_steps = [steps[i % len(steps)] for i in range(layers)]
+        sample = build_layered_sample(content, encoding_steps)
+        # Every layer's document is scanned once, so the work is the sum of all layer sizes
+        peeled_bytes = sum(len(build_layered_sample(content, encoding_steps[:i])) for i in range(1, layers + 1))
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed = best_time(lambda: decode_random_encoding(sample), repeat)
+        print(f"{layers:>6} {len(sample):>14} {peeled_bytes:>14} {elapsed * 1000:>10.2f} {elapsed * 1e9 / peeled_bytes:>8.2f}")
+
+def bench_encoders(content, sizes, max_reference_size, repeat):
+    encoders = [
+        ('unicode', encode_unicode, escape_unicode_per_char),
+        ('uri', encode_uri_all_chars, escape_uri_per_char),
+    ]
+    print(f"{'encoder':>8} {'size':>12} {'bulk (s)':>10} {'per char (s)':>13} {'speedup':>8}")
+    for size in sizes:
+        text = synthetic_text(content, size)
+        for name, fast, reference in encoders:
+            fast_time = best_time(lambda: fast(text), repeat)
+            if size > max_reference_size:
+                print(f"{name:>8} {size:>12} {fast_time:>10.3f} {'-':>13} {'-':>8}")
+                continue
+            reference_time = best_time(lambda: reference(text), repeat)
+            print(f"{name:>8} {size:>12} {fast_time:>10.3f} {reference_time:>13.3f} {reference_time / fast_time:>7.1f}x")
+
+def bench_decoders(content, sizes, repeat):
+    decoders = [
+        ('unicode', encode_unicode, decode_unicode, unescape_unicode_per_match),
+        ('uri', encode_uri_all_chars, decode_uri, unquote),
+    ]
+    print(f"{'decoder':>8} {'size':>12} {'bulk (MB/s)':>12} {'current (MB/s)':>15} {'speedup':>8}")
+    for size in sizes:
+        text = synthetic_text(content, size)
+        for name, encode, bulk, current in decoders:
+            encoded = encode(text)
+            megabytes = len(encoded) / 1024 ** 2
+            bulk_time = best_time(lambda: bulk(encoded), repeat)
+            current_time = best_time(lambda: current(encoded), repeat)
+            print(f"{name:>8} {len(encoded):>12} {megabytes / bulk_time:>12.1f} {megabytes / current_time:>15.1f} {current_time / bulk_time:>7.1f}x")
+
+def bench_compression(content, sizes, levels, repeat):
+    # Compresses a URI-escaped layer, the kind of stacked output the compression stage usually gets
+    print(f"{'format':>8} {'level':>6} {'size':>12} {'ratio':>7} {'compress (MB/s)':>16} {'inflate (MB/s)':>15}")
+    for size in sizes:
+        layer = encode_uri_all_chars(synthetic_text(content, size)).encode('utf-8')
+        megabytes = len(layer) / 1024 ** 2
+        for compression, wbits in COMPRESSION_WBITS.items():
+            for level in levels:
+                compressed = compress_content(layer, compression, level)
+                compress_time = best_time(lambda: compress_content(layer, compression, level), repeat)
+                inflate_time = best_time(lambda: zlib.decompress(compressed, wbits), repeat)
+                print(f"{compression:>8} {level:>6} {len(layer):>12} {len(layer) / len(compressed):>7.1f} {megabytes / compress_time:>16.1f} {megabytes / inflate_time:>15.1f}")
+
+def suite_cases(html_content, seed, max_expansion):
+    content = html_content.encode('utf-8')
+    max_output_bytes = int(len(content) * max_expansion) + len(base64_wrap_in_html('')) * 10
+    encoding_steps = choose_encoding_steps(make_rng(seed), predict_first_layer_sizes([content]), max_output_bytes)
+    sample = random_encoding(content, encoding_steps=encoding_steps)
+    unicode_payload = encode_unicode(html_content)
+
+    def decode_sample():
+        with contextlib.redirect_stdout(io.StringIO()):
+            decode_random_encoding(sample)
+
+    cases = [
+        ('encode_base64', len(content), lambda: encode_base64(content)),
+        ('encode_unicode', len(content), lambda: encode_unicode(html_content)),
+        ('encode_uri_all_chars', len(content), lambda: encode_uri_all_chars(html_content)),
+        ('gzip_content', len(content), lambda: gzip_content(content)),
+        ('random_encoding', len(content), lambda: random_encoding(content, encoding_steps=encoding_steps)),
+        ('decode_random_encoding', len(sample), decode_sample),
+        ('decode_unicode', len(unicode_payload), lambda: decode_unicode(unicode_payload)),
+        ('scan_decoded_content', len(content), lambda: scan_decoded_content(html_content)),
+    ]
+    if importlib.util.find_spec('magic') is not None:
+        cases.append(('scan_content', len(content), lambda: scan_content(content)))
+    return cases, encoding_steps
+
+def write_large_sample(output_file, size, steps, seed):
+    # The streaming encoder builds the sample chunk by chunk, so it never has to fit in memory
+    expansion = 1
+    for step in steps:
+        expansion *= LAYER_EXPANSION[step]
+    unit = synthetic_html(1024 ** 2, seed).encode('utf-8')
+    chunks = (unit for _ in range(max(1, int(size / expansion / len(unit)))))
+    for step in steps:
+        chunks = stream_encoding_layer(step, chunks)
+    write_chunks(output_file, chunks)
+
+def measure_peak_rss(mode, input_file, output_file):
+    # Each mode runs in a fresh interpreter, so its peak RSS is not hidden by an earlier run
+    script = f"import resource, sys, time\nfrom decoder import *\nstart = time.perf_counter()\n{PEAK_RSS_MODES[mode]}\nprint(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+    result = subprocess.run([sys.executable, '-c', script, input_file, output_file], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        return None, None
+    elapsed, max_rss = result.stdout.split()[-2:]
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return float(elapsed), int(max_rss) * (1 if sys.platform == 'darwin' else 1024)
+
+def bench_large_file(sizes, steps, seed):
+    print(f"{'mode':>10} {'sample bytes':>14} {'time (s)':>10} {'peak RSS (MB)':>14}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_file = os.path.join(tmp_dir, 'sample.html')
+            write_large_sample(input_file, size, steps, seed)
+            sample_size = os.path.getsize(input_file)
+            for mode in PEAK_RSS_MODES:
+                elapsed, max_rss = measure_peak_rss(mode, input_file, os.path.join(tmp_dir, f'{mode}.html'))
+                if elapsed is None:
+                    print(f"{mode:>10} {sample_size:>14} {'failed':>10} {'-':>14}")
+                    continue
+                print(f"{mode:>10} {sample_size:>14} {elapsed:>10.2f} {max_rss / 1024 ** 2:>14.1f}")
+
+def load_baseline(baseline_file):
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    return {(result['name'], result['size']): result for result in baseline['results']}
+
+def run_suite(sizes, seed, max_expansion, repeat, baseline=None, threshold=1.25):
+    results = []
+    print(f"{'benchmark':<24} {'size':>12} {'time (s)':>10} {'MB/s':>9} {'vs baseline':>12}")
+    for size in sizes:
+        html_content = synthetic_html(size, seed)
+        cases, encoding_steps = suite_cases(html_content, seed, max_expansion)
+        for name, input_bytes, func in cases:
+            elapsed = best_time(func, repeat)
+            result = {
+                'name': name,
+                'size': size,
+                'input_bytes': input_bytes,
+                'seconds': elapsed,
+                'mb_per_s': input_bytes / 1024 ** 2 / elapsed if elapsed else None,
+            }
+            if name in ('random_encoding', 'decode_random_encoding'):
+                result['encoding_steps'] = encoding_steps
+            comparison = ''
+            if baseline is not None and (name, size) in baseline:
+                result['baseline_ratio'] = elapsed / baseline[(name, size)]['seconds']
+                result['regression'] = result['baseline_ratio'] > threshold
+                comparison = f"{result['baseline_ratio']:.2f}x" + (' SLOWER' if result['regression'] else '')
+            results.append(result)
+            mb_per_s = f"{result['mb_per_s']:.1f}" if result['mb_per_s'] else '-'
+            print(f"{name:<24} {size:>12} {elapsed:>10.4f} {mb_per_s:>9} {comparison:>12}")
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': seed,
+            'repeat': repeat,
+            'max_expansion': max_expansion,
+        },
+        'results': results,
+    }
+
+def main(args):
+    with open(args.input_file, 'rb') as f:
+        content = f.read()
+
+    if args.benchmark == 'suite':
+        sizes = [parse_size(size) for size in (args.sizes or SUITE_SIZES).split(',')]
+        baseline = load_baseline(args.baseline) if args.baseline else None
+        report = run_suite(sizes, args.seed, args.max_expansion, args.repeat, baseline, args.threshold)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2)
+            print(f"\nResults saved to: {args.output}")
+        regressions = [result for result in report['results'] if result.get('regression')]
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) slower than {args.threshold}x their baseline")
+            sys.exit(1)
+    elif args.benchmark == 'large-file':
+        sizes = [parse_size(size) for size in (args.sizes or LARGE_FILE_SIZES).split(',')]
+        bench_large_file(sizes, (args.steps or LARGE_FILE_STEPS).split(','), args.seed)
+    elif args.benchmark == 'encoders':
+        sizes = [parse_size(size) for size in (args.sizes or '1MB,10MB,100MB').split(',')]
+        bench_encoders(content, sizes, parse_size(args.max_reference_size), args.repeat)
+    elif args.benchmark == 'decoders':
+        sizes = [parse_size(size) for size in (args.sizes or '1MB,10MB,100MB').split(',')]
+        bench_decoders(content, sizes, args.repeat)
+    elif args.benchmark == 'compression':
+        sizes = [parse_size(size) for size in (args.sizes or '1MB,10MB,100MB').split(',')]
+        bench_compression(content, sizes, [int(level) for level in args.levels.split(',')], args.repeat)
+    else:
+        steps = (args.steps or LAYER_STEPS).split(',')
+        bench_decode_layers(content, steps, args.max_layers, args.repeat)
+
+if __name__ == '__main__':
+    main(parse_arguments())
@@ -0,0 +1,414 @@
+import base64
+import binascii
+import gzip
+import re
+import struct
+import time
+import zlib
+from dataclasses import dataclass, field
+from urllib.parse import quote, unquote
+from decode_limits import DecodeLimitExceeded
+
+# Every encoding layer is declared once here, and the encoder and the decoder are both driven by these declarations
+
+ASTRAL_PATTERN = re.compile('([\U00010000-\U0010FFFF]+)')
+WIDE_PATTERN = re.compile('([^\x00-\xff]+)')
+# decodeURI leaves the escapes of these characters alone: ; / ? : @ & = + $ , #
+URI_RESERVED_ESCAPE = re.compile('(%(?:2[346BCFbcf]|3[ABDFabdf]|40))')
+HTML_BEFORE_CALL = '<html><head><script>document.write('
+HTML_AFTER_CALL = ')</script></head></html>'
+# zlib window bits for each compressed format: a gzip header, a zlib header, or raw deflate with no header
+COMPRESSION_WBITS = {'gzip': 31, 'zlib': 15, 'deflate': -15}
+COMPRESSION_STRATEGIES = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'huffman': zlib.Z_HUFFMAN_ONLY,
+    'rle': zlib.Z_RLE,
+    'fixed': zlib.Z_FIXED,
+}
+GZIP_MAGIC = b'\x1f\x8b'
+INFLATE_CHUNK_SIZE = 1024 * 1024
+
+def gzip_content(content):
+    # A fixed mtime keeps seeded output byte for byte reproducible
+    compressed = gzip.compress(content, mtime=0)
+    return compressed
+
+def make_compressor(compression='gzip', level=9, strategy='default'):
+    # zlib writes a gzip header with a zero mtime, so this output is reproducible as well
+    return zlib.compressobj(level, zlib.DEFLATED, COMPRESSION_WBITS[compression], 8, COMPRESSION_STRATEGIES[strategy])
+
+def compress_content(content, compression='gzip', level=9, strategy='default'):
+    compressor = make_compressor(compression, level, strategy)
+    return compressor.compress(content) + compressor.flush()
+
+def encode_base64(content):
+    return base64.b64encode(content).decode('utf-8')
+
+def escape_unicode_per_char(content):
+    return ''.join([f'\\u{ord(c):04x}' for c in content])
+
+def encode_unicode(content):
+    if not content:
+        return ''
+    # Each BMP character is one UTF-16 code unit, and bytes.hex inserts a separator every two bytes,
+    # so the whole escape runs in C. Astral characters keep their variable-width escape.
+    encoded = content.encode('utf-16-be', 'surrogatepass')
+    if len(encoded) != 2 * len(content):
+        parts = ASTRAL_PATTERN.split(content)
+        return ''.join(escape_unicode_per_char(part) if i % 2 else encode_unicode(part) for i, part in enumerate(parts))
+    return '\\u' + encoded.hex(':', 2).replace(':', '\\u')
+
+def encode_uri_chars(content):
+    return quote(content, safe='', encoding='utf-8', errors='replace')
+
+def escape_uri_per_char(content):
+    return ''.join(f'%{ord(char):02X}' for char in content)
+
+def encode_uri_all_chars(content):
+    if not content:
+        return ''
+    try:
+        encoded = content.encode('latin-1')
+    except UnicodeEncodeError:
+        parts = WIDE_PATTERN.split(content)
+        return ''.join(escape_uri_per_char(part) if i % 2 else encode_uri_all_chars(part) for i, part in enumerate(parts))
+    return '%' + encoded.hex('%').upper()
+
+def encode_gzip(content):
+    return encode_base64(gzip_content(content))
+
+def encode_zlib(content):
+    return encode_base64(compress_content(content, 'zlib'))
+
+def encode_deflate(content):
+    return encode_base64(compress_content(content, 'deflate'))
+
+def encode_uri_component(content):
+    # Same set as encodeURIComponent: letters, digits and -_.!~*'() stay as they are
+    return quote(content, safe="!'()*")
+
+def encode_full_uri(content):
+    # Same set as encodeURI, which also keeps the reserved characters
+    return quote(content, safe="!'()*;/?:@&=+$,#")
+
+def encode_char_codes(content):
+    code_units = content.encode('utf-16-be', 'surrogatepass')
+    return ','.join(map(hex, struct.unpack(f'>{len(code_units) // 2}H', code_units)))
+
+def stream_gunzip(chunks, chunk_size, wbits=COMPRESSION_WBITS['gzip']):
+    inflater = zlib.decompressobj(wbits)
+    started = after_member = False
+    for data in chunks:
+        while data:
+            if after_member and not started:
+                # Like gzip.open, carry on with the next member and ignore zero padding between members
+                data = data.lstrip(b'\0')
+                if not data:
+                    break
+            started = True
+            inflated = inflater.decompress(data, chunk_size)
+            if inflated:
+                yield inflated
+            if inflater.eof:
+                if wbits != COMPRESSION_WBITS['gzip']:
+                    # zlib.decompress stops at the end of a zlib or raw deflate stream and ignores the rest
+                    return
+                data = inflater.unused_data
+                inflater = zlib.decompressobj(wbits)
+                started = False
+                after_member = True
+            else:
+                data = inflater.unconsumed_tail
+    if started:
+        inflated = inflater.flush()
+        if not inflater.eof:
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+        if inflated:
+            yield inflated
+
+def inflate(compressed, wbits, max_length=None, deadline=None):
+    # A chunk at a time, so a decompression bomb stops at max_length bytes or the deadline instead of filling memory
+    parts = []
+    size = 0
+    for inflated in stream_gunzip([compressed], INFLATE_CHUNK_SIZE, wbits):
+        size += len(inflated)
+        if max_length is not None and size > max_length:
+            raise DecodeLimitExceeded(f"inflated output passed {max_length} bytes")
+        if deadline is not None and time.monotonic() > deadline:
+            raise DecodeLimitExceeded("ran out of time while inflating")
+        parts.append(inflated)
+    return b''.join(parts)
+
+def decode_and_unzip_base64(encoded_content, max_length=None, deadline=None):
+    decoded_content = base64.b64decode(encoded_content)
+    return inflate(decoded_content, COMPRESSION_WBITS['gzip'], max_length, deadline).decode('utf-8')
+
+def decode_base64(encoded_content):
+    return base64.b64decode(encoded_content.encode('utf-8'))
+
+def compressed_payload_format(encoded_content):
+    # The first four base64 characters are the first three bytes, enough to tell the two headers apart
+    try:
+        head = base64.b64decode(encoded_content[:4])
+    except (binascii.Error, ValueError):
+        return None
+    if head[:2] == GZIP_MAGIC:
+        return 'gzip'
+    if len(head) >= 2 and head[0] & 0x0F == 8 and head[0] >> 4 <= 7 and (head[0] << 8 | head[1]) % 31 == 0:
+        return 'zlib'
+    return 'deflate'
+
+def decode_gzip_layer(encoded_content, max_length=None, deadline=None):
+    if compressed_payload_format(encoded_content) != 'gzip':
+        return None
+    return decode_and_unzip_base64(encoded_content, max_length, deadline)
+
+def decode_zlib_layer(encoded_content, max_length=None, deadline=None):
+    if compressed_payload_format(encoded_content) != 'zlib':
+        return None
+    return inflate(decode_base64(encoded_content), COMPRESSION_WBITS['zlib'], max_length, deadline).decode('utf-8')
+
+def decode_deflate_layer(encoded_content, max_length=None, deadline=None):
+    # Raw deflate has no header to check, so a payload that does not inflate is not this codec's
+    try:
+        inflated = inflate(decode_base64(encoded_content), COMPRESSION_WBITS['deflate'], max_length, deadline)
+    except (binascii.Error, zlib.error, EOFError):
+        return None
+    return inflated.decode('utf-8')
+
+def unescape_unicode_per_match(encoded_content):
+    return re.sub(r'\\u([0-9a-fA-F]{4})', lambda x: chr(int(x.group(1), 16)), encoded_content)
+
+def unescape_unicode_bulk(encoded_content):
+    # Only for payloads that are nothing but \uXXXX escapes, as written by encoder.encode_unicode
+    count = len(encoded_content) // 6
+    if not count or len(encoded_content) % 6:
+        return None
+    if encoded_content[0::6] != '\\' * count or encoded_content[1::6] != 'u' * count:
+        return None
+    hex_digits = encoded_content.replace('\\u', '')
+    if len(hex_digits) != 4 * count:
+        return None
+    try:
+        code_units = bytes.fromhex(hex_digits)
+    except ValueError:
+        return None
+    if len(code_units) != 2 * count:
+        return None
+    decoded_content = code_units.decode('utf-16-be', 'surrogatepass')
+    # A surrogate pair decodes to one astral character, the per-match path keeps two
+    if len(decoded_content) != count:
+        return None
+    return decoded_content
+
+def unescape_uri_bulk(encoded_content):
+    # Only for payloads that are nothing but %XX escapes, as written by encoder.encode_uri_all_chars
+    count = len(encoded_content) // 3
+    if not count or len(encoded_content) % 3:
+        return None
+    if encoded_content[0::3] != '%' * count:
+        return None
+    hex_digits = encoded_content.replace('%', '')
+    if len(hex_digits) != 2 * count:
+        return None
+    try:
+        raw = bytes.fromhex(hex_digits)
+    except ValueError:
+        return None
+    if len(raw) != count:
+        return None
+    return raw.decode('utf-8', 'replace')
+
+def decode_unicode(encoded_content):
+    decoded_content = unescape_unicode_bulk(encoded_content)
+    if decoded_content is None:
+        decoded_content = unescape_unicode_per_match(encoded_content)
+    return decoded_content
+
+def decode_uri(encoded_content):
+    decoded_content = unescape_uri_bulk(encoded_content)
+    if decoded_content is None:
+        decoded_content = unquote(encoded_content)
+    return decoded_content
+
+def decode_base64_text(encoded_content):
+    return decode_base64(encoded_content).decode('utf-8')
+
+def decode_unicode_layer(encoded_content):
+    decoded_content = decode_unicode(encoded_content)
+    return decoded_content if decoded_content != encoded_content else None
+
+def decode_uri_layer(encoded_content):
+    try:
+        decoded_content = decode_uri(encoded_content)
+        if decoded_content != encoded_content:
+            return decoded_content
+    except Exception as e:
+        print(f"Error decoding URI: {e}")
+    return None
+
+def decode_uri_component(encoded_content):
+    return unquote(encoded_content)
+
+def decode_full_uri(encoded_content):
+    parts = URI_RESERVED_ESCAPE.split(encoded_content)
+    return ''.join(part if i % 2 else unquote(part) for i, part in enumerate(parts))
+
+def decode_char_codes(encoded_content):
+    # String.fromCharCode takes UTF-16 code units, wrapped to 16 bits, in decimal or 0x hex
+    codes = [code.strip() for code in encoded_content.split(',')]
+    code_units = [(int(code, 16) if code[:2].lower() == '0x' else int(code)) & 0xFFFF for code in codes]
+    return struct.pack(f'>{len(code_units)}H', *code_units).decode('utf-16-be', 'surrogatepass')
+
+def inflate_wrap_in_html(encoded_content, inflate='inflate'):
+    # pako.inflate reads both the gzip and the zlib header, raw deflate needs pako.inflateRaw
+    return f'''
+        <!DOCTYPE html>
+        <html lang="en">
+            <head>
+                <meta charset="UTF-8">
+                <meta name="viewport" content="width=device-width, initial-scale=1.0">
+                <title>ReadGZIPandRender</title>
+                <script src="https://cdnjs.cloudflare.com/ajax/libs/pako/2.1.0/pako.min.js" integrity="sha512-g2TeAWw5GPnX7z0Kn8nFbYfeHcvAu/tx6d6mrLe/90mkCxO+RcptyYpksUz35EO337F83bZwcmUyHiHamspkfg==" crossorigin="anonymous" referrerpolicy="no-referrer"></script>
+                <script>
+                    async function fetchAndRenderGzip() {{
+                        try {{
+                            const base64Data = 'data:application/octet-stream;base64,{encoded_content}';
+                            const binaryString = atob(base64Data.split(',')[1]);
+                            const len = binaryString.length;
+                            const bytes = new Uint8Array(len);
+                            for (let i = 0; i < len; i++) {{
+                                bytes[i] = binaryString.charCodeAt(i);
+                            }}
+                            const decompressedData = pako.{inflate}(bytes, {{ to: 'string' }});
+                            document.write(decompressedData);
+                            document.close();
+                        }} catch(error) {{
+                            console.error('There was a problem with the fetch operation:', error);
+                        }}
+                    }}
+                    document.addEventListener('DOMContentLoaded', () => {{
+                        fetchAndRenderGzip();
+                    }});
+                </script>
+            </head>
+        </html>
+    '''
+
+def gzip_wrap_in_html(encoded_content):
+    return inflate_wrap_in_html(encoded_content)
+
+def deflate_wrap_in_html(encoded_content):
+    return inflate_wrap_in_html(encoded_content, 'inflateRaw')
+
+def quoted_call_pattern(function, group):
+    return rf'{function}\s*\(\s*(?P<{group}_quote>["\'])(?P<{group}>.+?)(?P={group}_quote)\s*\)'
+
+def find_replace_op(regex):
+    return {
+        "op": "Find / Replace",
+        "args": [
+            {"option": "Regex", "string": regex},
+            "",
+            True,
+            False,
+            True,
+            False,
+        ],
+    }
+
+# Strips the document.write wrapper down to the quoted payload
+STRIP_QUOTED_CALL_OP = find_replace_op("^<.*\\(\"|\"\\).*>$")
+CHAR_CODE = r'(?:0[xX][0-9a-fA-F]+|\d+)'
+
+@dataclass(frozen=True)
+class Codec:
+    name: str
+    # Name of the LAYER_PATTERN group that captures the payload; codecs that share a call share a detector
+    detector: str
+    # Literal every detector match starts with
+    prefix: str
+    pattern: str
+    # Takes text for text codecs and bytes otherwise, returns the payload
+    encode: object
+    # Returns the decoded text, or None when the payload is not this codec's
+    decode: object
+    cyberchef_ops: list = field(default_factory=list)
+    # Call written around the payload inside document.write, unless the codec has a wrapper of its own
+    opener: str = None
+    closer: str = None
+    wrapper: object = None
+    text: bool = True
+    # Output can be far larger than the payload, so decode also takes max_length and deadline keywords
+    inflates: bool = False
+    # Joins the payloads of consecutive chunks when encoding a stream
+    separator: str = ''
+
+    def wrap(self, encoded_content):
+        if self.wrapper is not None:
+            return self.wrapper(encoded_content)
+        return f'{HTML_BEFORE_CALL}{self.opener}{encoded_content}{self.closer}{HTML_AFTER_CALL}'
+
+UNESCAPE_PATTERN = quoted_call_pattern('unescape', 'unescape')
+COMPRESSED_PREFIX = 'data:application/octet-stream;base64,'
+COMPRESSED_PATTERN = r'data:application/octet-stream;base64,(?P<gzip>.+)'
+COMPRESSED_PAYLOAD_OPS = [
+    STRIP_QUOTED_CALL_OP,
+    {"op": "Regular expression", "args": ["User defined", "data:application/octet-stream;base64,([^;']+)", True, True, False, False, False, False, "List capture groups"]},
+    {"op": "From Base64", "args": ["A-Za-z0-9+/=", True, False]},
+]
+
+CODECS = {codec.name: codec for codec in [
+    Codec('base64', 'base64', 'atob', quoted_call_pattern('atob', 'base64'), encode_base64, decode_base64_text,
+          [STRIP_QUOTED_CALL_OP, {"op": "From Base64", "args": ["A-Za-z0-9+/="]}],
+          opener='atob("', closer='")', text=False),
+    # unescape() undoes both of these, so its payload is tried as unicode first and then as uri
+    Codec('unicode', 'unescape', 'unescape', UNESCAPE_PATTERN, encode_unicode, decode_unicode_layer,
+          [STRIP_QUOTED_CALL_OP, {"op": "Unescape Unicode Characters", "args": ["\\u"]}],
+          opener='unescape("', closer='")'),
+    Codec('uri', 'unescape', 'unescape', UNESCAPE_PATTERN, encode_uri_all_chars, decode_uri_layer,
+          [STRIP_QUOTED_CALL_OP, {"op": "URL Decode", "args": []}],
+          opener='unescape("', closer='")'),
+    # The compressed formats share the data URI and are told apart by the header of the decoded bytes
+    Codec('gzip', 'gzip', COMPRESSED_PREFIX, COMPRESSED_PATTERN, encode_gzip, decode_gzip_layer,
+          COMPRESSED_PAYLOAD_OPS + [{"op": "Gunzip", "args": []}],
+          wrapper=gzip_wrap_in_html, text=False, inflates=True),
+    Codec('zlib', 'gzip', COMPRESSED_PREFIX, COMPRESSED_PATTERN, encode_zlib, decode_zlib_layer,
+          COMPRESSED_PAYLOAD_OPS + [{"op": "Zlib Inflate", "args": [0, 0, "Adaptive", False, False]}],
+          wrapper=gzip_wrap_in_html, text=False, inflates=True),
+    Codec('deflate', 'gzip', COMPRESSED_PREFIX, COMPRESSED_PATTERN, encode_deflate, decode_deflate_layer,
+          COMPRESSED_PAYLOAD_OPS + [{"op": "Raw Inflate", "args": [0, 0, "Adaptive", False, False]}],
+          wrapper=deflate_wrap_in_html, text=False, inflates=True),
+    Codec('uri_component', 'uri_component', 'decodeURIComponent', quoted_call_pattern('decodeURIComponent', 'uri_component'), encode_uri_component, decode_uri_component,
+          [STRIP_QUOTED_CALL_OP, {"op": "URL Decode", "args": []}],
+          opener='decodeURIComponent("', closer='")'),
+    Codec('full_uri', 'full_uri', 'decodeURI', quoted_call_pattern('decodeURI', 'full_uri'), encode_full_uri, decode_full_uri,
+          [STRIP_QUOTED_CALL_OP, {"op": "URL Decode", "args": []}],
+          opener='decodeURI("', closer='")'),
+    Codec('charcode', 'charcode', 'String.fromCharCode', rf'String\.fromCharCode\s*\(\s*(?P<charcode>{CHAR_CODE}(?:\s*,\s*{CHAR_CODE})*)\s*\)', encode_char_codes, decode_char_codes,
+          [find_replace_op("^<.*fromCharCode\\(|\\)\\).*>$"), {"op": "From Charcode", "args": ["Comma", 16]}],
+          opener='String.fromCharCode(', closer=')', separator=','),
+]}
+
+# Compression is only ever the outermost layer, added with --gzip or --compression
+ENCODING_TYPES = [name for name in CODECS if name not in COMPRESSION_WBITS]
+DETECTOR_CODECS = {}
+for codec in CODECS.values():
+    DETECTOR_CODECS.setdefault(codec.detector, []).append(codec)
+DETECTOR_PATTERNS = {detector: codecs[0].pattern for detector, codecs in DETECTOR_CODECS.items()}
+DETECTOR_PREFIXES = {detector: codecs[0].prefix for detector, codecs in DETECTOR_CODECS.items()}
+
+def get_codec(encoding_type):
+    if encoding_type not in CODECS:
+        raise ValueError(f"Unsupported encoding type: {encoding_type}")
+    return CODECS[encoding_type]
+
+def unicode_wrap_in_html(encoded_content):
+    return CODECS['unicode'].wrap(encoded_content)
+
+def base64_wrap_in_html(encoded_content):
+    return CODECS['base64'].wrap(encoded_content)
+
+def uri_wrap_in_html(encoded_content):
+    return CODECS['uri'].wrap(encoded_content)
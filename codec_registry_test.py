@@ -0,0 +1,60 @@
+import unittest
+from codec_registry import CODECS, ENCODING_TYPES, DETECTOR_CODECS, COMPRESSION_WBITS, COMPRESSION_STRATEGIES, get_codec, compress_content, compressed_payload_format, encode_base64, encode_uri_component, encode_full_uri, encode_char_codes, decode_full_uri, decode_char_codes
+
+class TestCodecRegistry(unittest.TestCase):
+
+    def test_round_trip(self):
+        text = '<p>Hello "world" & a/b?c=d#e %25 (x)</p>\n'
+        for name in ENCODING_TYPES:
+            codec = CODECS[name]
+            payload = codec.encode(text if codec.text else text.encode('utf-8'))
+            self.assertEqual(codec.decode(payload), text, name)
+        wide_text = text + 'é 中文 😀'
+        for name in ('base64', 'uri_component', 'full_uri', 'charcode'):
+            codec = CODECS[name]
+            payload = codec.encode(wide_text if codec.text else wide_text.encode('utf-8'))
+            self.assertEqual(codec.decode(payload), wide_text, name)
+
+    def test_encode_uri_component(self):
+        self.assertEqual(encode_uri_component("a b/c?d=é'()"), "a%20b%2Fc%3Fd%3D%C3%A9'()")
+        self.assertEqual(encode_full_uri("a b/c?d=é#"), "a%20b/c?d=%C3%A9#")
+
+    def test_decode_full_uri_keeps_reserved_escapes(self):
+        self.assertEqual(decode_full_uri("a%2Fb%20c%3f%40"), "a%2Fb c%3f%40")
+
+    def test_char_codes(self):
+        self.assertEqual(encode_char_codes("<p>😀"), "0x3c,0x70,0x3e,0xd83d,0xde00")
+        self.assertEqual(decode_char_codes("72, 0x69,105"), "Hii")
+        self.assertEqual(decode_char_codes("0xd83d,0xde00"), "😀")
+        # Like String.fromCharCode, codes are wrapped to 16 bits
+        self.assertEqual(decode_char_codes("65601"), "A")
+
+    def test_wrap(self):
+        self.assertEqual(CODECS['charcode'].wrap("0x41"), '<html><head><script>document.write(String.fromCharCode(0x41))</script></head></html>')
+        self.assertIn("pako.inflate", CODECS['gzip'].wrap("H4sI"))
+
+    def test_compressed_formats(self):
+        content = '<p>Hello é</p>'.encode('utf-8') * 50
+        for compression in COMPRESSION_WBITS:
+            for level in (0, 1, 9):
+                for strategy in COMPRESSION_STRATEGIES:
+                    payload = encode_base64(compress_content(content, compression, level, strategy))
+                    self.assertEqual(compressed_payload_format(payload), compression)
+                    # Only the codec of the payload's own format takes it
+                    decoded = [(codec.name, codec.decode(payload)) for codec in DETECTOR_CODECS['gzip']]
+                    self.assertEqual([name for name, text in decoded if text is not None], [compression])
+                    self.assertEqual(CODECS[compression].decode(payload), content.decode('utf-8'))
+        self.assertIn("pako.inflateRaw(", CODECS['deflate'].wrap(""))
+        self.assertNotIn("inflateRaw", CODECS['zlib'].wrap(""))
+
+    def test_shared_detector(self):
+        self.assertEqual([codec.name for codec in DETECTOR_CODECS['unescape']], ['unicode', 'uri'])
+        self.assertEqual([codec.name for codec in DETECTOR_CODECS['gzip']], ['gzip', 'zlib', 'deflate'])
+        self.assertNotIn('gzip', ENCODING_TYPES)
+        self.assertNotIn('deflate', ENCODING_TYPES)
+        with self.assertRaises(ValueError):
+            get_codec('rot13')
+
+
+if __name__ == '__main__':
+    unittest.main()
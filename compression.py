@@ -0,0 +1,67 @@
+import argparse
+import itertools
+import time
+from codec_registry import COMPRESSION_WBITS, COMPRESSION_STRATEGIES, compress_content
+
+AUTO_LEVEL_SAMPLE_SIZE = 1024 * 1024
+AUTO_LEVELS = range(1, 10)
+
+def parse_compression_level(value):
+    if value == 'auto':
+        return value
+    try:
+        level = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid compression level: {value}")
+    if not 0 <= level <= 9:
+        raise argparse.ArgumentTypeError(f"compression level must be between 0 and 9 or auto, got {level}")
+    return level
+
+def add_compression_arguments(parser):
+    parser.add_argument('--compression', choices=list(COMPRESSION_WBITS), help='Compress the output in this format before wrapping it, --gzip is the same as --compression gzip')
+    parser.add_argument('--compression-level', type=parse_compression_level, default=9, help='Compression level from 0 to 9, or auto to pick one for --compression-max-seconds or --compression-max-bytes')
+    parser.add_argument('--compression-strategy', choices=list(COMPRESSION_STRATEGIES), default='default', help='zlib compression strategy')
+    parser.add_argument('--compression-max-seconds', type=float, help='With --compression-level auto, the time the compression may take')
+    parser.add_argument('--compression-max-bytes', type=int, help='With --compression-level auto, the size the compressed data should fit in')
+
+def check_compression_arguments(parser, args):
+    if args.compression_level == 'auto' and args.compression_max_seconds is None and args.compression_max_bytes is None:
+        parser.error("--compression-level auto needs --compression-max-seconds or --compression-max-bytes")
+    return args
+
+def take_sample(chunks, size=AUTO_LEVEL_SAMPLE_SIZE):
+    # Returns the first size bytes or so and the chunks with the sample put back in front
+    sample = []
+    sample_size = 0
+    for chunk in chunks:
+        sample.append(chunk)
+        sample_size += len(chunk)
+        if sample_size >= size:
+            break
+    return b''.join(sample)[:size], itertools.chain(sample, chunks)
+
+def choose_compression_level(sample, total_size, compression='gzip', strategy='default', max_seconds=None, max_bytes=None):
+    if max_seconds is None and max_bytes is None:
+        raise ValueError("--compression-level auto needs --compression-max-seconds or --compression-max-bytes")
+    # Each level is timed on the sample and scaled up to the whole input, time and size grow about linearly with it
+    scale = total_size / len(sample) if sample else 0
+    fitting = []
+    for level in AUTO_LEVELS:
+        start = time.perf_counter()
+        size = len(compress_content(sample, compression, level, strategy))
+        seconds = time.perf_counter() - start
+        if (max_seconds is None or seconds * scale <= max_seconds) and (max_bytes is None or size * scale <= max_bytes):
+            fitting.append((size, level))
+    if not fitting:
+        # Nothing meets the target, so get as close as possible: the fastest level for time, the smallest output for size
+        return AUTO_LEVELS[0] if max_seconds is not None else AUTO_LEVELS[-1]
+    if max_seconds is not None:
+        # The best compression that still fits the time budget
+        return min(fitting)[1]
+    # The lowest, and so the fastest, level that reaches the size
+    return fitting[0][1]
+
+def format_compression_stats(compression, level, strategy, input_size, output_size, seconds):
+    ratio = input_size / output_size if output_size else 0
+    speed = f"{input_size / 1024 ** 2 / seconds:.2f} MB/s" if seconds > 0 else "n/a MB/s"
+    return f"Compression: {compression} level {level}, {strategy} strategy, {input_size} -> {output_size} bytes, ratio {ratio:.2f}, {speed}"
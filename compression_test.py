@@ -0,0 +1,43 @@
+import unittest
+import argparse
+from unittest import mock
+from compression import parse_compression_level, take_sample, choose_compression_level, format_compression_stats
+
+class TestCompression(unittest.TestCase):
+
+    def test_parse_compression_level(self):
+        self.assertEqual(parse_compression_level('6'), 6)
+        self.assertEqual(parse_compression_level('auto'), 'auto')
+        for value in ('10', '-1', 'fast'):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                parse_compression_level(value)
+
+    def test_take_sample(self):
+        sample, chunks = take_sample(iter([b"abc", b"def", b"ghi"]), 4)
+        self.assertEqual(sample, b"abcd")
+        self.assertEqual(b''.join(chunks), b"abcdefghi")
+
+    def test_choose_compression_level_for_size(self):
+        sample = b"<p>some repetitive text</p>" * 2000
+        # Any level fits a generous target, so the fastest is taken, and nothing fits an impossible one
+        self.assertEqual(choose_compression_level(sample, len(sample), max_bytes=len(sample)), 1)
+        self.assertEqual(choose_compression_level(sample, len(sample), max_bytes=1), 9)
+
+    def test_choose_compression_level_for_time(self):
+        sample = b"<p>some repetitive text</p>" * 2000
+        with mock.patch('compression.time.perf_counter', side_effect=range(100)):
+            # Every level appears to take one second, so the budget decides
+            self.assertEqual(choose_compression_level(sample, len(sample), max_seconds=0.5), 1)
+        with mock.patch('compression.time.perf_counter', side_effect=range(100)):
+            level = choose_compression_level(sample, len(sample), max_seconds=10)
+        self.assertGreater(level, 1)
+        with self.assertRaises(ValueError):
+            choose_compression_level(sample, len(sample))
+
+    def test_format_compression_stats(self):
+        self.assertEqual(format_compression_stats('zlib', 6, 'default', 4 * 1024 ** 2, 1024 ** 2, 2.0),
+                         "Compression: zlib level 6, default strategy, 4194304 -> 1048576 bytes, ratio 4.00, 2.00 MB/s")
+
+
+if __name__ == '__main__':
+    unittest.main()
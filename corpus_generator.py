@@ -0,0 +1,216 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from encoder import collect_batch_inputs, read_file, make_rng, choose_encoding_steps, predict_first_layer_sizes, max_layer_size, encode_layer, gzip_layer
+
+MANIFEST_NAME = 'manifest.jsonl'
+
+def parse_corpus_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Generate seeded random encodings of the input files into shard files with an index manifest')
+    parser.add_argument('source', type=str, help='Input directory, glob pattern, or list file with --input-list')
+    parser.add_argument('output_dir', type=str, help='Directory the shards and manifest.jsonl are written to')
+    parser.add_argument('--seed', type=str, required=True, help='Corpus seed, each variant gets its own seed derived from it, the file name and the variant number')
+    parser.add_argument('--variants', type=int, default=100, help='Number of encoded variants per input file')
+    parser.add_argument('--shard-size', type=int, default=1000, help='Number of variants written to each shard file')
+    parser.add_argument('--input-list', action='store_true', help='Read input files from SOURCE, one per line, optionally followed by a tab and a seed')
+    parser.add_argument('--gzip', action='store_true', help='Add the gzip layer on top of every variant')
+    parser.add_argument('--max-output-bytes', type=int, help='Only use encoding layers whose predicted output fits in this many bytes')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Maximum number of shards generated at once')
+    parser.add_argument('--resume', action='store_true', help='Continue an interrupted run, skipping the shards the manifest already lists')
+    return parser.parse_args(argv)
+
+def shard_file_name(shard):
+    return f"shard-{shard:05d}.html"
+
+def variant_seed(corpus_seed, file_seed, name, variant):
+    if file_seed is not None:
+        return f"{file_seed}:{variant}"
+    return f"{corpus_seed}:{name}:{variant}"
+
+def build_prefix_tree(variants):
+    # Each node is (children by encoding type, variants whose steps end here), so shared first layers are one path
+    root = ({}, [])
+    for variant in variants:
+        node = root
+        for encoding_type in variant["encoding_steps"]:
+            node = node[0].setdefault(encoding_type, ({}, []))
+        node[1].append(variant)
+    return root
+
+def iter_prefix_tree(node, content, use_gzip=False):
+    # Depth first, so only the contents along the current path are held; yields (variant, html bytes, layers encoded)
+    children, variants = node
+    for variant in variants:
+        yield variant, gzip_layer(content).encode('utf-8') if use_gzip else content, 0
+    for encoding_type, child in children.items():
+        encoded = encode_layer(encoding_type, content).encode('utf-8')
+        first = True
+        for variant, html, layers in iter_prefix_tree(child, encoded, use_gzip):
+            # The layer just encoded is counted once, against the first variant below it
+            yield variant, html, layers + first
+            first = False
+
+def generate_shard(job):
+    shard, output_dir, samples, use_gzip, max_output_bytes = job
+    start = time.perf_counter()
+    by_input = {}
+    for input_file, name, variant, seed in samples:
+        by_input.setdefault(input_file, []).append((name, variant, seed))
+
+    records = []
+    skipped = 0
+    layers_encoded = 0
+    hasher = hashlib.sha256()
+    offset = 0
+    path = os.path.join(output_dir, shard_file_name(shard))
+    layer_budget = max_layer_size(max_output_bytes, 'gzip' if use_gzip else None) if max_output_bytes is not None else None
+    with open(path + '.tmp', 'wb') as out:
+        for input_file, input_variants in by_input.items():
+            content = read_file(input_file)
+            first_layer_sizes = predict_first_layer_sizes([content]) if max_output_bytes is not None else None
+            variants = []
+            for name, variant, seed in input_variants:
+                encoding_steps = choose_encoding_steps(make_rng(seed), first_layer_sizes, layer_budget)
+                if not encoding_steps:
+                    skipped += 1
+                    continue
+                variants.append({"input": name, "variant": variant, "seed": seed, "encoding_steps": encoding_steps})
+
+            for variant, html, layers in iter_prefix_tree(build_prefix_tree(variants), content, use_gzip):
+                out.write(html)
+                hasher.update(html)
+                layers_encoded += layers
+                steps = variant["encoding_steps"] + ['gzip'] if use_gzip else variant["encoding_steps"]
+                records.append({**variant, "encoding_steps": steps, "offset": offset, "length": len(html)})
+                offset += len(html)
+    # Only a finished shard gets its final name, so a crash leaves nothing that looks complete
+    os.replace(path + '.tmp', path)
+    records.sort(key=lambda record: (record["input"], record["variant"]))
+    return {
+        "shard": shard,
+        "file": shard_file_name(shard),
+        "bytes": offset,
+        "sha256": hasher.hexdigest(),
+        "skipped": skipped,
+        "layers_encoded": layers_encoded,
+        "layers_total": sum(len(variant["encoding_steps"]) for variant in records) - (len(records) if use_gzip else 0),
+        "elapsed_seconds": round(time.perf_counter() - start, 6),
+        "samples": records,
+    }
+
+def read_corpus_manifest(output_dir):
+    # The first line holds the settings, every other line one finished shard; a rewritten shard's last line wins
+    settings = None
+    shards = {}
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if settings is None:
+                settings = entry
+            else:
+                shards[entry["shard"]] = entry
+    return settings, shards
+
+def shard_is_complete(output_dir, entry):
+    path = os.path.join(output_dir, entry["file"])
+    return os.path.isfile(path) and os.path.getsize(path) == entry["bytes"]
+
+def iter_corpus_samples(output_dir):
+    # Yields (sample record, html bytes) for every variant, shard by shard
+    _, shards = read_corpus_manifest(output_dir)
+    for shard in sorted(shards):
+        entry = shards[shard]
+        with open(os.path.join(output_dir, entry["file"]), 'rb') as f:
+            for record in sorted(entry["samples"], key=lambda record: record["offset"]):
+                f.seek(record["offset"])
+                yield record, f.read(record["length"])
+
+def plan_corpus(args):
+    inputs = collect_batch_inputs(args.source, args.input_list)
+    names = set()
+    samples = []
+    for input_file, file_seed in inputs:
+        name = os.path.basename(input_file)
+        if name in names:
+            raise ValueError(f"Duplicate input file name in corpus: {name}")
+        names.add(name)
+        for variant in range(args.variants):
+            samples.append((input_file, name, variant, variant_seed(args.seed, file_seed, name, variant)))
+    settings = {
+        "seed": args.seed,
+        "variants": args.variants,
+        "shard_size": args.shard_size,
+        "gzip": args.gzip,
+        "max_output_bytes": args.max_output_bytes,
+        "inputs": [[os.path.basename(input_file), file_seed] for input_file, file_seed in inputs],
+    }
+    shard_size = max(1, args.shard_size)
+    shards = [samples[start:start + shard_size] for start in range(0, len(samples), shard_size)]
+    return settings, shards
+
+def corpus_main(args):
+    settings, shards = plan_corpus(args)
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest_path = os.path.join(args.output_dir, MANIFEST_NAME)
+
+    done = set()
+    if os.path.exists(manifest_path):
+        if not args.resume:
+            raise ValueError(f"{manifest_path} already exists, pass --resume to continue that run")
+        previous_settings, previous_shards = read_corpus_manifest(args.output_dir)
+        if previous_settings != settings:
+            raise ValueError(f"{manifest_path} was written with different settings, use a new output directory")
+        done = {shard for shard, entry in previous_shards.items() if shard_is_complete(args.output_dir, entry)}
+    else:
+        with open(manifest_path, 'w', encoding='utf-8') as manifest:
+            manifest.write(json.dumps(settings) + '\n')
+
+    jobs = [(shard, args.output_dir, samples, args.gzip, args.max_output_bytes) for shard, samples in enumerate(shards) if shard not in done]
+    workers = max(1, args.workers or 1)
+    entries = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor, open(manifest_path, 'a', encoding='utf-8') as manifest:
+        pending_jobs = iter(jobs)
+        in_flight = set()
+        while True:
+            for job in pending_jobs:
+                in_flight.add(executor.submit(generate_shard, job))
+                if len(in_flight) >= 2 * workers:
+                    break
+            if not in_flight:
+                break
+            completed, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in completed:
+                entry = future.result()
+                # Written as soon as the shard is on disk, so an interrupted run can pick up from here
+                manifest.write(json.dumps(entry) + '\n')
+                manifest.flush()
+                entries.append(entry)
+    elapsed = time.perf_counter() - start
+
+    samples_written = sum(len(entry["samples"]) for entry in entries)
+    bytes_out = sum(entry["bytes"] for entry in entries)
+    layers_encoded = sum(entry["layers_encoded"] for entry in entries)
+    layers_total = sum(entry["layers_total"] for entry in entries)
+    print(f"Shards written: {len(entries)}, already complete: {len(done)}")
+    print(f"Variants written: {samples_written}, skipped: {sum(entry['skipped'] for entry in entries)}")
+    print(f"Layers encoded: {layers_encoded} of {layers_total} in the written variants")
+    print(f"Output: {bytes_out / 1024 ** 2:.2f} MB")
+    if elapsed > 0:
+        print(f"Elapsed: {elapsed:.2f} s, {samples_written / elapsed:.2f} variants/s")
+    return entries
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    try:
+        corpus_main(parse_corpus_arguments())
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
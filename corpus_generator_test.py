@@ -0,0 +1,83 @@
+import unittest
+import os
+import json
+import tempfile
+from unittest import mock
+from corpus_generator import parse_corpus_arguments, corpus_main, read_corpus_manifest, iter_corpus_samples, build_prefix_tree, iter_prefix_tree, MANIFEST_NAME
+from encoder import encode
+
+class TestCorpusGenerator(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.input_dir = os.path.join(self.tmp_dir.name, "inputs")
+        os.makedirs(self.input_dir)
+        for name, content in (("a.html", "<p>Hello</p>"), ("b.html", "<p>café</p>")):
+            with open(os.path.join(self.input_dir, name), 'w', encoding='utf-8') as f:
+                f.write(content)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def run_corpus(self, output_name, *extra):
+        output_dir = os.path.join(self.tmp_dir.name, output_name)
+        args = parse_corpus_arguments([self.input_dir, output_dir, '--seed', '7', '--variants', '5', '--shard-size', '4', '--workers', '1', *extra])
+        with mock.patch('builtins.print'):
+            corpus_main(args)
+        return output_dir
+
+    def read_shards(self, output_dir):
+        return {name: open(os.path.join(output_dir, name), 'rb').read() for name in sorted(os.listdir(output_dir)) if name.startswith('shard-')}
+
+    def test_prefix_tree_shares_layers(self):
+        variants = [{"encoding_steps": steps} for steps in (['base64', 'uri'], ['base64', 'unicode'], ['base64'])]
+        results = list(iter_prefix_tree(build_prefix_tree(variants), b"<p>Hi</p>"))
+        self.assertEqual(sum(layers for _, _, layers in results), 3)
+        for variant, html, _ in results:
+            self.assertEqual(html, encode(b"<p>Hi</p>", variant["encoding_steps"]))
+
+    def test_corpus_matches_encode(self):
+        output_dir = self.run_corpus("corpus", '--gzip')
+        settings, shards = read_corpus_manifest(output_dir)
+        self.assertEqual(settings["seed"], '7')
+        self.assertEqual(sorted(shards), [0, 1, 2])
+        samples = list(iter_corpus_samples(output_dir))
+        self.assertEqual(len(samples), 10)
+        for record, html in samples:
+            self.assertEqual(record["encoding_steps"][-1], 'gzip')
+            with open(os.path.join(self.input_dir, record["input"]), 'rb') as f:
+                self.assertEqual(html, encode(f.read(), record["encoding_steps"][:-1], gzip=True))
+
+    def test_corpus_is_deterministic(self):
+        first = self.read_shards(self.run_corpus("first", '--gzip'))
+        second = self.read_shards(self.run_corpus("second", '--gzip'))
+        self.assertEqual(first, second)
+
+    def test_resume(self):
+        output_dir = self.run_corpus("corpus")
+        expected = self.read_shards(output_dir)
+        manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+        # Simulate a run that was stopped before its last shard was recorded
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+        last = json.loads(lines[-1])
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            f.writelines(lines[:-1])
+        os.remove(os.path.join(output_dir, last["file"]))
+
+        with self.assertRaises(ValueError):
+            self.run_corpus("corpus")
+        with mock.patch('builtins.print'):
+            entries = corpus_main(parse_corpus_arguments([self.input_dir, output_dir, '--seed', '7', '--variants', '5', '--shard-size', '4', '--workers', '1', '--resume']))
+        self.assertEqual([entry["shard"] for entry in entries], [last["shard"]])
+        self.assertEqual(self.read_shards(output_dir), expected)
+        self.assertEqual(len(read_corpus_manifest(output_dir)[1]), 3)
+
+    def test_resume_rejects_other_settings(self):
+        output_dir = self.run_corpus("corpus")
+        with self.assertRaises(ValueError):
+            self.run_corpus("corpus", '--resume', '--gzip')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import hashlib
+import sqlite3
+import time
+
+DECODE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+def layer_key(text):
+    return hashlib.sha256(text.encode('utf-8', errors='surrogatepass')).digest()
+
+class DecodeCache:
+    # Maps the SHA-256 of a layer's input text to its fully decoded text and the steps that produced it
+    def __init__(self, path, max_bytes=DECODE_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # last_used times from hits, written with the next put so a hit does not take the write lock
+        self.touched = {}
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS layers (key BLOB PRIMARY KEY, content TEXT NOT NULL, steps TEXT NOT NULL, size INTEGER NOT NULL, last_used INTEGER NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS layers_last_used ON layers (last_used)")
+        # Running total of the sizes, shared by every process using the file, so eviction does not have to sum the table
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)")
+        self.connection.execute("INSERT OR IGNORE INTO cache_size (id, bytes) SELECT 0, COALESCE(SUM(size), 0) FROM layers")
+        self.connection.commit()
+
+    def get(self, key, accept=None):
+        # accept can turn down an entry by its steps, which then counts as a miss
+        row = self.connection.execute("SELECT content, steps FROM layers WHERE key = ?", (key,)).fetchone()
+        steps = (row[1].split(',') if row[1] else []) if row is not None else None
+        if row is None or accept is not None and not accept(steps):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touched[key] = time.time_ns()
+        return row[0], steps
+
+    def put(self, key, content, steps):
+        size = len(content.encode('utf-8', errors='surrogatepass'))
+        if size > self.max_bytes:
+            return
+        # Taking the old size off first also takes the write lock, so the total cannot change under us
+        self.connection.execute("UPDATE cache_size SET bytes = bytes - COALESCE((SELECT size FROM layers WHERE key = ?), 0)", (key,))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO layers (key, content, steps, size, last_used) VALUES (?, ?, ?, ?, ?)",
+            (key, content, ','.join(steps), size, time.time_ns()),
+        )
+        self.connection.execute("UPDATE cache_size SET bytes = bytes + ?", (size,))
+        self.write_touched()
+        self.evict()
+        self.connection.commit()
+
+    def write_touched(self):
+        if self.touched:
+            self.connection.executemany("UPDATE layers SET last_used = MAX(last_used, ?) WHERE key = ?", [(used, key) for key, used in self.touched.items()])
+            self.touched.clear()
+
+    def total_bytes(self):
+        return self.connection.execute("SELECT bytes FROM cache_size").fetchone()[0]
+
+    def evict(self):
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        # Least recently used entries go first until the store fits again
+        stale = []
+        for key, size in self.connection.execute("SELECT key, size FROM layers ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        self.connection.executemany("DELETE FROM layers WHERE key = ?", stale)
+        self.connection.execute("UPDATE cache_size SET bytes = ?", (total,))
+        self.evictions += len(stale)
+
+    def stats(self):
+        entries = self.connection.execute("SELECT COUNT(*) FROM layers").fetchone()[0]
+        total = self.total_bytes()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+        }
+
+    def flush(self):
+        self.write_touched()
+        self.connection.commit()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
@@ -0,0 +1,87 @@
+import unittest
+import os
+import tempfile
+from decode_cache import DecodeCache, layer_key
+
+class TestDecodeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "cache.sqlite")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_get_put(self):
+        cache = DecodeCache(self.path)
+        key = layer_key('atob("SGk=")')
+        self.assertIsNone(cache.get(key))
+        cache.put(key, "Hi", ["base64"])
+        self.assertEqual(cache.get(key), ("Hi", ["base64"]))
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"], stats["bytes"]), (1, 1, 1, 2))
+        self.assertEqual(stats["hit_rate"], 0.5)
+        cache.close()
+
+    def test_persists_across_connections(self):
+        cache = DecodeCache(self.path)
+        cache.put(layer_key("a"), "decoded", ["uri", "base64"])
+        cache.close()
+        cache = DecodeCache(self.path)
+        self.assertEqual(cache.get(layer_key("a")), ("decoded", ["uri", "base64"]))
+        cache.close()
+
+    def test_lru_eviction(self):
+        cache = DecodeCache(self.path, max_bytes=10)
+        cache.put(layer_key("a"), "aaaa", ["uri"])
+        cache.put(layer_key("b"), "bbbb", ["uri"])
+        # Reading a makes b the least recently used entry
+        cache.get(layer_key("a"))
+        cache.put(layer_key("c"), "cccc", ["uri"])
+        self.assertIsNone(cache.get(layer_key("b")))
+        self.assertIsNotNone(cache.get(layer_key("a")))
+        self.assertIsNotNone(cache.get(layer_key("c")))
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertLessEqual(cache.stats()["bytes"], 10)
+        cache.close()
+
+    def test_hits_are_written_with_the_next_put(self):
+        cache = DecodeCache(self.path, max_bytes=10)
+        cache.put(layer_key("a"), "aaaa", ["uri"])
+        cache.put(layer_key("b"), "bbbb", ["uri"])
+        cache.get(layer_key("a"))
+        self.assertFalse(cache.connection.in_transaction)
+        cache.close()
+        # The hit was kept when the cache closed, so a is still the most recently used entry
+        cache = DecodeCache(self.path, max_bytes=10)
+        cache.put(layer_key("c"), "cccc", ["uri"])
+        self.assertIsNone(cache.get(layer_key("b")))
+        self.assertIsNotNone(cache.get(layer_key("a")))
+        cache.close()
+
+    def test_running_total(self):
+        cache = DecodeCache(self.path)
+        cache.put(layer_key("a"), "aaaa", ["uri"])
+        cache.put(layer_key("a"), "aa", ["uri"])
+        cache.put(layer_key("b"), "bbb", ["uri"])
+        self.assertEqual(cache.stats()["bytes"], 5)
+        cache.close()
+        other = DecodeCache(self.path)
+        cache = DecodeCache(self.path, max_bytes=6)
+        # An entry put through another connection counts towards the shared total
+        other.put(layer_key("c"), "cc", ["uri"])
+        cache.put(layer_key("d"), "d", ["uri"])
+        self.assertEqual(cache.stats()["bytes"], cache.connection.execute("SELECT SUM(size) FROM layers").fetchone()[0])
+        self.assertLessEqual(cache.stats()["bytes"], 6)
+        other.close()
+        cache.close()
+
+    def test_entry_larger_than_cache_is_skipped(self):
+        cache = DecodeCache(self.path, max_bytes=3)
+        cache.put(layer_key("a"), "aaaa", ["uri"])
+        self.assertEqual(cache.stats()["entries"], 0)
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
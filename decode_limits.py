@@ -0,0 +1,75 @@
+import time
+from dataclasses import dataclass
+
+class DecodeLimitExceeded(Exception):
+    pass
+
+@dataclass
+class DecodeLimits:
+    # None leaves that limit off
+    max_layers: int = None
+    max_total_bytes: int = None
+    max_expansion: float = None
+    max_seconds: float = None
+
+class DecodeBudget:
+    # What one decode has used so far; a layer that would go over a limit raises DecodeLimitExceeded and is left encoded
+    def __init__(self, limits):
+        self.limits = limits
+        self.deadline = time.monotonic() + limits.max_seconds if limits.max_seconds is not None else None
+        self.layers = 0
+        self.total_bytes = 0
+        self.truncated = None
+
+    def check_layer(self):
+        if self.limits.max_layers is not None and self.layers >= self.limits.max_layers:
+            raise DecodeLimitExceeded(f"more than {self.limits.max_layers} layers")
+        self.check_time()
+
+    def check_time(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise DecodeLimitExceeded(f"took longer than {self.limits.max_seconds} seconds")
+
+    def output_limit(self, input_size):
+        # Largest output the next layer may produce, so inflating can stop as soon as it passes it
+        limits = []
+        if self.limits.max_expansion is not None:
+            limits.append(int(input_size * self.limits.max_expansion))
+        if self.limits.max_total_bytes is not None:
+            limits.append(self.limits.max_total_bytes - self.total_bytes)
+        return min(limits) if limits else None
+
+    def add_cached(self, steps):
+        # A cache hit stands for these layers. Only the final text is stored, not each layer's output,
+        # so with a byte or expansion limit the hit is turned down and the layers are decoded again to be measured
+        if self.limits.max_total_bytes is not None or self.limits.max_expansion is not None:
+            return False
+        if self.limits.max_layers is not None and self.layers + len(steps) > self.limits.max_layers:
+            return False
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            return False
+        self.layers += len(steps)
+        return True
+
+    def add_layer(self, input_size, output_size):
+        if self.limits.max_expansion is not None and output_size > input_size * self.limits.max_expansion:
+            raise DecodeLimitExceeded(f"a layer expanded more than {self.limits.max_expansion} times")
+        if self.limits.max_total_bytes is not None and self.total_bytes + output_size > self.limits.max_total_bytes:
+            raise DecodeLimitExceeded(f"more than {self.limits.max_total_bytes} decoded bytes")
+        self.layers += 1
+        self.total_bytes += output_size
+
+def limits_from_args(args):
+    limits = DecodeLimits(
+        max_layers=getattr(args, 'max_layers', None),
+        max_total_bytes=getattr(args, 'max_decoded_bytes', None),
+        max_expansion=getattr(args, 'max_expansion', None),
+        max_seconds=getattr(args, 'max_seconds', None),
+    )
+    return limits if limits != DecodeLimits() else None
+
+def add_limit_arguments(parser):
+    parser.add_argument('--max-layers', type=int, help='Stop after peeling this many layers and report the result as truncated')
+    parser.add_argument('--max-decoded-bytes', type=int, help='Stop before the layers decoded so far add up to more than this many bytes')
+    parser.add_argument('--max-expansion', type=float, help='Stop at a layer whose output is more than this many times the size of its payload')
+    parser.add_argument('--max-seconds', type=float, help='Stop peeling layers after this many seconds')
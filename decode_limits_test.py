@@ -0,0 +1,56 @@
+import unittest
+import argparse
+from unittest import mock
+from decode_limits import DecodeLimits, DecodeBudget, DecodeLimitExceeded, limits_from_args, add_limit_arguments
+from codec_registry import inflate, compress_content
+
+class TestDecodeLimits(unittest.TestCase):
+
+    def test_budget(self):
+        budget = DecodeBudget(DecodeLimits(max_layers=2, max_total_bytes=100, max_expansion=4))
+        self.assertEqual(budget.output_limit(10), 40)
+        budget.check_layer()
+        budget.add_layer(10, 40)
+        self.assertEqual(budget.output_limit(100), 60)
+        with self.assertRaisesRegex(DecodeLimitExceeded, "expanded"):
+            budget.add_layer(10, 41)
+        with self.assertRaisesRegex(DecodeLimitExceeded, "decoded bytes"):
+            budget.add_layer(100, 61)
+        budget.add_layer(100, 60)
+        with self.assertRaisesRegex(DecodeLimitExceeded, "layers"):
+            budget.check_layer()
+        self.assertIsNone(DecodeBudget(DecodeLimits()).output_limit(10))
+
+    def test_add_cached(self):
+        budget = DecodeBudget(DecodeLimits(max_layers=3))
+        self.assertTrue(budget.add_cached(["base64", "uri"]))
+        self.assertFalse(budget.add_cached(["base64", "uri"]))
+        self.assertEqual(budget.layers, 2)
+        self.assertTrue(budget.add_cached(["gzip"]))
+        # Cached entries do not say what each layer produced, so byte and expansion limits never take them
+        self.assertFalse(DecodeBudget(DecodeLimits(max_total_bytes=10 ** 9)).add_cached([]))
+        self.assertFalse(DecodeBudget(DecodeLimits(max_expansion=1000)).add_cached(["base64"]))
+
+    def test_deadline(self):
+        with mock.patch('decode_limits.time.monotonic', side_effect=[0, 0.5, 2]):
+            budget = DecodeBudget(DecodeLimits(max_seconds=1))
+            budget.check_time()
+            with self.assertRaises(DecodeLimitExceeded):
+                budget.check_time()
+
+    def test_inflate_max_length(self):
+        for compression, wbits in (("gzip", 31), ("zlib", 15), ("deflate", -15)):
+            compressed = compress_content(b"x" * 100000, compression)
+            self.assertEqual(inflate(compressed, wbits, max_length=100000), b"x" * 100000)
+            with self.assertRaises(DecodeLimitExceeded):
+                inflate(compressed, wbits, max_length=99999)
+
+    def test_limits_from_args(self):
+        parser = argparse.ArgumentParser()
+        add_limit_arguments(parser)
+        self.assertIsNone(limits_from_args(parser.parse_args([])))
+        self.assertEqual(limits_from_args(parser.parse_args(['--max-layers', '5', '--max-seconds', '2'])), DecodeLimits(max_layers=5, max_seconds=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
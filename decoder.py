@@ -1,20 +1,45 @@
 import argparse
 import base64
+import binascii
+import bisect
+import codecs
+import hashlib
+import mmap
+import multiprocessing
+import os
 import re
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
 from html.parser import HTMLParser
 import json
-import gzip
 import io
-from urllib.parse import unquote
-import magic
+from profiling import LayerProfiler, profile_layer
+from decode_cache import DecodeCache, DECODE_CACHE_MAX_BYTES, layer_key
+from decode_limits import DecodeBudget, DecodeLimitExceeded, add_limit_arguments, limits_from_args
+from codec_registry import CODECS, COMPRESSION_WBITS, compressed_payload_format, stream_gunzip, DETECTOR_CODECS, DETECTOR_PATTERNS, DETECTOR_PREFIXES, HTML_BEFORE_CALL, HTML_AFTER_CALL, decode_and_unzip_base64, decode_base64, unescape_unicode_per_match, unescape_unicode_bulk, unescape_uri_bulk, decode_unicode, decode_uri
 
+MIME_CACHE_SIZE = 1024
+EXTRACT_CHUNK_SIZE = 64 * 1024
+LARGE_FILE_CHUNK_SIZE = 8 * 1024 * 1024
+# unquote splits its input into one object per escape, so unescape layers are read in smaller chunks
+LARGE_FILE_UNESCAPE_CHUNK_SIZE = 1024 * 1024
+TRACE_PREVIEW_CHARS = 120
+
+# libmagic is only loaded once a scan needs it, and then shared by every scan in the process
+_magic_detector = None
+_mime_cache = OrderedDict()
+_mime_cache_size = MIME_CACHE_SIZE
+# Opened per batch worker by init_batch_worker when --cache is given
+_decode_cache = None
+_decode_limits = None
 
-def decode_and_unzip_base64(encoded_content):
-    decoded_content = base64.b64decode(encoded_content)
-    buffer = io.BytesIO(decoded_content)
-    with gzip.open(buffer, 'rb') as f:
-        unzipped_content = f.read()
-    return unzipped_content.decode('utf-8')
 
 def read_file(input_file, mode='rb', encoding=None):
     with open(input_file, mode, encoding=encoding) as f:
@@ -28,201 +53,988 @@ def write_file(output_file, content, mode='w', encoding=None):
 class CustomHTMLParser(HTMLParser):
     def __init__(self):
         super().__init__()
-        self.script_data = ""
+        self.fragments = []
+
+    def handle_data(self, data):
+        self.fragments.append(data)
+
+    @property
+    def script_data(self):
+        # Joined on first use, so collecting text stays linear however many nodes there are
+        if len(self.fragments) > 1:
+            self.fragments[:] = [''.join(self.fragments)]
+        return self.fragments[0] if self.fragments else ""
+
+@dataclass
+class ScriptPayload:
+    kind: str
+    offset: int
+    line: int
+    column: int
+    content: str
+
+class ScriptExtractor(HTMLParser):
+    # Collects <script> bodies and data: URIs in attributes, each with the character offset it starts at
+    def __init__(self):
+        super().__init__()
+        self.payloads = deque()
+        self.newline_offsets = []
+        self.fed = 0
+        self.script_fragments = None
+        self.script_offset = None
+
+    def feed(self, data):
+        self.newline_offsets.extend(self.fed + match.start() for match in re.finditer("\n", data))
+        self.fed += len(data)
+        super().feed(data)
+
+    def close(self):
+        super().close()
+        if self.script_fragments is not None:
+            # An unterminated script runs to the end of the document, and HTMLParser keeps that tail to itself
+            self.script_fragments.append(self.rawdata)
+            self.emit_script()
+
+    def current_offset(self):
+        line, column = self.getpos()
+        return column if line == 1 else self.newline_offsets[line - 2] + 1 + column
+
+    def add_payload(self, kind, offset, content):
+        line, column = offset_to_location(self.newline_offsets, offset)
+        self.payloads.append(ScriptPayload(kind, offset, line, column, content))
+
+    def emit_script(self):
+        content = ''.join(self.script_fragments)
+        if content:
+            self.add_payload("script", self.script_offset, content)
+        self.script_fragments = None
+
+    def handle_starttag(self, tag, attrs):
+        tag_offset = self.current_offset()
+        tag_text = self.get_starttag_text()
+        if tag == "script":
+            self.script_fragments = []
+            self.script_offset = tag_offset + len(tag_text)
+        for name, value in attrs:
+            if value and value.lstrip()[:5].lower() == "data:":
+                value_index = tag_text.find(value)
+                self.add_payload("data_uri", tag_offset + max(value_index, 0), value)
+
+    def handle_endtag(self, tag):
+        if tag == "script" and self.script_fragments is not None:
+            self.emit_script()
 
     def handle_data(self, data):
-        self.script_data += data
+        if self.script_fragments is not None:
+            self.script_fragments.append(data)
 
 def parse_decoding_arguments():
     parser = argparse.ArgumentParser(description='Decode input HTML file and create a new file with decoded content')
     parser.add_argument('input_html_file', type=str, help='Input HTML file')
     parser.add_argument('output_file', type=str, help='Output file')
     parser.add_argument('--cyberchef', action='store_true', help='Save CyberChef output to a file')
+    parser.add_argument('--mime-cache-size', type=int, default=MIME_CACHE_SIZE, help='Number of MIME detection results to cache, 0 disables the cache')
+    parser.add_argument('--profile', action='store_true', help='Print per-layer timings and memory use and save them as JSON next to the output file')
+    parser.add_argument('--cache', type=str, help='SQLite file that caches decoded layers across runs, off unless given')
+    parser.add_argument('--cache-max-bytes', type=int, default=DECODE_CACHE_MAX_BYTES, help='Size the cached layers are kept under, least recently used first out')
+    parser.add_argument('--large-file', action='store_true', help='Memory-map the input and decode each layer in chunks through spill files, for inputs too large to hold in memory')
+    parser.add_argument('--spill-dir', type=str, help='Directory for the per-layer spill files of --large-file, the system temp directory by default')
+    parser.add_argument('--workers', type=int, default=1, help='Decode independent payloads in this many processes')
+    parser.add_argument('--step', action='store_true', help='Show each layer as it is peeled, with its range, sizes and a preview')
+    parser.add_argument('--trace-dir', type=str, help='With --step, save the full output of every layer to this directory')
+    add_limit_arguments(parser)
     return parser.parse_args()
 
-def decode_base64(encoded_content):
-    return base64.b64decode(encoded_content.encode('utf-8'))
+def parse_batch_decoding_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='decoder.py batch', description='Decode every HTML file in a directory in parallel and write one JSON line per file')
+    parser.add_argument('input_dir', type=str, help='Directory that is walked for input files')
+    parser.add_argument('output_jsonl', type=str, help='JSON lines file the results are written to')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Maximum number of files decoded at once')
+    parser.add_argument('--timeout', type=float, default=60, help='Seconds a single file may take before it is recorded as a timeout')
+    parser.add_argument('--mime-cache-size', type=int, default=MIME_CACHE_SIZE, help='Number of MIME detection results each worker caches, 0 disables the cache')
+    parser.add_argument('--cache', type=str, help='SQLite file of decoded layers shared by the workers, off unless given')
+    parser.add_argument('--cache-max-bytes', type=int, default=DECODE_CACHE_MAX_BYTES, help='Size the cached layers are kept under, least recently used first out')
+    add_limit_arguments(parser)
+    return parser.parse_args(argv)
 
-def decode_unicode(encoded_content):
-    return re.sub(r'\\u([0-9a-fA-F]{4})', lambda x: chr(int(x.group(1), 16)), encoded_content)
+def feed_chunks(parser, f, chunk_size=EXTRACT_CHUNK_SIZE):
+    # HTMLParser holds back an unfinished element, such as a long script body, and rescans it on every feed.
+    # Reading at least as much as it holds back keeps that to a doubling buffer, so feeding stays linear.
+    while True:
+        chunk = f.read(max(chunk_size, len(parser.rawdata)))
+        if not chunk:
+            return
+        parser.feed(chunk)
+        yield
 
 def extract_script_content(input_html_file):
+    parser = CustomHTMLParser()
     with open(input_html_file, 'r', encoding='utf-8') as f:
-        html_content = f.read()
+        for _ in feed_chunks(parser, f):
+            pass
+    return parser.script_data
+
+def iter_script_payloads(source, chunk_size=EXTRACT_CHUNK_SIZE):
+    # source is a path or a text file object; payloads are yielded as soon as the parser has seen them whole
+    extractor = ScriptExtractor()
+    with open(source, 'r', encoding='utf-8') if isinstance(source, (str, os.PathLike)) else nullcontext(source) as f:
+        for _ in feed_chunks(extractor, f, chunk_size):
+            while extractor.payloads:
+                yield extractor.payloads.popleft()
+    extractor.close()
+    while extractor.payloads:
+        yield extractor.payloads.popleft()
+
+def decode_script_payloads(source, profiler=None, cache=None, chunk_size=EXTRACT_CHUNK_SIZE):
+    # Each script is decoded as soon as it has been read, before the rest of the document is parsed
+    for payload in iter_script_payloads(source, chunk_size):
+        if payload.kind == "script":
+            decoded_content, encoding_steps = decode_layers(payload.content, profiler, cache)
+            yield payload, decoded_content, encoding_steps
+
+def extract_script_text(html_content):
     parser = CustomHTMLParser()
     parser.feed(html_content)
     return parser.script_data
 
 def create_cyberchef_ops_json(encoding_steps):
     cyberchef_ops = []
-    find_replace_op = {
-        "op": "Find / Replace",
-        "args": [
-            {"option": "Regex", "string": "^<.*\\(\"|\"\\).*>$"},
-            "",
-            True,
-            False,
-            True,
-            False,
-        ],
-    }
-
     for step in encoding_steps:
-        cyberchef_ops.append(find_replace_op)
-        if step == "base64":
-            cyberchef_ops.append({"op": "From Base64", "args": ["A-Za-z0-9+/="]})
-        elif step == "unicode":
-            cyberchef_ops.append({ "op": "Unescape Unicode Characters", "args": ["\\u"] })
-        elif step == "uri":
-            cyberchef_ops.append({"op":"URL Decode","args":[]})
-        elif step == "gzip":
-            gzip_recipe = [
-                {"op": "Regular expression", "args": ["User defined", "data:application/octet-stream;base64,([^;']+)", True, True, False, False, False, False, "List capture groups"]},
-                {"op": "From Base64", "args": ["A-Za-z0-9+/=", True, False]},
-                {"op": "Gunzip", "args": []}
-            ]
-            cyberchef_ops.extend(gzip_recipe)
+        cyberchef_ops.extend(CODECS[step].cyberchef_ops)
 
     return json.dumps(cyberchef_ops, indent=2)
 
-def decode_random_encoding(script_content):
-    decoded_content = script_content
-    counters = {"base64": 0, "unicode": 0, "uri": 0, "gzip": 0}
+# One alternation of every codec's detector, so each pass is a single search whatever the number of codecs
+LAYER_PATTERN = re.compile('|'.join(DETECTOR_PATTERNS.values()))
+
+# Documents produced by the encoder's document.write wrappers: (before, opener, closer, after, detector)
+WRAPPER_SHAPES = list(dict.fromkeys(
+    (HTML_BEFORE_CALL, codec.opener, codec.closer, HTML_AFTER_CALL, codec.detector)
+    for codec in CODECS.values() if codec.opener and codec.opener.endswith('"')
+))
+
+def find_layer(text):
+    # Fast path: the whole text is one of the encoder's own wrappers, so the payload can be sliced out directly.
+    # A quoted payload ends at the first quote, so one without quotes or newlines is exactly what the regex matches.
+    for before, opener, closer, after, kind in WRAPPER_SHAPES:
+        if text.startswith(before + opener) and text.endswith(closer + after):
+            start = len(before)
+            payload = text[start + len(opener):len(text) - len(closer) - len(after)]
+            if '"' not in payload and '\n' not in payload:
+                return start, len(text) - len(after), kind, payload
+
+    match = LAYER_PATTERN.search(text)
+    if match is None:
+        return None
+    return match.start(), match.end(), match.lastgroup, match.group(match.lastgroup)
+
+def decode_layer(kind, payload, budget=None):
+    # Codecs that share a detector are tried in registry order, the first that applies names the step
+    for codec in DETECTOR_CODECS[kind]:
+        if codec.inflates and budget is not None:
+            decoded_str = codec.decode(payload, max_length=budget.output_limit(len(payload)), deadline=budget.deadline)
+        else:
+            decoded_str = codec.decode(payload)
+        if decoded_str is not None:
+            return codec.name, decoded_str
+    return None
+
+def decode_layers(script_content, profiler=None, cache=None, budget=None):
+    # Text left of the current position is final; pending holds the rest, innermost layer on top.
+    # Each peel only searches the freshly decoded payload, so every layer is scanned once.
+    # Once the budget runs out, the layers still pending are kept as they are and nothing more is cached.
+    decoded_parts = []
+    pending = [script_content]
     encoding_steps = []
 
-    while True:
-        updated = False
-
-        # Base64 decoding
-        b64_match = re.search(r'atob\s*\(\s*(["\'])(.+?)\1\s*\)', decoded_content)
-        if b64_match:
-            decoded_str = decode_base64(b64_match.group(2)).decode('utf-8')
-            decoded_content = decoded_content.replace(b64_match.group(0), decoded_str)
-            counters["base64"] += 1
-            encoding_steps.append("base64")
-            updated = True
-
-        # Unicode and URI decoding
-        unicode_match = re.search(r'unescape\s*\(\s*(["\'])(.+?)\1\s*\)', decoded_content)
-        if unicode_match:
-            encoded_str = unicode_match.group(2)
-            decoded_str = decode_unicode(encoded_str)
-            if decoded_str != encoded_str:
-                decoded_content = decoded_content.replace(unicode_match.group(0), decoded_str)
-                counters["unicode"] += 1
-                encoding_steps.append("unicode")
-                updated = True
+    while pending:
+        text = pending.pop()
+        if isinstance(text, tuple):
+            # Everything decoded from this layer's text is final now, so remember it under the text's hash
+            key, parts_start, steps_start = text
+            if budget is None or budget.truncated is None:
+                cache.put(key, ''.join(decoded_parts[parts_start:]), encoding_steps[steps_start:])
+            continue
+        layer = find_layer(text) if budget is None or budget.truncated is None else None
+        if layer is None:
+            decoded_parts.append(text)
+            continue
+
+        if cache is not None:
+            key = layer_key(text)
+            cached = cache.get(key, budget.add_cached if budget is not None else None)
+            if cached is not None:
+                decoded_parts.append(cached[0])
+                encoding_steps.extend(cached[1])
+                continue
+            pending.append((key, len(decoded_parts), len(encoding_steps)))
+
+        start, end, kind, payload = layer
+        decoded = peel_layer(kind, payload, profiler, budget)
+        if decoded is None:
+            decoded_parts.append(text[:end])
+            pending.append(text[end:])
+            continue
+
+        step, decoded_str = decoded
+        encoding_steps.append(step)
+        decoded_parts.append(text[:start])
+        pending.append(text[end:])
+        pending.append(decoded_str)
+
+    return ''.join(decoded_parts), encoding_steps
+
+def peel_layer(kind, payload, profiler=None, budget=None):
+    # With a budget, a layer that goes over a limit is not peeled and the reason is kept in budget.truncated
+    try:
+        with profile_layer(profiler, kind, len(payload)) as layer_profile:
+            if budget is not None:
+                budget.check_layer()
+            decoded = decode_layer(kind, payload, budget)
+            if decoded is None:
+                layer_profile["skipped"] = True
             else:
-                try:
-                    decoded_uri_str = unquote(encoded_str)
-                    if decoded_uri_str != encoded_str:
-                        decoded_content = decoded_content.replace(unicode_match.group(0), decoded_uri_str)
-                        counters["uri"] += 1
-                        encoding_steps.append("uri")
-                        updated = True
-                except Exception as e:
-                    print(f"Error decoding URI: {e}")
-
-        # Gzip decompressing
-        gzip_match = re.search(r'data:application/octet-stream;base64,(.+)', decoded_content)
-        if gzip_match:
-            decoded_str = decode_and_unzip_base64(gzip_match.group(1))
-            decoded_content = decoded_content.replace(gzip_match.group(0), decoded_str)
-            counters["gzip"] += 1
-            encoding_steps.append("gzip")
-            updated = True
-
-        if not updated:
-            break
+                if budget is not None:
+                    budget.add_layer(len(payload), len(decoded[1]))
+                layer_profile["encoding_type"] = decoded[0]
+                layer_profile["output_size"] = len(decoded[1])
+    except DecodeLimitExceeded as e:
+        budget.truncated = str(e)
+        return None
+    return decoded
+
+def find_layers(text):
+    # Every top-level payload in one pass; decoding one payload never moves the others
+    layer = find_layer(text)
+    if layer is None:
+        return []
+    layers = [layer]
+    for match in LAYER_PATTERN.finditer(text, layer[1]):
+        layers.append((match.start(), match.end(), match.lastgroup, match.group(match.lastgroup)))
+    return layers
+
+def decode_payload(layer_text, kind, payload, profiler=None, cache=None, budget=None):
+    # Resolves one payload down to its original text, returns (encoding_steps, content) or None if it is not encoded
+    if budget is not None and budget.truncated is not None:
+        return None
+    if cache is not None:
+        key = layer_key(layer_text)
+        cached = cache.get(key, budget.add_cached if budget is not None else None)
+        if cached is not None:
+            return cached[1], cached[0]
+    decoded = peel_layer(kind, payload, profiler, budget)
+    if decoded is None:
+        return None
+    step, decoded_str = decoded
+    content, inner_steps = decode_layers(decoded_str, profiler, cache, budget)
+    encoding_steps = [step] + inner_steps
+    if cache is not None and (budget is None or budget.truncated is None):
+        cache.put(key, content, encoding_steps)
+    return encoding_steps, content
+
+def decode_payloads(script_content, workers=1, executor=None, profiler=None, cache=None, budget=None):
+    layers = find_layers(script_content)
+    jobs = [(script_content[start:end], kind, payload) for start, end, kind, payload in layers]
+    # The profiler, the SQLite connection and the budget stay in this process, so with any of them the payloads are decoded in turn
+    if len(jobs) > 1 and (executor is not None or workers > 1) and profiler is None and cache is None and budget is None:
+        with nullcontext(executor) if executor is not None else ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            results = list(pool.map(decode_payload, *zip(*jobs)))
+    else:
+        results = [decode_payload(*job, profiler, cache, budget) for job in jobs]
+
+    # One rebuild: the untouched text between payloads and each decoded payload, in offset order
+    decoded_parts = []
+    encoding_steps = []
+    payloads = []
+    position = 0
+    for (start, end, kind, payload), result in zip(layers, results):
+        decoded_parts.append(script_content[position:start])
+        position = end
+        if result is None:
+            decoded_parts.append(script_content[start:end])
+            continue
+        payload_steps, content = result
+        decoded_parts.append(content)
+        encoding_steps.extend(payload_steps)
+        payloads.append({"start": start, "end": end, "encoding_steps": payload_steps})
+    decoded_parts.append(script_content[position:])
+    return ''.join(decoded_parts), encoding_steps, payloads
+
+@dataclass
+class DecodeResult:
+    content: str
+    encoding_steps: list
+    layer_counts: dict
+    mime_type: str = None
+    embedded_mime_types: dict = field(default_factory=dict)
+    script_tags: list = field(default_factory=list)
+    indicators: dict = field(default_factory=dict)
+    payloads: list = field(default_factory=list)
+    # Why decoding stopped early, None when every layer was peeled
+    truncated: str = None
+
+    def cyberchef_recipe(self):
+        return create_cyberchef_ops_json(self.encoding_steps)
+
+def read_input_text(html):
+    if hasattr(html, 'read'):
+        html = html.read()
+    if isinstance(html, str):
+        return html
+    # Same newline handling as reading the file in text mode, so results match the CLI
+    return io.TextIOWrapper(io.BytesIO(bytes(html)), encoding='utf-8').read()
+
+def decode(html, scan=True, profiler=None, cache=None, workers=1, executor=None, limits=None):
+    # In-process API: bytes, memoryview, str or a file object in, a DecodeResult out, nothing printed or written
+    budget = DecodeBudget(limits) if limits is not None else None
+    script_content = extract_script_text(read_input_text(html))
+    decoded_content, encoding_steps, payloads = decode_payloads(script_content, workers, executor, profiler, cache, budget)
+    result = DecodeResult(
+        content=decoded_content,
+        encoding_steps=encoding_steps,
+        layer_counts={step: encoding_steps.count(step) for step in CODECS},
+        payloads=payloads,
+        truncated=budget.truncated if budget is not None else None,
+    )
+    if scan:
+        scan_results = scan_content(decoded_content.encode('utf-8', errors='surrogatepass'))
+        result.mime_type = scan_results["mime_type"]
+        result.embedded_mime_types = scan_results["embedded_mime_types"]
+        result.script_tags = scan_results["script_tags"]
+        result.indicators = scan_results["indicators"]
+    return result
+
+def decode_random_encoding(script_content, profiler=None, cache=None, workers=1, limits=None):
+    budget = DecodeBudget(limits) if limits is not None else None
+    decoded_content, encoding_steps, payloads = decode_payloads(script_content, workers, profiler=profiler, cache=cache, budget=budget)
+    print_encoding_flow(encoding_steps)
+    if len(payloads) > 1:
+        print_payload_flows(payloads)
+    print_truncated(budget)
+    return decoded_content, encoding_steps
+
+def print_truncated(budget):
+    if budget is not None and budget.truncated is not None:
+        print(f"Decoding stopped early, the output is partial: {budget.truncated}")
+
+def print_payload_flows(payloads):
+    for number, payload in enumerate(payloads, 1):
+        print(f"Payload {number} at {payload['start']}-{payload['end']}:", " -> ".join(payload["encoding_steps"]) + " -> original")
+
+def print_encoding_flow(encoding_steps):
+    counters = dict.fromkeys(CODECS, 0)
+    for step in encoding_steps:
+        counters[step] += 1
 
     for key, value in counters.items():
         print(f"{key.capitalize()} decoding count:", value)
 
     print("Decoding flow:", " -> ".join(encoding_steps) + " -> original")
 
-    return decoded_content, encoding_steps
+@dataclass
+class LayerStep:
+    number: int
+    step: str
+    # Nesting level: 0 for payloads in the script itself, and parent is the number of the layer whose output held this one
+    depth: int
+    parent: int
+    # Character range of the wrapped payload in the text it was found in
+    start: int
+    end: int
+    input_size: int
+    output_size: int
+    preview: str
+    spill_file: str = None
 
-def scan_for_mime_types(output_file):
-    mime = magic.Magic(mime=True)
-    with open(output_file, "rb") as f:
-        content = f.read()
-        mime_type = mime.from_buffer(content)
-        print(f"MIME Type: {mime_type}")
-        
-        if "html" in mime_type:
-            # If the output file is an HTML page, check for embedded MIME types
-            embedded_mime_types = {}
-            start_index = 0
-            content_str = content.decode("utf-8", errors='ignore')  # Decode the bytes object into a string
-            
-            # Find all occurrences of the pattern data:\s*[^;,]*; in the content
-            pattern = re.compile(r'data:\s*[^;,]*;')
-            locations = [(match.start(0), match.end(0)) for match in pattern.finditer(content_str)]
-            
-            # Extract the embedded MIME types and add them to the dictionary
-            for start_index, end_index in locations:
-                embedded_mime_type = content_str[start_index+len("data:"):end_index-1].strip()
-
-                prev_newline_index = content_str.rfind("\n", 0, start_index)
-                if prev_newline_index == -1:
-                    line_number = 1
-                    col_number = start_index + 1
-                else:
-                    line_number = content_str.count("\n", 0, start_index) + 1
-                    col_number = start_index - prev_newline_index
+class DecodeTrace:
+    # Peels one layer per step, lazily and in the same order as decode_layers.
+    # Only the text still to be peeled is held; each layer's full output goes to spill_dir if one is given.
+    def __init__(self, script_content, spill_dir=None, preview_chars=TRACE_PREVIEW_CHARS, profiler=None, budget=None):
+        self.script_content = script_content
+        self.spill_dir = spill_dir
+        self.preview_chars = preview_chars
+        self.profiler = profiler
+        self.budget = budget
+        self.layers = []
+        self.content = None
 
-                location = (line_number, col_number)
-                if embedded_mime_type in embedded_mime_types:
-                    embedded_mime_types[embedded_mime_type].append(location)
-                else:
-                    embedded_mime_types[embedded_mime_type] = [location]
-                    
-            # Print the embedded MIME types and their occurrences and locations
-            for embedded_mime_type, locations in embedded_mime_types.items():
-                print(f"Embedded MIME Type: {embedded_mime_type}")
-                print(f"Occurrences: {len(locations)}")
-                print(f"Locations: {', '.join(f'line {loc[0]}, col {loc[1]}' for loc in locations)}")
+    @property
+    def encoding_steps(self):
+        return [layer.step for layer in self.layers]
 
+    def cyberchef_recipe(self):
+        return create_cyberchef_ops_json(self.encoding_steps)
 
-def scan_for_script_tags(output_file):
-    mime = magic.Magic(mime=True)
-    with open(output_file, "rb") as f:
-        content = f.read()
-        mime_type = mime.from_buffer(content)
-        
-        if "html" in mime_type:
-            content_str = content.decode("utf-8", errors='ignore')  # Decode the bytes object into a string
-            
-            # Find all occurrences of the pattern <script> in the content
-            pattern = re.compile(r'<script[^>]*>', re.IGNORECASE)
-            script_matches = pattern.finditer(content_str)
-
-            # Output the locations of the matching script tags
-            print("Locations of <script> tags:")
-            for match in script_matches:
-                start_index = match.start(0)
-
-                prev_newline_index = content_str.rfind("\n", 0, start_index)
-                if prev_newline_index == -1:
-                    line_number = 1
-                    col_number = start_index + 1
+    def __iter__(self):
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+        decoded_parts = []
+        # (text, depth, offset of the text in its parent's output, parent layer number)
+        pending = [(self.script_content, 0, 0, None)]
+        while pending:
+            text, depth, base, parent = pending.pop()
+            # As in decode_layers, nothing more is peeled once the budget runs out
+            layer = find_layer(text) if self.budget is None or self.budget.truncated is None else None
+            if layer is None:
+                decoded_parts.append(text)
+                continue
+            start, end, kind, payload = layer
+            decoded = peel_layer(kind, payload, self.profiler, self.budget)
+            if decoded is None:
+                decoded_parts.append(text[:end])
+                pending.append((text[end:], depth, base + end, parent))
+                continue
+
+            step, decoded_str = decoded
+            layer_step = LayerStep(len(self.layers) + 1, step, depth, parent, base + start, base + end, len(payload), len(decoded_str), decoded_str[:self.preview_chars])
+            if self.spill_dir is not None:
+                layer_step.spill_file = os.path.join(self.spill_dir, f"layer_{layer_step.number:03d}_{step}.txt")
+                write_file(layer_step.spill_file, decoded_str.encode('utf-8', 'surrogatepass'), mode='wb')
+            self.layers.append(layer_step)
+            decoded_parts.append(text[:start])
+            pending.append((text[end:], depth, base + end, parent))
+            pending.append((decoded_str, depth + 1, 0, layer_step.number))
+            yield layer_step
+        self.content = ''.join(decoded_parts)
+
+def print_layer_step(layer):
+    parent = f", inside layer {layer.parent}" if layer.parent is not None else ""
+    print(f"Layer {layer.number}: {layer.step} at {layer.start}-{layer.end}{parent}, {layer.input_size} -> {layer.output_size} characters")
+    print(f"  Preview: {layer.preview!r}")
+    if layer.spill_file is not None:
+        print(f"  Saved to: {layer.spill_file}")
+
+def decode_step_by_step(script_content, trace_dir=None, profiler=None, limits=None):
+    budget = DecodeBudget(limits) if limits is not None else None
+    trace = DecodeTrace(script_content, trace_dir, profiler=profiler, budget=budget)
+    for layer in trace:
+        print_layer_step(layer)
+    print_encoding_flow(trace.encoding_steps)
+    print_truncated(budget)
+    return trace.content, trace.encoding_steps
+
+# Large-file mode works on memory-mapped bytes: payloads are sliced out as memoryviews and every
+# layer is decoded chunk by chunk into a spill file, which is mapped in turn to peel the next layer
+LAYER_PATTERN_BYTES = re.compile(LAYER_PATTERN.pattern.encode('ascii'))
+# Every LAYER_PATTERN match starts with one of these, so the text between layers can be skipped chunk by chunk
+LAYER_START_BYTES = re.compile('|'.join(re.escape(prefix) for prefix in DETECTOR_PREFIXES.values()).encode('ascii'))
+WRAPPER_SHAPES_BYTES = [tuple(part.encode('ascii') for part in shape[:4]) + (shape[4],) for shape in WRAPPER_SHAPES]
+UNICODE_ESCAPE_BYTES = re.compile(rb'\\u[0-9a-fA-F]{4}')
+URI_ESCAPE_BYTES = re.compile(rb'%[0-9a-fA-F]{2}')
+# Everything base64.b64decode skips over, so chunk boundaries can be aligned on the characters it keeps
+# Steps whose payloads are decoded chunk by chunk, every other codec is decoded in memory
+STREAMED_STEPS = ("base64", "gzip", "zlib", "deflate", "unicode", "uri")
+BASE64_IGNORED = bytes(sorted(set(range(256)) - set(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=')))
+
+@contextmanager
+def map_file(f):
+    if os.fstat(f.fileno()).st_size == 0:
+        yield b''
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        yield mapped
+
+def release_pages(data, start, end):
+    # Pages already decoded are dropped from the process, so resident memory stays at about one chunk per layer
+    if isinstance(data, mmap.mmap) and hasattr(data, 'madvise') and end > start:
+        aligned = start - start % mmap.PAGESIZE
+        data.madvise(mmap.MADV_DONTNEED, aligned, end - aligned)
+
+def iter_mapped_chunks(data, start, end, chunk_size):
+    view = memoryview(data)
+    for offset in range(start, end, chunk_size):
+        yield view[offset:min(offset + chunk_size, end)]
+        release_pages(data, offset, min(offset + chunk_size, end))
+
+def mapped_contains(data, needles, start, end, chunk_size=LARGE_FILE_CHUNK_SIZE):
+    # Checks a huge range a chunk at a time, dropping the pages behind it
+    for offset in range(start, end, chunk_size):
+        chunk_end = min(offset + chunk_size, end)
+        found = any(data.find(needle, offset, chunk_end) != -1 for needle in needles)
+        release_pages(data, offset, chunk_end)
+        if found:
+            return True
+    return False
+
+def mapped_search(pattern, data, start, end, chunk_size=LARGE_FILE_CHUNK_SIZE):
+    # Chunks overlap by a few bytes, enough for the short fixed-length escape patterns this is used with
+    for offset in range(start, end, chunk_size):
+        match = pattern.search(data, offset, min(offset + chunk_size + 8, end))
+        release_pages(data, offset, min(offset + chunk_size, end))
+        if match:
+            return match
+    return None
+
+def copy_range(data, start, end, out, chunk_size):
+    for chunk in iter_mapped_chunks(data, start, end, chunk_size):
+        out.write(chunk)
+
+def find_layer_bytes(data, pos=0, chunk_size=LARGE_FILE_CHUNK_SIZE):
+    if pos == 0:
+        for before, opener, closer, after, kind in WRAPPER_SHAPES_BYTES:
+            payload_start = len(before) + len(opener)
+            payload_end = len(data) - len(closer) - len(after)
+            if payload_end >= payload_start and data[:payload_start] == before + opener and data[payload_end:] == closer + after:
+                if not mapped_contains(data, (b'"', b'\n'), payload_start, payload_end):
+                    return len(before), len(data) - len(after), kind, payload_start, payload_end
+
+    next_candidate = pos
+    for offset in range(pos, len(data), chunk_size):
+        chunk_end = min(offset + chunk_size, len(data))
+        # The overlap lets a start that crosses the chunk end still be seen whole
+        for candidate in LAYER_START_BYTES.finditer(data, max(offset, next_candidate), min(chunk_end + 64, len(data))):
+            match = LAYER_PATTERN_BYTES.match(data, candidate.start())
+            if match:
+                return match.start(), match.end(), match.lastgroup, match.start(match.lastgroup), match.end(match.lastgroup)
+            next_candidate = candidate.start() + 1
+        release_pages(data, offset, chunk_end)
+    return None
+
+def detect_payload_step(data, kind, payload_start, payload_end):
+    # Same choice as decode_layer: unicode if any escape would change, then uri, otherwise the layer is left alone
+    if kind == "gzip":
+        return compressed_payload_format(bytes(data[payload_start:payload_start + 4]).decode('ascii', 'replace'))
+    if kind in STREAMED_STEPS:
+        return kind
+    if kind == "unescape":
+        if mapped_search(UNICODE_ESCAPE_BYTES, data, payload_start, payload_end):
+            return "unicode"
+        if mapped_search(URI_ESCAPE_BYTES, data, payload_start, payload_end):
+            return "uri"
+        return None
+    decoded = decode_layer(kind, bytes(data[payload_start:payload_end]).decode('utf-8'))
+    return decoded[0] if decoded is not None else None
+
+def stream_base64_decode(chunks):
+    remainder = b''
+    for chunk in chunks:
+        chunk = (remainder + chunk).translate(None, BASE64_IGNORED)
+        cut = len(chunk) - len(chunk) % 4
+        remainder = chunk[cut:]
+        if cut:
+            yield binascii.a2b_base64(chunk[:cut])
+    if remainder:
+        yield base64.b64decode(remainder)
+
+def unicode_chunk_boundary(text):
+    # An escape is six characters, so one starting in the last five may be cut off
+    cut = text.find('\\', max(0, len(text) - 5))
+    return len(text) if cut == -1 else cut
+
+def uri_escape_value(text, index):
+    if text[index] == '%' and index + 3 <= len(text):
+        try:
+            return int(text[index + 1:index + 3], 16)
+        except ValueError:
+            pass
+    return None
+
+def uri_chunk_boundary(text):
+    # Cut where a new UTF-8 character starts: at a literal or an escape that is not a continuation byte,
+    # or after three continuation escapes, which no multi-byte character can span
+    window_start = max(0, len(text) - 15)
+    percents = []
+    for index in range(len(text) - 3, window_start - 1, -1):
+        if index >= 1 and uri_escape_value(text, index - 1) is not None or index >= 2 and uri_escape_value(text, index - 2) is not None:
+            continue
+        value = uri_escape_value(text, index)
+        if value is None or not 0x80 <= value < 0xC0:
+            return index
+        percents.append(index)
+    if len(percents) >= 4:
+        return percents[0]
+    return 0
+
+def stream_unescape(chunks, step):
+    decode_chunk, boundary = (decode_unicode, unicode_chunk_boundary) if step == "unicode" else (decode_uri, uri_chunk_boundary)
+    text_decoder = codecs.getincrementaldecoder('utf-8')('surrogatepass')
+    remainder = ''
+    for chunk in chunks:
+        text = remainder + text_decoder.decode(chunk)
+        cut = boundary(text)
+        remainder = text[cut:]
+        if cut:
+            yield decode_chunk(text[:cut]).encode('utf-8', 'surrogatepass')
+    text = remainder + text_decoder.decode(b'', final=True)
+    if text:
+        yield decode_chunk(text).encode('utf-8', 'surrogatepass')
+
+def write_decoded_payload(data, step, payload_start, payload_end, out, chunk_size, max_length=None, deadline=None):
+    # Like inflate, checked a chunk at a time so a bomb stops at max_length bytes or the deadline instead of filling the disk
+    written = 0
+    def write(decoded):
+        nonlocal written
+        written += len(decoded)
+        if max_length is not None and written > max_length:
+            raise DecodeLimitExceeded(f"decoded output passed {max_length} bytes")
+        if deadline is not None and time.monotonic() > deadline:
+            raise DecodeLimitExceeded("ran out of time while decoding")
+        out.write(decoded)
+
+    if step not in STREAMED_STEPS:
+        # Codecs without a chunked decoder get their payload decoded in one piece
+        write(CODECS[step].decode(bytes(data[payload_start:payload_end]).decode('utf-8')).encode('utf-8', 'surrogatepass'))
+        return
+    if step in ("unicode", "uri"):
+        chunk_size = min(chunk_size, LARGE_FILE_UNESCAPE_CHUNK_SIZE)
+    chunks = iter_mapped_chunks(data, payload_start, payload_end, chunk_size)
+    try:
+        if step in ("unicode", "uri"):
+            for decoded in stream_unescape(chunks, step):
+                write(decoded)
+            return
+
+        decoded_chunks = stream_base64_decode(chunks)
+        if step in COMPRESSION_WBITS:
+            decoded_chunks = stream_gunzip(decoded_chunks, chunk_size, COMPRESSION_WBITS[step])
+        # The in-memory decoders reject output that is not UTF-8, so check it as it goes past
+        validator = codecs.getincrementaldecoder('utf-8')()
+        for decoded in decoded_chunks:
+            validator.decode(decoded)
+            write(decoded)
+        validator.decode(b'', final=True)
+    finally:
+        # Drops the memoryview into the mapping even when decoding fails, so the mapping can be closed
+        chunks.close()
+
+def write_large_text(data, out, spill_dir, encoding_steps, profiler=None, chunk_size=LARGE_FILE_CHUNK_SIZE, budget=None):
+    # Same order as decode_layers: text before a layer, the layer peeled all the way down, then the rest
+    pos = 0
+    while True:
+        layer = find_layer_bytes(data, pos) if budget is None or budget.truncated is None else None
+        if layer is None:
+            copy_range(data, pos, len(data), out, chunk_size)
+            return
+        start, end, kind, payload_start, payload_end = layer
+        step = detect_payload_step(data, kind, payload_start, payload_end)
+        if step is None:
+            copy_range(data, pos, end, out, chunk_size)
+            pos = end
+            continue
+
+        copy_range(data, pos, start, out, chunk_size)
+        if not peel_large_layer(data, step, payload_start, payload_end, out, spill_dir, encoding_steps, profiler, chunk_size, budget):
+            copy_range(data, start, end, out, chunk_size)
+        pos = end
+
+def peel_large_layer(data, step, payload_start, payload_end, out, spill_dir, encoding_steps, profiler=None, chunk_size=LARGE_FILE_CHUNK_SIZE, budget=None):
+    # Returns False when the layer went over a limit or is not raw deflate after all,
+    # its spill file is dropped and the caller keeps the layer as it was
+    input_size = payload_end - payload_start
+    with tempfile.TemporaryFile(dir=spill_dir) as spill:
+        try:
+            with profile_layer(profiler, step, input_size) as layer_profile:
+                if budget is None:
+                    write_decoded_payload(data, step, payload_start, payload_end, spill, chunk_size)
                 else:
-                    line_number = content_str.count("\n", 0, start_index) + 1
-                    col_number = start_index - prev_newline_index
+                    budget.check_layer()
+                    write_decoded_payload(data, step, payload_start, payload_end, spill, chunk_size, budget.output_limit(input_size), budget.deadline)
+                    budget.add_layer(input_size, spill.tell())
+                layer_profile["output_size"] = spill.tell()
+        except DecodeLimitExceeded as e:
+            budget.truncated = str(e)
+            return False
+        except (binascii.Error, zlib.error, EOFError):
+            # Like decode_deflate_layer: raw deflate has no header, so a payload that does not inflate is left alone
+            if step != "deflate":
+                raise
+            return False
+        encoding_steps.append(step)
+        spill.flush()
+        with map_file(spill) as decoded:
+            write_large_text(decoded, out, spill_dir, encoding_steps, profiler, chunk_size, budget)
+    return True
+
+def decode_large_file(input_html_file, output_file, spill_dir=None, profiler=None, chunk_size=LARGE_FILE_CHUNK_SIZE, budget=None):
+    encoding_steps = []
+    with open(input_html_file, 'rb') as f, map_file(f) as html, open(output_file, 'wb') as out:
+        layer = find_layer_bytes(html)
+        step = detect_payload_step(html, *layer[2:]) if layer is not None else None
+        if step is None:
+            # Nothing to peel, so the document is small enough to handle the usual way
+            decoded_content, encoding_steps = decode_layers(extract_script_text(read_input_text(html[:])), profiler, budget=budget)
+            out.write(decoded_content.encode('utf-8', 'surrogatepass'))
+            return encoding_steps
+
+        # Only the markup around the outer payload goes through the HTML parser, with a marker where the payload sits
+        start, end, kind, payload_start, payload_end = layer
+        around = extract_script_text(read_input_text(html[:start]) + '\0' + read_input_text(html[end:]))
+        if around.count('\0') != 1:
+            raise ValueError("The outer payload is not inside the script text, decode this file without --large-file")
+        head, tail = around.split('\0')
+        out.write(head.encode('utf-8', 'surrogatepass'))
+        if not peel_large_layer(html, step, payload_start, payload_end, out, spill_dir, encoding_steps, profiler, chunk_size, budget):
+            copy_range(html, start, end, out, chunk_size)
+        decoded_tail, tail_steps = decode_layers(tail, profiler, budget=budget)
+        out.write(decoded_tail.encode('utf-8', 'surrogatepass'))
+        encoding_steps.extend(tail_steps)
+    return encoding_steps
+
+SCAN_PATTERN = re.compile(
+    r'(?P<data_uri>data:(?=(?P<data_uri_type>\s*[^;,]*);))'
+    r'|(?P<script_tag>(?i:<script)(?=[^>]*>))'
+    r'|(?P<iframe_tag>(?i:<iframe)(?=[^>]*>))'
+    r'|(?P<form_tag>(?i:<form)(?=[^>]*>))'
+    r'|(?P<meta_refresh>(?i:<meta\s[^>]*http-equiv\s*=\s*["\']?refresh))'
+    r'|(?P<eval_call>\beval\s*\()'
+)
+
+def get_magic_detector():
+    global _magic_detector
+    if _magic_detector is None:
+        import magic
+        _magic_detector = magic.Magic(mime=True)
+    return _magic_detector
 
-                print(f"line {line_number}, col {col_number}")
+def set_mime_cache_size(size):
+    global _mime_cache_size
+    _mime_cache_size = max(0, size)
+    while len(_mime_cache) > _mime_cache_size:
+        _mime_cache.popitem(last=False)
+
+def detect_mime_type(content):
+    key = hashlib.sha256(content).digest()
+    mime_type = _mime_cache.get(key)
+    if mime_type is not None:
+        _mime_cache.move_to_end(key)
+        return mime_type
+
+    mime_type = get_magic_detector().from_buffer(content)
+    if _mime_cache_size:
+        _mime_cache[key] = mime_type
+        if len(_mime_cache) > _mime_cache_size:
+            _mime_cache.popitem(last=False)
+    return mime_type
+
+def build_newline_index(content_str):
+    return [match.start() for match in re.finditer("\n", content_str)]
+
+def offset_to_location(newline_offsets, start_index):
+    newlines_before = bisect.bisect_left(newline_offsets, start_index)
+    if newlines_before == 0:
+        return 1, start_index + 1
+    return newlines_before + 1, start_index - newline_offsets[newlines_before - 1]
+
+def scan_decoded_content(content_str):
+    embedded_mime_types = {}
+    script_tags = []
+    indicators = {}
+    newline_offsets = None
+    # Matches only consume their prefix so tags and data URIs nested inside each other are all found.
+    # Like separate finditer passes, a match that starts inside the previous match of its kind is skipped.
+    match_ends = {}
+
+    for match in SCAN_PATTERN.finditer(content_str):
+        kind = match.lastgroup
+        start_index = match.start()
+        if start_index < match_ends.get(kind, 0):
+            continue
+        if kind == "data_uri":
+            match_ends[kind] = match.end("data_uri_type") + 1
+        elif kind in ("script_tag", "iframe_tag", "form_tag"):
+            match_ends[kind] = content_str.index(">", start_index) + 1
+        else:
+            match_ends[kind] = match.end()
+
+        if newline_offsets is None:
+            newline_offsets = build_newline_index(content_str)
+        location = offset_to_location(newline_offsets, start_index)
+
+        if kind == "data_uri":
+            embedded_mime_types.setdefault(match.group("data_uri_type").strip(), []).append(location)
+        elif kind == "script_tag":
+            script_tags.append(location)
+        else:
+            indicators.setdefault(kind, []).append(location)
+
+    return {"embedded_mime_types": embedded_mime_types, "script_tags": script_tags, "indicators": indicators}
+
+def scan_content(content):
+    mime_type = detect_mime_type(content)
+    results = {"mime_type": mime_type, "embedded_mime_types": {}, "script_tags": [], "indicators": {}}
+    if "html" in mime_type:
+        results.update(scan_decoded_content(content.decode("utf-8", errors='ignore')))
+    return results
+
+def print_mime_types(results):
+    print(f"MIME Type: {results['mime_type']}")
+    for embedded_mime_type, locations in results["embedded_mime_types"].items():
+        print(f"Embedded MIME Type: {embedded_mime_type}")
+        print(f"Occurrences: {len(locations)}")
+        print(f"Locations: {', '.join(f'line {loc[0]}, col {loc[1]}' for loc in locations)}")
+
+def print_script_tags(results):
+    if "html" in results["mime_type"]:
+        print("Locations of <script> tags:")
+        for line_number, col_number in results["script_tags"]:
+            print(f"line {line_number}, col {col_number}")
+
+def scan_for_mime_types(output_file):
+    print_mime_types(scan_content(read_file(output_file)))
+
+def scan_for_script_tags(output_file):
+    print_script_tags(scan_content(read_file(output_file)))
 
 def decode_main(args):
-    script_content = extract_script_content(args.input_html_file)
-    decoded_content, encoding_steps = decode_random_encoding(script_content)
-    write_file(args.output_file, decoded_content, mode='w', encoding='utf-8')
-    scan_for_mime_types(args.output_file)
-    scan_for_script_tags(args.output_file)
+    set_mime_cache_size(getattr(args, 'mime_cache_size', MIME_CACHE_SIZE))
+    profiler = LayerProfiler() if getattr(args, 'profile', False) else None
+    limits = limits_from_args(args)
+    if getattr(args, 'large_file', False):
+        budget = DecodeBudget(limits) if limits is not None else None
+        encoding_steps = decode_large_file(args.input_html_file, args.output_file, args.spill_dir, profiler, budget=budget)
+        print_encoding_flow(encoding_steps)
+        print_truncated(budget)
+        # The tag and data-URI scan needs the whole output in memory, libmagic only reads the start of the file
+        print(f"MIME Type: {get_magic_detector().from_file(args.output_file)}")
+    else:
+        script_content = extract_script_content(args.input_html_file)
+        if getattr(args, 'step', False):
+            # Every layer is peeled to be shown, so the decode cache is not used
+            decoded_content, encoding_steps = decode_step_by_step(script_content, args.trace_dir, profiler, limits)
+        else:
+            cache = DecodeCache(args.cache, args.cache_max_bytes) if getattr(args, 'cache', None) else None
+            try:
+                decoded_content, encoding_steps = decode_random_encoding(script_content, profiler, cache, getattr(args, 'workers', 1), limits)
+                if cache is not None:
+                    print_cache_stats(cache.stats())
+            finally:
+                if cache is not None:
+                    cache.close()
+        write_file(args.output_file, decoded_content, mode='w', encoding='utf-8')
+        scan_results = scan_content(decoded_content.encode('utf-8'))
+        print_mime_types(scan_results)
+        print_script_tags(scan_results)
     if args.cyberchef:
         cyberchef_ops_json = create_cyberchef_ops_json(encoding_steps)
         cyberchef_output_file = args.output_file + "_cyberchef.json"
         write_file(cyberchef_output_file, cyberchef_ops_json, mode='w', encoding='utf-8')
         print(f"\nCyberChef JSON saved to: {cyberchef_output_file}")
+    if profiler is not None:
+        profile_output_file = args.output_file + "_profile.json"
+        profiler.write_report(profile_output_file)
+        print()
+        print(profiler.format_table())
+        print(f"\nProfile JSON saved to: {profile_output_file}")
+
+def print_cache_stats(stats):
+    print(f"Decode cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries, {stats['bytes']} bytes")
+
+def collect_input_files(input_dir):
+    input_files = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        input_files.extend(os.path.join(root, name) for name in sorted(files))
+    return input_files
+
+def init_batch_worker(mime_cache_size, cache_path=None, cache_max_bytes=DECODE_CACHE_MAX_BYTES, limits=None):
+    global _decode_cache, _decode_limits
+    set_mime_cache_size(mime_cache_size)
+    _decode_cache = DecodeCache(cache_path, cache_max_bytes) if cache_path else None
+    _decode_limits = limits
+
+def triage_file(input_html_file):
+    start = time.perf_counter()
+    record = {"file": input_html_file}
+    if _decode_cache is not None:
+        hits, misses = _decode_cache.hits, _decode_cache.misses
+    try:
+        result = decode(read_file(input_html_file), cache=_decode_cache, limits=_decode_limits)
+        record["status"] = "ok"
+        record["encoding_flow"] = result.encoding_steps
+        record["layer_counts"] = result.layer_counts
+        record["mime_type"] = result.mime_type
+        record["embedded_mime_types"] = result.embedded_mime_types
+        record["script_tags"] = result.script_tags
+        record["indicators"] = result.indicators
+        record["payloads"] = result.payloads
+        record["truncated"] = result.truncated
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = f"{type(e).__name__}: {e}"
+    if _decode_cache is not None:
+        # Batch workers are terminated rather than closed, so this file's hits are written now or never
+        _decode_cache.flush()
+        record["cache_hits"] = _decode_cache.hits - hits
+        record["cache_misses"] = _decode_cache.misses - misses
+    record["elapsed_seconds"] = round(time.perf_counter() - start, 6)
+    return record
+
+def batch_decode_main(args, triage=triage_file):
+    input_files = collect_input_files(args.input_dir)
+    workers = max(1, args.workers or 1)
+    statuses = {"ok": 0, "error": 0, "timeout": 0}
+    cache_hits = cache_misses = 0
+    start = time.perf_counter()
+
+    pending_files = iter(enumerate(input_files))
+    # index -> (input file, async result, submitted at); finished records wait in done until every earlier file is written
+    in_flight = {}
+    done = {}
+    next_to_write = 0
+    finished = threading.Event()
+    pool_args = (workers, init_batch_worker, (args.mime_cache_size, getattr(args, 'cache', None), getattr(args, 'cache_max_bytes', DECODE_CACHE_MAX_BYTES), limits_from_args(args)))
+    pool = multiprocessing.Pool(*pool_args)
+
+    def submit(index, input_file):
+        result = pool.apply_async(triage, (input_file,), callback=lambda _: finished.set(), error_callback=lambda _: finished.set())
+        in_flight[index] = (input_file, result, time.monotonic())
+
+    try:
+        with open(args.output_jsonl, 'w', encoding='utf-8') as out:
+            while True:
+                # One file per worker, so a file's deadline starts when it starts running, and a free worker is refilled at once
+                while len(in_flight) < workers:
+                    index, input_file = next(pending_files, (None, None))
+                    if input_file is None:
+                        break
+                    submit(index, input_file)
+                if not in_flight:
+                    break
+
+                # Cleared before looking, so a file that finishes after the check still wakes the wait below
+                finished.clear()
+                completed = [index for index, (_, result, _) in in_flight.items() if result.ready()]
+                for index in completed:
+                    done[index] = in_flight.pop(index)[1].get()
+                now = time.monotonic()
+                expired = [index for index, (_, _, submitted) in in_flight.items() if now >= submitted + args.timeout]
+                if expired:
+                    for index in expired:
+                        input_file = in_flight.pop(index)[0]
+                        done[index] = {"file": input_file, "status": "timeout", "error": f"Timed out after {args.timeout} seconds", "elapsed_seconds": args.timeout}
+                    # A stuck worker cannot be interrupted, so replace the pool and resubmit the files that were still running
+                    pool.terminate()
+                    pool = multiprocessing.Pool(*pool_args)
+                    for index, (input_file, _, _) in list(in_flight.items()):
+                        submit(index, input_file)
+
+                # Records are written in input order, so the output is the same whatever the scheduling
+                while next_to_write in done:
+                    record = done.pop(next_to_write)
+                    next_to_write += 1
+                    statuses[record["status"]] += 1
+                    cache_hits += record.get("cache_hits", 0)
+                    cache_misses += record.get("cache_misses", 0)
+                    out.write(json.dumps(record) + "\n")
+
+                if not completed and not expired:
+                    finished.wait(max(0, min(submitted for _, _, submitted in in_flight.values()) + args.timeout - time.monotonic()))
+    finally:
+        pool.terminate()
+
+    elapsed = time.perf_counter() - start
+    print(f"Decoded files: {statuses['ok']}")
+    print(f"Failed files: {statuses['error']}")
+    print(f"Timed out files: {statuses['timeout']}")
+    if getattr(args, 'cache', None):
+        print(f"Decode cache: {cache_hits} hits, {cache_misses} misses")
+    print(f"Elapsed: {elapsed:.2f} s")
+    print(f"Results saved to: {args.output_jsonl}")
+    return statuses
 
 if __name__ == '__main__':
-    decode_main(parse_decoding_arguments())
\ No newline at end of file
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        batch_decode_main(parse_batch_decoding_arguments(sys.argv[2:]))
+    else:
+        decode_main(parse_decoding_arguments())
\ No newline at end of file
@@ -0,0 +1,316 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from functools import partial
+from urllib.parse import urlsplit, parse_qs
+from decoder import decode
+from decode_limits import add_limit_arguments, limits_from_args
+
+LATENCY_WINDOW = 1024
+THROUGHPUT_WINDOW_SECONDS = 60
+MAX_BODY_BYTES = 64 * 1024 * 1024
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+def parse_server_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the decoder over local HTTP with a worker pool')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--unix-socket', type=str, help='Listen on this Unix socket instead of TCP')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of decoder processes')
+    parser.add_argument('--queue-size', type=int, default=100, help='Requests that may wait for a worker before new ones are rejected with 503')
+    parser.add_argument('--timeout', type=float, default=30, help='Seconds a request may take before it is answered with 504')
+    parser.add_argument('--max-body-bytes', type=int, default=MAX_BODY_BYTES, help='Largest accepted request body')
+    add_limit_arguments(parser)
+    return parser.parse_args(argv)
+
+def decode_sample(html, include_content=False, limits=None):
+    # Runs in a worker process, so it only takes and returns picklable values
+    result = decode(html, limits=limits)
+    response = {
+        "encoding_flow": result.encoding_steps,
+        "layer_counts": result.layer_counts,
+        "mime_type": result.mime_type,
+        "embedded_mime_types": result.embedded_mime_types,
+        "script_tags": result.script_tags,
+        "indicators": result.indicators,
+        "payloads": result.payloads,
+        "truncated": result.truncated,
+        "content_length": len(result.content),
+    }
+    if include_content:
+        response["content"] = result.content
+    return response
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+class QueueFullError(Exception):
+    pass
+
+class DecoderService:
+    def __init__(self, workers=None, queue_size=100, timeout=30, executor=None, decode_func=decode_sample):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.executor = executor
+        self.decode_func = decode_func
+        self.pool = None
+        self.pending = {}
+        self.queue = None
+        self.worker_tasks = []
+        self.started = time.monotonic()
+        self.in_flight = 0
+        self.counters = {"received": 0, "completed": 0, "errors": 0, "timeouts": 0, "rejected": 0}
+        self.bytes_decoded = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.completions = deque()
+
+    async def start(self):
+        if self.executor is None:
+            # A pool of our own can be terminated when a decode runs past its deadline, an executor passed in cannot
+            self.pool = multiprocessing.Pool(self.workers)
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.worker_tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+        self.started = time.monotonic()
+
+    async def stop(self):
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        if self.pool is not None:
+            self.pool.terminate()
+        else:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def submit(self, html, include_content=False):
+        self.counters["received"] += 1
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((html, include_content, future, time.monotonic()))
+        except asyncio.QueueFull:
+            # Backpressure: refuse straight away rather than letting the backlog grow without bound
+            self.counters["rejected"] += 1
+            raise QueueFullError(f"Queue is full ({self.queue_size} requests waiting)")
+        return await future
+
+    def dispatch(self, decode, html, include_content):
+        loop = decode.get_loop()
+        def settle(set_value, value):
+            if not decode.done():
+                set_value(value)
+        self.pool.apply_async(self.decode_func, (html, include_content),
+                              callback=lambda result: loop.call_soon_threadsafe(settle, decode.set_result, result),
+                              error_callback=lambda error: loop.call_soon_threadsafe(settle, decode.set_exception, error))
+
+    def replace_pool(self):
+        # Terminating is the only way to stop a decode that ran past its deadline, the other requests on the old pool are sent again to the new one
+        self.pool.terminate()
+        self.pool = multiprocessing.Pool(self.workers)
+        for decode, (html, include_content) in self.pending.items():
+            self.dispatch(decode, html, include_content)
+
+    async def worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            html, include_content, future, enqueued = await self.queue.get()
+            self.in_flight += 1
+            decode = None
+            try:
+                # The deadline covers time spent waiting in the queue as well
+                remaining = self.timeout - (time.monotonic() - enqueued)
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                if self.pool is not None:
+                    decode = loop.create_future()
+                    self.pending[decode] = (html, include_content)
+                    self.dispatch(decode, html, include_content)
+                else:
+                    decode = loop.run_in_executor(self.executor, self.decode_func, html, include_content)
+                result = await asyncio.wait_for(asyncio.shield(decode), remaining)
+                self.record_completion(enqueued, len(html))
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.TimeoutError:
+                self.counters["timeouts"] += 1
+                if not future.done():
+                    future.set_exception(asyncio.TimeoutError(f"Decoding took longer than {self.timeout} seconds"))
+                if decode is not None:
+                    # The slot stays busy until the stuck decode is gone, so the queue still fills up and rejects with 503
+                    if self.pool is not None:
+                        del self.pending[decode]
+                        self.replace_pool()
+                    else:
+                        await asyncio.wait([decode])
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+            except Exception as e:
+                self.counters["errors"] += 1
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self.pending.pop(decode, None)
+                self.in_flight -= 1
+                self.queue.task_done()
+
+    def record_completion(self, enqueued, size):
+        now = time.monotonic()
+        self.counters["completed"] += 1
+        self.bytes_decoded += size
+        self.latencies.append(now - enqueued)
+        self.completions.append((now, size))
+        while self.completions and self.completions[0][0] < now - THROUGHPUT_WINDOW_SECONDS:
+            self.completions.popleft()
+
+    def metrics(self):
+        now = time.monotonic()
+        while self.completions and self.completions[0][0] < now - THROUGHPUT_WINDOW_SECONDS:
+            self.completions.popleft()
+        uptime = now - self.started
+        window = min(uptime, THROUGHPUT_WINDOW_SECONDS) or 1
+        latencies = sorted(self.latencies)
+        return {
+            "uptime_seconds": uptime,
+            "workers": self.workers,
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "queue_size": self.queue_size,
+            "in_flight": self.in_flight,
+            **self.counters,
+            "latency_seconds": {
+                "p50": percentile(latencies, 0.5),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+                "max": latencies[-1] if latencies else None,
+                "samples": len(latencies),
+            },
+            "throughput": {
+                "requests_per_second": len(self.completions) / window,
+                "mb_per_second": sum(size for _, size in self.completions) / 1024 ** 2 / window,
+                "window_seconds": window,
+                "total_mb": self.bytes_decoded / 1024 ** 2,
+            },
+        }
+
+async def read_request(reader, max_body_bytes):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    content_length = int(headers.get('content-length', 0))
+    if content_length > max_body_bytes:
+        return method, target, headers, None
+    body = await reader.readexactly(content_length) if content_length else b''
+    return method, target, headers, body
+
+async def write_response(writer, status, payload, extra_headers=None):
+    body = json.dumps(payload).encode('utf-8')
+    headers = [
+        f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}",
+        "Content-Type: application/json",
+        f"Content-Length: {len(body)}",
+        "Connection: close",
+    ]
+    for name, value in (extra_headers or {}).items():
+        headers.append(f"{name}: {value}")
+    writer.write(("\r\n".join(headers) + "\r\n\r\n").encode('latin-1') + body)
+    await writer.drain()
+
+async def handle_connection(service, reader, writer, max_body_bytes=MAX_BODY_BYTES):
+    try:
+        try:
+            request = await read_request(reader, max_body_bytes)
+        except (ValueError, asyncio.IncompleteReadError):
+            await write_response(writer, 400, {"error": "Malformed request"})
+            return
+        if request is None:
+            return
+        method, target, headers, body = request
+        url = urlsplit(target)
+
+        if url.path == '/decode':
+            if method != 'POST':
+                await write_response(writer, 405, {"error": "Use POST"})
+            elif body is None:
+                await write_response(writer, 413, {"error": f"Body larger than {max_body_bytes} bytes"})
+            else:
+                include_content = parse_qs(url.query).get('content', ['0'])[0] in ('1', 'true')
+                try:
+                    result = await service.submit(body, include_content)
+                    await write_response(writer, 200, result)
+                except QueueFullError as e:
+                    await write_response(writer, 503, {"error": str(e)}, {"Retry-After": "1"})
+                except asyncio.TimeoutError as e:
+                    await write_response(writer, 504, {"error": str(e)})
+                except Exception as e:
+                    await write_response(writer, 500, {"error": f"{type(e).__name__}: {e}"})
+        elif url.path == '/metrics':
+            await write_response(writer, 200, service.metrics())
+        elif url.path == '/health':
+            await write_response(writer, 200, {"status": "ok"})
+        else:
+            await write_response(writer, 404, {"error": f"Unknown path: {url.path}"})
+    finally:
+        writer.close()
+
+async def start_server(service, host='127.0.0.1', port=8080, unix_socket=None, max_body_bytes=MAX_BODY_BYTES):
+    await service.start()
+    handler = lambda reader, writer: handle_connection(service, reader, writer, max_body_bytes)
+    if unix_socket:
+        return await asyncio.start_unix_server(handler, path=unix_socket)
+    return await asyncio.start_server(handler, host, port)
+
+async def request(method, path, body=b'', host='127.0.0.1', port=8080, unix_socket=None):
+    # Minimal stand-in client for local testing, returns (status, parsed JSON body)
+    if unix_socket:
+        reader, writer = await asyncio.open_unix_connection(unix_socket)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    status = int(status_line.split()[1])
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            content_length = int(value.strip())
+    payload = json.loads(await reader.readexactly(content_length)) if content_length else None
+    writer.close()
+    await writer.wait_closed()
+    return status, payload
+
+async def serve(args):
+    # With limits, a hostile sample comes back as a partial result instead of holding its worker past the timeout
+    service = DecoderService(args.workers, args.queue_size, args.timeout, decode_func=partial(decode_sample, limits=limits_from_args(args)))
+    server = await start_server(service, args.host, args.port, args.unix_socket, args.max_body_bytes)
+    print(f"Decoder service listening on {args.unix_socket or f'http://{args.host}:{args.port}'} with {service.workers} workers")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    try:
+        asyncio.run(serve(parse_server_arguments()))
+    except KeyboardInterrupt:
+        pass
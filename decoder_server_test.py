@@ -0,0 +1,151 @@
+import unittest
+import asyncio
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from encoder import base64_wrap_in_html, encode_base64
+from decode_limits import DecodeLimits
+from decoder_server import DecoderService, start_server, request, decode_sample, percentile, parse_server_arguments
+
+def slow_decode(html, include_content=False):
+    threading.Event().wait(0.5)
+    return {"content_length": len(html)}
+
+def stuck_decode(html, include_content=False):
+    if html == b'stuck':
+        threading.Event().wait(30)
+    return {"content_length": len(html)}
+
+def blocking_decode(release):
+    def decode_func(html, include_content=False):
+        release.wait(5)
+        return {"content_length": len(html)}
+    return decode_func
+
+class TestDecoderServer(unittest.TestCase):
+
+    def run_server(self, scenario, **service_kwargs):
+        async def run():
+            executor = service_kwargs.pop('executor', ThreadPoolExecutor(max_workers=2))
+            service = DecoderService(executor=executor, **service_kwargs)
+            server = await start_server(service, port=0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                return await scenario(service, port)
+            finally:
+                server.close()
+                await server.wait_closed()
+                await service.stop()
+        return asyncio.run(run())
+
+    def test_decode_sample(self):
+        html = base64_wrap_in_html(encode_base64(b'<p>hi</p>')).encode('utf-8')
+        result = decode_sample(html, include_content=True)
+        self.assertEqual(result["encoding_flow"], ["base64"])
+        self.assertEqual(result["content"], 'document.write(<p>hi</p>)')
+        self.assertNotIn("content", decode_sample(html))
+        self.assertIsNone(result["truncated"])
+        self.assertEqual(decode_sample(html, limits=DecodeLimits(max_layers=0))["truncated"], "more than 0 layers")
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 0.5), 51)
+        self.assertEqual(percentile(values, 0.99), 99)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_decode_endpoint(self):
+        html = base64_wrap_in_html(encode_base64(b'<p>hi</p>')).encode('utf-8')
+
+        async def scenario(service, port):
+            status, payload = await request('POST', '/decode?content=1', html, port=port)
+            self.assertEqual(status, 200)
+            self.assertEqual(payload["encoding_flow"], ["base64"])
+            self.assertEqual(payload["content"], 'document.write(<p>hi</p>)')
+            status, metrics = await request('GET', '/metrics', port=port)
+            self.assertEqual(status, 200)
+            self.assertEqual(metrics["completed"], 1)
+            self.assertIsNotNone(metrics["latency_seconds"]["p99"])
+            self.assertGreater(metrics["throughput"]["requests_per_second"], 0)
+
+        self.run_server(scenario, workers=1)
+
+    def test_unknown_path_and_method(self):
+        async def scenario(service, port):
+            self.assertEqual((await request('GET', '/nope', port=port))[0], 404)
+            self.assertEqual((await request('GET', '/decode', port=port))[0], 405)
+            self.assertEqual((await request('GET', '/health', port=port))[0], 200)
+
+        self.run_server(scenario, workers=1)
+
+    def test_max_body_bytes(self):
+        async def run():
+            service = DecoderService(workers=1, executor=ThreadPoolExecutor(max_workers=1))
+            server = await start_server(service, port=0, max_body_bytes=10)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                return await request('POST', '/decode', b'x' * 11, port=port)
+            finally:
+                server.close()
+                await server.wait_closed()
+                await service.stop()
+        self.assertEqual(asyncio.run(run())[0], 413)
+
+    def test_timeout(self):
+        async def scenario(service, port):
+            status, payload = await request('POST', '/decode', b'<p>slow</p>', port=port)
+            self.assertEqual(status, 504)
+            self.assertEqual(service.metrics()["timeouts"], 1)
+            # A thread cannot be stopped, so its slot stays busy until the decode ends
+            self.assertEqual(service.metrics()["in_flight"], 1)
+
+        self.run_server(scenario, workers=1, timeout=0.1, decode_func=slow_decode)
+
+    def test_timeout_frees_pool_worker(self):
+        async def scenario(service, port):
+            self.assertEqual((await request('POST', '/decode', b'stuck', port=port))[0], 504)
+            status, payload = await request('POST', '/decode', b'fast', port=port)
+            self.assertEqual((status, payload), (200, {"content_length": 4}))
+            metrics = service.metrics()
+            self.assertEqual((metrics["timeouts"], metrics["completed"], metrics["in_flight"]), (1, 1, 0))
+
+        self.run_server(scenario, executor=None, workers=1, timeout=1, decode_func=stuck_decode)
+
+    def test_queue_full_returns_503(self):
+        release = threading.Event()
+
+        async def scenario(service, port):
+            # One request occupies the worker, one waits in the queue and the third is rejected
+            first = asyncio.create_task(request('POST', '/decode', b'a', port=port))
+            await asyncio.sleep(0.1)
+            second = asyncio.create_task(request('POST', '/decode', b'b', port=port))
+            await asyncio.sleep(0.1)
+            status, payload = await request('POST', '/decode', b'c', port=port)
+            self.assertEqual(status, 503)
+            release.set()
+            self.assertEqual((await first)[0], 200)
+            self.assertEqual((await second)[0], 200)
+            self.assertEqual(service.metrics()["rejected"], 1)
+
+        self.run_server(scenario, workers=1, queue_size=1, decode_func=blocking_decode(release))
+
+    def test_unix_socket(self):
+        async def run(path):
+            service = DecoderService(workers=1, executor=ThreadPoolExecutor(max_workers=1))
+            server = await start_server(service, unix_socket=path)
+            try:
+                return await request('GET', '/health', unix_socket=path)
+            finally:
+                server.close()
+                await server.wait_closed()
+                await service.stop()
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertEqual(asyncio.run(run(os.path.join(tmp, 'decoder.sock'))), (200, {"status": "ok"}))
+
+    def test_parse_server_arguments(self):
+        args = parse_server_arguments(['--port', '9000', '--queue-size', '5', '--timeout', '2.5'])
+        self.assertEqual((args.port, args.queue_size, args.timeout), (9000, 5, 2.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,8 +3,26 @@ import io
 import base64
 import gzip
 import os
-from unittest.mock import patch
-from decoder import decode_and_unzip_base64, decode_base64, decode_unicode, extract_script_content, CustomHTMLParser, scan_for_mime_types, scan_for_script_tags
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, MagicMock
+from profiling import LayerProfiler
+from decode_cache import DecodeCache
+from encoder import encode
+from codec_registry import CODECS, compress_content, encode_gzip
+from decode_limits import DecodeBudget, DecodeLimits
+from decoder import DecodeTrace, LayerStep, find_layers, decode_payloads, decode_and_unzip_base64, decode_base64, decode_unicode, extract_script_content, CustomHTMLParser, scan_for_mime_types, scan_for_script_tags, find_layer, decode_layers, decode_uri, unescape_unicode_bulk, unescape_uri_bulk, scan_decoded_content, scan_content, build_newline_index, offset_to_location, triage_file, decode, DecodeResult, extract_script_text, detect_mime_type, set_mime_cache_size, MIME_CACHE_SIZE, parse_batch_decoding_arguments, batch_decode_main, init_batch_worker, decode_large_file, iter_script_payloads, decode_script_payloads, ScriptPayload, stream_unescape, stream_gunzip, stream_base64_decode
+import decoder
+
+def timed_triage(input_html_file):
+    # Stands in for triage_file in the batch tests: slow and stuck files take their time, every record says when it finished
+    name = os.path.basename(input_html_file)
+    time.sleep(60 if "stuck" in name else 0.5 if "slow" in name else 0.05)
+    return {"file": input_html_file, "status": "ok", "finished": time.time()}
 
 class TestDecoder(unittest.TestCase):
     
@@ -48,6 +66,234 @@ class TestDecoder(unittest.TestCase):
         decoded_content = decode_unicode(encoded_content)
         self.assertEqual(decoded_content, expected_decoded_content)
 
+    def test_decode_layers_profiler(self):
+        profiler = LayerProfiler()
+        decode_layers('document.write(unescape("%48%69"))', profiler)
+        self.assertEqual([layer["encoding_type"] for layer in profiler.layers], ["uri"])
+        self.assertEqual(profiler.layers[0]["output_size"], 2)
+        # Matches that are left alone and layers stopped by a limit are not in the profile
+        profiler = LayerProfiler(trace_memory=False)
+        script_content = 'var c=unescape("plain"); var a=atob("QUJD"); var b=atob("REVG");'
+        self.assertEqual(decode_layers(script_content, profiler, budget=DecodeBudget(DecodeLimits(max_layers=1)))[1], ["base64"])
+        self.assertEqual([(layer["encoding_type"], layer["output_size"]) for layer in profiler.layers], [("base64", 3)])
+
+    def test_decode_layers_cache(self):
+        inner = encode(b'<p>shared payload</p>', ['uri', 'base64', 'unicode']).decode('utf-8')
+        outer = encode(inner.encode('utf-8'), ['base64']).decode('utf-8')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = DecodeCache(os.path.join(tmp_dir, "cache.sqlite"))
+            expected = decode_layers(extract_script_text(inner))
+            self.assertEqual(decode_layers(extract_script_text(inner), cache=cache), expected)
+            self.assertEqual(cache.hits, 0)
+            # The outer sample wraps the same layers, so decoding stops at the first one it has seen before
+            result = decode_layers(extract_script_text(outer), cache=cache)
+            self.assertEqual(result, decode_layers(extract_script_text(outer)))
+            self.assertEqual(cache.hits, 1)
+            self.assertEqual(decode_layers(extract_script_text(outer), cache=cache), result)
+            self.assertEqual(cache.hits, 2)
+            cache.close()
+
+    def test_decode_payloads(self):
+        script_content = ''.join([
+            'var a = atob("', base64.b64encode(b'unescape("%6F%6E%65")').decode('ascii'), '");\n',
+            'var b = unescape("\\u0074\\u0077\\u006F");\n',
+            'var c = unescape("plain");\n',
+            'var d = atob("dGhyZWU=");',
+        ])
+        self.assertEqual([layer[2] for layer in find_layers(script_content)], ["base64", "unescape", "unescape", "base64"])
+        expected = ('var a = one;\nvar b = two;\nvar c = unescape("plain");\nvar d = three;', ["base64", "uri", "unicode", "base64"])
+        self.assertEqual(decode_layers(script_content), expected)
+        decoded_content, encoding_steps, payloads = decode_payloads(script_content)
+        self.assertEqual((decoded_content, encoding_steps), expected)
+        self.assertEqual([payload["encoding_steps"] for payload in payloads], [["base64", "uri"], ["unicode"], ["base64"]])
+        self.assertTrue(script_content[payloads[1]["start"]:payloads[1]["end"]].startswith('unescape("'))
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self.assertEqual(decode_payloads(script_content, executor=executor), (decoded_content, encoding_steps, payloads))
+        self.assertEqual(decode_payloads(script_content, workers=2), (decoded_content, encoding_steps, payloads))
+        self.assertEqual(decode_payloads("no payloads here"), ("no payloads here", [], []))
+
+    def test_decode_registry_codecs(self):
+        html_content = encode(b'<p>Hi</p>', ['charcode', 'uri_component', 'full_uri'])
+        result = decode(html_content, scan=False)
+        self.assertEqual(result.encoding_steps, ["full_uri", "uri_component", "charcode"])
+        self.assertTrue(result.content.endswith("document.write(<p>Hi</p>)</script></head></html>)</script></head></html>)"))
+        self.assertIn("From Charcode", result.cyberchef_recipe())
+        script_content = 'a(decodeURIComponent("%3Cb%3E")); b(decodeURI("x%2Fy%20z")); c(String.fromCharCode(72, 0x69));'
+        self.assertEqual([layer[2] for layer in find_layers(script_content)], ["uri_component", "full_uri", "charcode"])
+        self.assertEqual(decode_layers(script_content), ('a(<b>); b(x%2Fy z); c(Hi);', ["uri_component", "full_uri", "charcode"]))
+
+    def test_decode_trace(self):
+        script_content = 'var a = atob("' + base64.b64encode(b'unescape("%6F%6E%65")').decode('ascii') + '"); var b = unescape("%68%69");'
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trace = DecodeTrace(script_content, spill_dir=os.path.join(tmp_dir, "layers"), preview_chars=5)
+            layers = iter(trace)
+            first = next(layers)
+            # Lazy: nothing past the first layer has been peeled yet
+            self.assertEqual(len(trace.layers), 1)
+            self.assertIsNone(trace.content)
+            self.assertEqual(first, LayerStep(1, "base64", 0, None, 8, 44, 28, 21, 'unesc', first.spill_file))
+            with open(first.spill_file, encoding='utf-8') as f:
+                self.assertEqual(f.read(), 'unescape("%6F%6E%65")')
+            rest = list(layers)
+            self.assertEqual([(layer.step, layer.depth, layer.parent, layer.start, layer.end) for layer in rest], [("uri", 1, 1, 0, 21), ("uri", 0, None, 54, 72)])
+            self.assertEqual((trace.content, trace.encoding_steps), decode_layers(script_content))
+            self.assertIn("URL Decode", trace.cyberchef_recipe())
+
+    def test_decode(self):
+        html_content = b'<html><head><script>document.write(atob("PHA+SGk8L3A+"))</script></head></html>'
+        for html in (html_content, memoryview(html_content), io.BytesIO(html_content), html_content.decode('utf-8')):
+            result = decode(html)
+            self.assertIsInstance(result, DecodeResult)
+            self.assertEqual(result.content, "document.write(<p>Hi</p>)")
+            self.assertEqual(result.encoding_steps, ["base64"])
+            self.assertEqual(result.layer_counts, {"base64": 1, "unicode": 0, "uri": 0, "gzip": 0, "zlib": 0, "deflate": 0, "uri_component": 0, "full_uri": 0, "charcode": 0})
+            self.assertIsNotNone(result.mime_type)
+
+    def test_decode_limits(self):
+        html = encode(b"<p>Hi</p>", ['base64', 'uri', 'unicode'], gzip=True)
+        self.assertIsNone(decode(html, scan=False, limits=DecodeLimits(max_layers=10)).truncated)
+        result = decode(html, scan=False, limits=DecodeLimits(max_layers=2))
+        self.assertEqual(result.encoding_steps, ["gzip", "unicode"])
+        self.assertEqual(result.truncated, "more than 2 layers")
+        # The layer the limit stopped at is left in the output as it was
+        self.assertIn('unescape("%', result.content)
+
+        # A gzip bomb stops inflating once it passes the expansion limit
+        bomb = CODECS['gzip'].wrap(encode_gzip(b"A" * (16 * 1024 * 1024)))
+        result = decode(bomb, scan=False, limits=DecodeLimits(max_expansion=100))
+        self.assertEqual(result.encoding_steps, [])
+        self.assertIn("inflated output passed", result.truncated)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = DecodeCache(os.path.join(tmp_dir, "cache.sqlite"))
+            result = decode(html, scan=False, cache=cache, limits=DecodeLimits(max_layers=3))
+            self.assertEqual(result.truncated, "more than 3 layers")
+            # A partial result is never cached
+            self.assertEqual(cache.stats()["entries"], 0)
+            self.assertEqual(decode(html, scan=False, cache=cache).encoding_steps, ["gzip", "unicode", "uri", "base64"])
+            # Now that the cache holds the whole decode, a hit must not get around the limits
+            for limits in (DecodeLimits(max_layers=2), DecodeLimits(max_total_bytes=100), DecodeLimits(max_expansion=1.5)):
+                hits = cache.hits
+                result = decode(html, scan=False, cache=cache, limits=limits)
+                self.assertEqual(result, decode(html, scan=False, limits=limits))
+                self.assertIsNotNone(result.truncated)
+                self.assertEqual(cache.hits, hits)
+            # A hit that fits the layer limit is still used
+            result = decode(html, scan=False, cache=cache, limits=DecodeLimits(max_layers=4))
+            self.assertEqual((result.encoding_steps, result.truncated), (["gzip", "unicode", "uri", "base64"], None))
+            self.assertEqual(cache.hits, hits + 1)
+            cache.close()
+
+    def test_decode_without_scan(self):
+        result = decode(b'<script>document.write(unescape("%48%69"))</script>', scan=False)
+        self.assertEqual(result.encoding_steps, ["uri"])
+        self.assertIsNone(result.mime_type)
+        self.assertIn("URL Decode", result.cyberchef_recipe())
+
+    def test_decode_large_file(self):
+        html = encode(b'<p>caf\xc3\xa9 \xe4\xb8\xad</p>' * 50, ['base64', 'unicode', 'base64', 'uri', 'base64'], gzip=True)
+        expected = decode(html, scan=False)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_file = os.path.join(tmp_dir, "in.html")
+            output_file = os.path.join(tmp_dir, "out.html")
+            with open(input_file, "wb") as f:
+                f.write(html)
+            for chunk_size in (5, 4096):
+                profiler = LayerProfiler(trace_memory=False)
+                encoding_steps = decode_large_file(input_file, output_file, spill_dir=tmp_dir, profiler=profiler, chunk_size=chunk_size)
+                self.assertEqual(encoding_steps, expected.encoding_steps)
+                with open(output_file, encoding="utf-8") as f:
+                    self.assertEqual(f.read(), expected.content)
+                self.assertEqual([layer["encoding_type"] for layer in profiler.layers], encoding_steps)
+
+    def test_decode_large_file_octet_stream_that_is_not_deflate(self):
+        pdf = base64.b64encode(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n1 0 obj\n<< /Type /Catalog >>\nendobj\n" * 20).decode('ascii')
+        html = ("<html><head><script>var d = 'data:application/octet-stream;base64," + pdf + "';\ndocument.write(atob('PHA+SGk8L3A+'));</script></head></html>").encode('utf-8')
+        expected = decode(html, scan=False)
+        self.assertEqual(expected.encoding_steps, ["base64"])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_file = os.path.join(tmp_dir, "in.html")
+            output_file = os.path.join(tmp_dir, "out.html")
+            # Once as the outer payload and once nested inside another layer
+            for sample in (html, encode(html, ['base64'])):
+                with open(input_file, "wb") as f:
+                    f.write(sample)
+                expected = decode(sample, scan=False)
+                profiler = LayerProfiler(trace_memory=False)
+                self.assertEqual(decode_large_file(input_file, output_file, spill_dir=tmp_dir, profiler=profiler, chunk_size=64), expected.encoding_steps)
+                with open(output_file, encoding="utf-8") as f:
+                    self.assertEqual(f.read(), expected.content)
+                self.assertEqual([layer["encoding_type"] for layer in profiler.layers], expected.encoding_steps)
+
+    def test_decode_large_file_limits(self):
+        html = encode(b'<p>Hi</p>' * 50, ['base64', 'uri', 'unicode'], gzip=True)
+        bomb = CODECS['gzip'].wrap(encode_gzip(b"A" * (16 * 1024 * 1024))).encode('utf-8')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_file = os.path.join(tmp_dir, "in.html")
+            output_file = os.path.join(tmp_dir, "out.html")
+            for sample, limits, reason in ((html, DecodeLimits(max_layers=2), "more than 2 layers"),
+                                           (bomb, DecodeLimits(max_expansion=100), "decoded output passed"),
+                                           (bomb, DecodeLimits(max_total_bytes=1024 * 1024), "decoded output passed 1048576 bytes")):
+                with open(input_file, "wb") as f:
+                    f.write(sample)
+                expected = decode(sample, scan=False, limits=limits)
+                budget = DecodeBudget(limits)
+                self.assertEqual(decode_large_file(input_file, output_file, spill_dir=tmp_dir, chunk_size=4096, budget=budget), expected.encoding_steps)
+                self.assertIn(reason, budget.truncated)
+                # The layer the limit stopped at is left as it was, as in the default mode
+                with open(output_file, encoding="utf-8") as f:
+                    self.assertEqual(f.read(), expected.content)
+
+    def test_decode_trace_limits(self):
+        script_content = 'var a = atob("' + base64.b64encode(b'unescape("%6F%6E%65")').decode('ascii') + '"); var b = unescape("%68%69");'
+        budget = DecodeBudget(DecodeLimits(max_layers=1))
+        trace = DecodeTrace(script_content, budget=budget)
+        self.assertEqual([layer.step for layer in trace], ["base64"])
+        self.assertEqual(budget.truncated, "more than 1 layers")
+        self.assertEqual(trace.content, decode_layers(script_content, budget=DecodeBudget(DecodeLimits(max_layers=1)))[0])
+
+    def test_decode_large_file_without_layers(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_file = os.path.join(tmp_dir, "out.html")
+            self.assertEqual(decode_large_file("test_script.html", output_file), [])
+            with open(output_file, encoding="utf-8") as f:
+                self.assertEqual(f.read(), "console.log('hello world')")
+
+    def test_stream_unescape_chunk_boundaries(self):
+        for step, text in (("unicode", "\\u0048\\u00e9\\ud83d\\ude00x\\u12"), ("uri", "%48%C3%A9%E4%B8%AD%F0%9F%98%80%80%zz%4")):
+            expected = (decode_unicode(text) if step == "unicode" else decode_uri(text)).encode('utf-8', 'surrogatepass')
+            data = text.encode('utf-8')
+            for size in range(1, 8):
+                chunks = [data[i:i + size] for i in range(0, len(data), size)]
+                self.assertEqual(b''.join(stream_unescape(chunks, step)), expected)
+
+    def test_stream_base64_gunzip(self):
+        data = base64.b64encode(gzip.compress(b"first ") + gzip.compress(b"second") + b"\0\0")
+        chunks = [data[i:i + 7] for i in range(0, len(data), 7)]
+        self.assertEqual(b''.join(stream_gunzip(stream_base64_decode(chunks), 3)), b"first second")
+        with self.assertRaises(EOFError):
+            list(stream_gunzip([gzip.compress(b"x" * 100)[:-12]], 16))
+        for compression, wbits in (("zlib", 15), ("deflate", -15)):
+            data = compress_content(b"first second", compression)
+            # Anything after the end of a zlib or raw deflate stream is ignored, as zlib.decompress does
+            chunks = [data[i:i + 3] for i in range(0, len(data), 3)] + [b"junk"]
+            self.assertEqual(b''.join(stream_gunzip(chunks, 4, wbits)), b"first second")
+
+    def test_unescape_unicode_bulk(self):
+        self.assertEqual(unescape_unicode_bulk("\\u0048\\u0069"), "Hi")
+        self.assertIsNone(unescape_unicode_bulk("\\u0048i"))
+        self.assertIsNone(unescape_unicode_bulk("\\u\\u00480048"))
+        # Surrogate pairs stay as two characters, like the per-match path
+        self.assertEqual(decode_unicode("\\ud83d\\ude00"), "\ud83d\ude00")
+
+    def test_decode_unicode_mixed_content(self):
+        self.assertEqual(decode_unicode("say \\u0048\\u0069!"), "say Hi!")
+
+    def test_unescape_uri_bulk(self):
+        self.assertEqual(unescape_uri_bulk("%48%65%6C%6C%6F"), "Hello")
+        self.assertIsNone(unescape_uri_bulk("%48%65%6C%6Co"))
+        self.assertEqual(decode_uri("Hello%2C%20World"), "Hello, World")
+
     def test_extract_script_content(self):
         html_content = "<html><body><script>console.log('Hello, World!');</script></body></html>"
         expected_script_content = "console.log('Hello, World!');"
@@ -61,6 +307,175 @@ class TestDecoder(unittest.TestCase):
         expected_script_data = "console.log('Hello, World!');"
         self.assertEqual(parser.script_data, expected_script_data)
 
+    def test_CustomHTMLParser_fragments(self):
+        parser = CustomHTMLParser()
+        for chunk in ("<p>a</p>", "<p>b", "</p><script>c</script>"):
+            parser.feed(chunk)
+        self.assertEqual(parser.fragments, ["a", "b", "c"])
+        self.assertEqual(parser.script_data, "abc")
+        self.assertEqual(parser.fragments, ["abc"])
+
+    def test_iter_script_payloads(self):
+        html_content = '<html>\n<head><script>var a = "<b>";</script>\n<img src="data:image/png;base64,AA"><script src="x.js"></script>\n<script>document.write(atob("PHA+SGk8L3A+"))'
+        for chunk_size in (1, 7, 4096):
+            payloads = list(iter_script_payloads(io.StringIO(html_content), chunk_size))
+            self.assertEqual(payloads, [
+                ScriptPayload("script", 21, 2, 15, 'var a = "<b>";'),
+                ScriptPayload("data_uri", 55, 3, 11, "data:image/png;base64,AA"),
+                ScriptPayload("script", 118, 4, 9, 'document.write(atob("PHA+SGk8L3A+"))'),
+            ])
+            for payload in payloads:
+                self.assertTrue(html_content[payload.offset:].startswith(payload.content))
+
+    def test_iter_script_payloads_path(self):
+        self.assertEqual([payload.content for payload in iter_script_payloads("test_script.html")], ["console.log('hello world')"])
+
+    def test_decode_script_payloads(self):
+        html_content = '<script>document.write(atob("PHA+SGk8L3A+"))</script><script>document.write(unescape("%48%69"))</script>'
+        results = [(payload.offset, content, steps) for payload, content, steps in decode_script_payloads(io.StringIO(html_content))]
+        self.assertEqual(results, [(8, "document.write(<p>Hi</p>)", ["base64"]), (61, "document.write(Hi)", ["uri"])])
+
+    def test_find_layer_wrapper_shape(self):
+        html_content = '<html><head><script>document.write(atob("SGVsbG8="))</script></head></html>'
+        start, end, kind, payload = find_layer(html_content)
+        self.assertEqual(html_content[start:end], 'atob("SGVsbG8=")')
+        self.assertEqual(kind, "base64")
+        self.assertEqual(payload, "SGVsbG8=")
+
+    def test_decode_layers(self):
+        inner = "<p>Hello</p>"
+        uri_layer = '<html><head><script>document.write(unescape("' + ''.join(f'%{ord(c):02X}' for c in inner) + '"))</script></head></html>'
+        base64_layer = base64.b64encode(uri_layer.encode('utf-8')).decode('utf-8')
+        script_content = 'var a = 1; document.write(atob("' + base64_layer + '")); var b = 2;'
+        decoded_content, encoding_steps = decode_layers(script_content)
+        self.assertEqual(encoding_steps, ["base64", "uri"])
+        self.assertEqual(decoded_content, 'var a = 1; document.write(<html><head><script>document.write(<p>Hello</p>)</script></head></html>); var b = 2;')
+
+    def test_offset_to_location(self):
+        content_str = "ab\ncd\n\nef"
+        newline_offsets = build_newline_index(content_str)
+        self.assertEqual(offset_to_location(newline_offsets, 1), (1, 2))
+        self.assertEqual(offset_to_location(newline_offsets, 3), (2, 1))
+        self.assertEqual(offset_to_location(newline_offsets, 7), (4, 1))
+
+    def test_scan_decoded_content(self):
+        content_str = "<img src='data:image/png;base64,AAAA'>\n<a href='data: text/plain;x'>"
+        results = scan_decoded_content(content_str)
+        self.assertEqual(results["embedded_mime_types"], {"image/png": [(1, 11)], "text/plain": [(2, 10)]})
+
+        content_str = "<html>\n  <SCRIPT src='a.js'></SCRIPT><script>1</script>"
+        self.assertEqual(scan_decoded_content(content_str)["script_tags"], [(2, 3), (2, 31)])
+
+    def test_scan_decoded_content_nested_matches(self):
+        content_str = "<script src='data:text/javascript;base64,AAAA'></script><iframe src=x></iframe>eval (x)"
+        results = scan_decoded_content(content_str)
+        self.assertEqual(results["script_tags"], [(1, 1)])
+        self.assertEqual(results["embedded_mime_types"], {"text/javascript": [(1, 14)]})
+        self.assertEqual(results["indicators"], {"iframe_tag": [(1, 57)], "eval_call": [(1, 80)]})
+
+    def test_decoder_import_does_not_load_magic(self):
+        result = subprocess.run([sys.executable, "-c", "import sys, decoder; print('magic' in sys.modules)"], capture_output=True, text=True, check=True)
+        self.assertEqual(result.stdout.strip(), "False")
+
+    def test_detect_mime_type_cache(self):
+        detector = MagicMock()
+        detector.from_buffer.return_value = "text/html"
+        with patch('decoder.get_magic_detector', return_value=detector):
+            set_mime_cache_size(1)
+            try:
+                self.assertEqual(detect_mime_type(b"<html>cache 1</html>"), "text/html")
+                self.assertEqual(detect_mime_type(b"<html>cache 1</html>"), "text/html")
+                self.assertEqual(detector.from_buffer.call_count, 1)
+                # The cache holds one entry, so the first buffer is evicted by the second
+                detect_mime_type(b"<html>cache 2</html>")
+                detect_mime_type(b"<html>cache 1</html>")
+                self.assertEqual(detector.from_buffer.call_count, 3)
+            finally:
+                set_mime_cache_size(MIME_CACHE_SIZE)
+
+    def test_scan_content(self):
+        results = scan_content(b"<head><script type='text/javascript'>console.log('hello world')</script></head>")
+        self.assertIn("html", results["mime_type"])
+        self.assertEqual(results["script_tags"], [(1, 7)])
+
+    def test_triage_file(self):
+        record = triage_file("test_script.html")
+        self.assertEqual(record["status"], "ok")
+        self.assertEqual(record["encoding_flow"], [])
+        self.assertIn("elapsed_seconds", record)
+
+    def test_triage_file_writes_cache_hits(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache_path = os.path.join(tmp_dir, "cache.sqlite")
+            input_file = os.path.join(tmp_dir, "a.html")
+            with open(input_file, "w", encoding="utf-8") as f:
+                f.write('<script>document.write(atob("PHA+SGk8L3A+"))</script>')
+            init_batch_worker(MIME_CACHE_SIZE, cache_path)
+            try:
+                self.assertEqual(triage_file(input_file)["cache_misses"], 1)
+                reader = DecodeCache(cache_path)
+                first_used = reader.connection.execute("SELECT last_used FROM layers").fetchone()[0]
+                self.assertEqual(triage_file(input_file)["cache_hits"], 1)
+                # The worker's cache is never closed, but the hit is already in the file
+                self.assertGreater(reader.connection.execute("SELECT last_used FROM layers").fetchone()[0], first_used)
+                reader.close()
+            finally:
+                decoder._decode_cache.close()
+                init_batch_worker(MIME_CACHE_SIZE)
+
+    def test_batch_decode_main(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_dir = os.path.join(tmp_dir, "in")
+            os.makedirs(os.path.join(input_dir, "sub"))
+            with open(os.path.join(input_dir, "sub", "a.html"), "w", encoding="utf-8") as f:
+                f.write('<script>document.write(atob("PHA+SGk8L3A+"))</script>')
+            with open(os.path.join(input_dir, "b.html"), "wb") as f:
+                f.write(b"\xff\xfe")
+            output_jsonl = os.path.join(tmp_dir, "out.jsonl")
+            with patch('sys.stdout', new=io.StringIO()):
+                statuses = batch_decode_main(parse_batch_decoding_arguments([input_dir, output_jsonl, "--workers", "1"]))
+            self.assertEqual(statuses, {"ok": 1, "error": 1, "timeout": 0})
+            with open(output_jsonl, encoding="utf-8") as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual([os.path.basename(record["file"]) for record in records], ["b.html", "a.html"])
+            self.assertEqual(records[0]["status"], "error")
+            self.assertEqual(records[1]["encoding_flow"], ["base64"])
+
+    def test_batch_decode_main_keeps_workers_busy(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_dir = os.path.join(tmp_dir, "in")
+            os.makedirs(input_dir)
+            for name in ("a_slow.html", "b.html", "c.html", "d.html", "e_stuck.html"):
+                with open(os.path.join(input_dir, name), "w", encoding="utf-8") as f:
+                    f.write("<p>Hi</p>")
+            output_jsonl = os.path.join(tmp_dir, "out.jsonl")
+            with patch('sys.stdout', new=io.StringIO()):
+                statuses = batch_decode_main(parse_batch_decoding_arguments([input_dir, output_jsonl, "--workers", "2", "--timeout", "2"]), triage=timed_triage)
+            self.assertEqual(statuses, {"ok": 4, "error": 0, "timeout": 1})
+            with open(output_jsonl, encoding="utf-8") as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual([os.path.basename(record["file"]) for record in records], ["a_slow.html", "b.html", "c.html", "d.html", "e_stuck.html"])
+            # The other worker went through the fast files while the slow one was still running
+            self.assertTrue(all(record["finished"] < records[0]["finished"] for record in records[1:4]))
+            self.assertEqual(records[4]["status"], "timeout")
+
+    def test_batch_decode_main_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_dir = os.path.join(tmp_dir, "in")
+            os.makedirs(input_dir)
+            for name in ("a.html", "b.html"):
+                with open(os.path.join(input_dir, name), "w", encoding="utf-8") as f:
+                    f.write('<script>document.write(atob("PHA+SGk8L3A+"))</script>')
+            output_jsonl = os.path.join(tmp_dir, "out.jsonl")
+            cache_path = os.path.join(tmp_dir, "cache.sqlite")
+            with patch('sys.stdout', new=io.StringIO()) as stdout:
+                batch_decode_main(parse_batch_decoding_arguments([input_dir, output_jsonl, "--workers", "1", "--cache", cache_path]))
+            with open(output_jsonl, encoding="utf-8") as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual([(record["cache_hits"], record["cache_misses"]) for record in records], [(0, 1), (1, 0)])
+            self.assertEqual(records[1]["encoding_flow"], ["base64"])
+            self.assertIn("Decode cache: 1 hits, 1 misses", stdout.getvalue())
+
     def test_scan_for_mime_types(self):
         scan_for_mime_types("test.html")
 
@@ -1,16 +1,58 @@
 import argparse
 import base64
+import codecs
+import glob
+import multiprocessing
+import os
 import random
-import gzip
-from urllib.parse import quote
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from profiling import LayerProfiler, profile_layer
+from compression import AUTO_LEVEL_SAMPLE_SIZE, add_compression_arguments, check_compression_arguments, take_sample, choose_compression_level, format_compression_stats
+from codec_registry import CODECS, ENCODING_TYPES, get_codec, make_compressor, compress_content, gzip_content, encode_base64, escape_unicode_per_char, encode_unicode, encode_uri_chars, escape_uri_per_char, encode_uri_all_chars, unicode_wrap_in_html, base64_wrap_in_html, uri_wrap_in_html, gzip_wrap_in_html
+
+CHUNK_SIZE = 64 * 1024
+WRAP_MARKER = '\0'
+# Code point ranges whose escapes are longer than the BMP/latin-1 width, with the extra characters per code point
+UNICODE_ESCAPE_EXTRA = [(re.compile('[\U00010000-\U000fffff]+'), 1), (re.compile('[\U00100000-\U0010ffff]+'), 2)]
+URI_ESCAPE_EXTRA = [
+    (re.compile('[\u0100-\u0fff]+'), 1),
+    (re.compile('[\u1000-\uffff]+'), 2),
+    (re.compile('[\U00010000-\U000fffff]+'), 3),
+    (re.compile('[\U00100000-\U0010ffff]+'), 4),
+]
+COMPRESSION_OPTIONS = ('compression', 'compression_level', 'compression_strategy', 'compression_max_seconds', 'compression_max_bytes')
+# Escape widths for the text codecs whose payload size can be counted without encoding
+ESCAPE_WIDTHS = {'unicode': (6, UNICODE_ESCAPE_EXTRA), 'uri': (3, URI_ESCAPE_EXTRA)}
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Encode input file with the specified encoding and create a new HTML file with encoded content')
-    parser.add_argument('encoding_type', choices=['base64', 'unicode', 'uri', 'random'], help='Encoding type')
+    parser.add_argument('encoding_type', choices=ENCODING_TYPES + ['random'], help='Encoding type')
     parser.add_argument('input_file', type=str, help='Input file')
     parser.add_argument('output_file', type=str, help='Output file')
     parser.add_argument('--gzip', action='store_true', help='Use gzip compression before encoding')
-    return parser.parse_args()
+    parser.add_argument('--stream', action='store_true', help='Encode in chunks straight to the output file to keep memory use bounded')
+    parser.add_argument('--seed', type=str, help='Seed for the random encoding so the output is reproducible')
+    parser.add_argument('--profile', action='store_true', help='Print per-layer timings and memory use and save them as JSON next to the output file')
+    parser.add_argument('--max-output-bytes', type=int, help='Only use encoding layers whose predicted output fits in this many bytes')
+    add_compression_arguments(parser)
+    return check_compression_arguments(parser, parser.parse_args())
+
+def parse_batch_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog='encoder.py batch', description='Encode many input files in parallel, one HTML output file per input')
+    parser.add_argument('encoding_type', choices=ENCODING_TYPES + ['random'], help='Encoding type')
+    parser.add_argument('source', type=str, help='Input directory, glob pattern, or manifest file with --manifest')
+    parser.add_argument('output_dir', type=str, help='Directory the encoded files are written to')
+    parser.add_argument('--manifest', action='store_true', help='Read input files from SOURCE, one per line, optionally followed by a tab and a seed')
+    parser.add_argument('--gzip', action='store_true', help='Use gzip compression before encoding')
+    parser.add_argument('--stream', action='store_true', help='Encode in chunks straight to the output file to keep memory use bounded')
+    parser.add_argument('--seed', type=str, help='Batch seed, each file gets its own seed derived from it and the file name')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Maximum number of files encoded at once')
+    parser.add_argument('--max-output-bytes', type=int, help='Only use encoding layers whose predicted output fits in this many bytes')
+    add_compression_arguments(parser)
+    return check_compression_arguments(parser, parser.parse_args(argv))
 
 def read_file(input_file, mode='rb', encoding=None):
     with open(input_file, mode, encoding=encoding) as f:
@@ -21,122 +63,448 @@ def write_file(output_file, content, mode='w', encoding=None):
     with open(output_file, mode, encoding=encoding) as f:
         f.write(content)
 
-def gzip_content(content):
-    compressed = gzip.compress(content)
-    return compressed
-
-def encode_base64(content):
-    return base64.b64encode(content).decode('utf-8')
-
-def encode_unicode(content):
-    return ''.join([f'\\u{ord(c):04x}' for c in content])
-
-def encode_uri_chars(content):
-    return quote(content, safe='', encoding='utf-8', errors='replace')
-
-def encode_uri_all_chars(content):
-    return ''.join(f'%{ord(char):02X}' for char in content)
-
-def unicode_wrap_in_html(encoded_content):
-    return f'<html><head><script>document.write(unescape("{encoded_content}"))</script></head></html>'
-
-def base64_wrap_in_html(encoded_content):
-    return f'<html><head><script>document.write(atob("{encoded_content}"))</script></head></html>'
-
-def uri_wrap_in_html(encoded_content):
-    return f'<html><head><script>document.write(unescape("{encoded_content}"))</script></head></html>'
-
-def gzip_wrap_in_html(encoded_content):
-    return f'''
-        <!DOCTYPE html>
-        <html lang="en">
-            <head>
-                <meta charset="UTF-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>ReadGZIPandRender</title>
-                <script src="https://cdnjs.cloudflare.com/ajax/libs/pako/2.1.0/pako.min.js" integrity="sha512-g2TeAWw5GPnX7z0Kn8nFbYfeHcvAu/tx6d6mrLe/90mkCxO+RcptyYpksUz35EO337F83bZwcmUyHiHamspkfg==" crossorigin="anonymous" referrerpolicy="no-referrer"></script>
-                <script>
-                    async function fetchAndRenderGzip() {{
-                        try {{
-                            const base64Data = 'data:application/octet-stream;base64,{encoded_content}';
-                            const binaryString = atob(base64Data.split(',')[1]);
-                            const len = binaryString.length;
-                            const bytes = new Uint8Array(len);
-                            for (let i = 0; i < len; i++) {{
-                                bytes[i] = binaryString.charCodeAt(i);
-                            }}
-                            const decompressedData = pako.inflate(bytes, {{ to: 'string' }});
-                            document.write(decompressedData);
-                            document.close();
-                        }} catch(error) {{
-                            console.error('There was a problem with the fetch operation:', error);
-                        }}
-                    }}
-                    document.addEventListener('DOMContentLoaded', () => {{
-                        fetchAndRenderGzip();
-                    }});
-                </script>
-            </head>
-        </html>
-    '''
-
-def random_encoding(content):
-    html_content = content.decode('utf-8')
-    encoding_steps = random.randint(1, 10)
-    prev_encoding = None
-    prev_prev_encoding = None
+def iter_file_chunks(input_file, chunk_size=CHUNK_SIZE):
+    with open(input_file, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def write_chunks(output_file, chunks, encoding='utf-8'):
+    with open(output_file, 'w', encoding=encoding) as f:
+        for chunk in chunks:
+            f.write(chunk.decode(encoding))
+
+def iter_slices(chunks, size=CHUNK_SIZE):
+    # Every stage expands its input, so re-slice to keep chunk sizes bounded however many layers are stacked
+    for chunk in chunks:
+        for start in range(0, len(chunk), size):
+            yield chunk[start:start + size]
+
+def stream_text(chunks):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in iter_slices(chunks):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    decoder.decode(b'', final=True)
+
+def stream_compress(chunks, compression='gzip', level=9, strategy='default', stats=None):
+    # stats, when given, collects the bytes in and out and the time spent in the compressor
+    compressor = make_compressor(compression, level, strategy)
+    input_size = output_size = 0
+    seconds = 0.0
+    for chunk in iter_slices(chunks):
+        start = time.perf_counter()
+        compressed = compressor.compress(chunk)
+        seconds += time.perf_counter() - start
+        input_size += len(chunk)
+        output_size += len(compressed)
+        if compressed:
+            yield compressed
+    start = time.perf_counter()
+    compressed = compressor.flush()
+    seconds += time.perf_counter() - start
+    if stats is not None:
+        stats.update(input_size=input_size, output_size=output_size + len(compressed), seconds=seconds)
+    yield compressed
+
+def stream_base64(chunks):
+    remainder = b''
+    for chunk in iter_slices(chunks):
+        chunk = remainder + chunk
+        cut = len(chunk) - len(chunk) % 3
+        remainder = chunk[cut:]
+        if cut:
+            yield base64.b64encode(chunk[:cut])
+    if remainder:
+        yield base64.b64encode(remainder)
+
+def stream_text_payload(codec, chunks):
+    # Text codecs escape character by character, so each chunk is encoded on its own
+    separator = b''
+    for text in stream_text(chunks):
+        yield separator + codec.encode(text).encode('ascii')
+        separator = codec.separator.encode('ascii')
+
+def stream_unicode(chunks):
+    return stream_text_payload(CODECS['unicode'], chunks)
+
+def stream_uri_all_chars(chunks):
+    return stream_text_payload(CODECS['uri'], chunks)
+
+def stream_wrap_in_html(wrap_in_html, chunks):
+    prefix, suffix = wrap_in_html(WRAP_MARKER).split(WRAP_MARKER)
+    yield prefix.encode('utf-8')
+    yield from chunks
+    yield suffix.encode('utf-8')
+
+def stream_encoding_layer(encoding_type, chunks):
+    codec = get_codec(encoding_type)
+    if encoding_type == 'base64':
+        return stream_wrap_in_html(codec.wrap, stream_base64(chunks))
+    elif codec.text:
+        return stream_wrap_in_html(codec.wrap, stream_text_payload(codec, chunks))
+    raise ValueError(f"Unsupported encoding type: {encoding_type}")
+
+def make_rng(seed=None):
+    if seed is None:
+        return random
+    return random.Random(seed)
 
-    for _ in range(encoding_steps):
-        encoding_types = ['base64', 'unicode', 'uri']
-        if prev_encoding == 'unicode' and prev_prev_encoding != 'uri':
-            encoding_type = random.choice(['base64', 'unicode'])
-        elif prev_encoding == 'uri' and prev_prev_encoding != 'unicode':
-            encoding_type = random.choice(['base64', 'uri'])
+def escaped_text_size(text, width, extra_widths):
+    size = len(text) * width
+    if not text.isascii():
+        for pattern, extra in extra_widths:
+            size += extra * sum(match.end() - match.start() for match in pattern.finditer(text))
+    return size
+
+def predict_first_layer_sizes(chunks):
+    # The first layer sees the raw input, so its escapes depend on which code points it contains
+    byte_count = 0
+    text_chunks = 0
+    text_sizes = {name: 0 for name in ENCODING_TYPES if CODECS[name].text}
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        for chunk in iter_slices(chunks):
+            byte_count += len(chunk)
+            text = decoder.decode(chunk)
+            if text:
+                text_chunks += 1
+            for name in text_sizes:
+                if name in ESCAPE_WIDTHS:
+                    text_sizes[name] += escaped_text_size(text, *ESCAPE_WIDTHS[name])
+                else:
+                    text_sizes[name] += len(CODECS[name].encode(text))
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        # Text layers cannot encode this input at all
+        text_sizes = dict.fromkeys(text_sizes)
+
+    sizes = {'base64': 4 * ((byte_count + 2) // 3) + len(base64_wrap_in_html(''))}
+    for name, size in text_sizes.items():
+        codec = CODECS[name]
+        # Streamed chunks are joined with the codec's separator, the same as encoding the text in one go
+        sizes[name] = None if size is None else size + len(codec.separator) * max(text_chunks - 1, 0) + len(codec.wrap(''))
+    return sizes
+
+def predict_layer_size(encoding_type, input_size):
+    # After the first layer every document is ASCII, one byte per character
+    if encoding_type == 'base64':
+        return 4 * ((input_size + 2) // 3) + len(base64_wrap_in_html(''))
+    elif encoding_type == 'unicode':
+        return 6 * input_size + len(unicode_wrap_in_html(''))
+    elif encoding_type == 'uri':
+        return 3 * input_size + len(uri_wrap_in_html(''))
+    raise ValueError(f"Unsupported encoding type: {encoding_type}")
+
+def predict_gzip_size(input_size, compression='gzip'):
+    # zlib's compressBound plus the larger gzip header and trailer, so this is an upper bound for every format and level
+    compressed_size = input_size + (input_size >> 12) + (input_size >> 14) + (input_size >> 25) + 25
+    return 4 * ((compressed_size + 2) // 3) + len(CODECS[compression].wrap(''))
+
+def max_layer_size(max_output_bytes, compression=None):
+    # Largest last layer that still fits once compressed, predict_gzip_size only grows with its input
+    if compression is None:
+        return max_output_bytes
+    low, high = -1, max_output_bytes
+    while low < high:
+        middle = (low + high + 1) // 2
+        if predict_gzip_size(middle, compression) <= max_output_bytes:
+            low = middle
         else:
-            encoding_type = random.choice(encoding_types)
+            high = middle - 1
+    return low
 
-        if encoding_type == 'base64':
-            content = encode_base64(content)
-            html_content = base64_wrap_in_html(content)
-            content = html_content.encode('utf-8')
-        elif encoding_type == 'unicode':
-            content = encode_unicode(html_content)
-            html_content = unicode_wrap_in_html(content)
-            content = html_content.encode('utf-8')
+def predict_output_sizes(first_layer_sizes, encoding_steps):
+    sizes = []
+    for encoding_type in encoding_steps:
+        if not sizes:
+            sizes.append(first_layer_sizes[encoding_type])
         else:
-            content = encode_uri_all_chars(html_content)
-            html_content = unicode_wrap_in_html(content)
-            content = html_content.encode('utf-8')
+            sizes.append(predict_layer_size(encoding_type, sizes[-1]))
+    return sizes
 
+def next_encoding_choices(prev_encoding, prev_prev_encoding):
+    if prev_encoding == 'unicode' and prev_prev_encoding != 'uri':
+        return ['base64', 'unicode']
+    elif prev_encoding == 'uri' and prev_prev_encoding != 'unicode':
+        return ['base64', 'uri']
+    return ['base64', 'unicode', 'uri']
+
+def choose_encoding_steps(rng=random, first_layer_sizes=None, max_output_bytes=None):
+    encoding_steps = []
+    prev_encoding = None
+    prev_prev_encoding = None
+    size = None
+
+    for _ in range(rng.randint(1, 10)):
+        encoding_types = next_encoding_choices(prev_encoding, prev_prev_encoding)
+        if max_output_bytes is not None:
+            if size is None:
+                predicted_sizes = {encoding_type: first_layer_sizes[encoding_type] for encoding_type in encoding_types}
+            else:
+                predicted_sizes = {encoding_type: predict_layer_size(encoding_type, size) for encoding_type in encoding_types}
+            encoding_types = [encoding_type for encoding_type in encoding_types if predicted_sizes[encoding_type] is not None and predicted_sizes[encoding_type] <= max_output_bytes]
+            if not encoding_types:
+                break
+        encoding_type = rng.choice(encoding_types)
+        if max_output_bytes is not None:
+            size = predicted_sizes[encoding_type]
+
+        encoding_steps.append(encoding_type)
         prev_prev_encoding = prev_encoding
         prev_encoding = encoding_type
+    return encoding_steps
+
+def plan_encoding(args, rng, max_output_bytes):
+    first_layer_sizes = predict_first_layer_sizes(iter_file_chunks(args.input_file))
+    compression = compression_format(args)
+    layer_budget = max_layer_size(max_output_bytes, compression)
+    if args.encoding_type == 'random':
+        encoding_steps = choose_encoding_steps(rng, first_layer_sizes, layer_budget)
+    else:
+        encoding_steps = [args.encoding_type]
+
+    sizes = predict_output_sizes(first_layer_sizes, encoding_steps) if encoding_steps else []
+    if not sizes or sizes[-1] is None or sizes[-1] > layer_budget:
+        raise ValueError(f"No {args.encoding_type} encoding of {args.input_file} fits in {max_output_bytes} bytes")
+
+    print("Encoding plan:", " -> ".join(encoding_steps))
+    print("Predicted layer sizes:", ", ".join(str(size) for size in sizes), "bytes")
+    if compression is not None:
+        print(f"Predicted {compression} output: at most {predict_gzip_size(sizes[-1], compression)} bytes")
+    return encoding_steps
+
+def encode_layer(encoding_type, content):
+    codec = get_codec(encoding_type)
+    return codec.wrap(codec.encode(content.decode('utf-8') if codec.text else content))
+
+def gzip_layer(content):
+    return encode_layer('gzip', content)
+
+def compression_format(args):
+    # --gzip is short for --compression gzip
+    return getattr(args, 'compression', None) or ('gzip' if getattr(args, 'gzip', False) else None)
+
+def compression_level(args, compression, sample, total_size):
+    level = getattr(args, 'compression_level', 9)
+    if level != 'auto':
+        return level
+    strategy = getattr(args, 'compression_strategy', 'default')
+    level = choose_compression_level(sample, total_size, compression, strategy, getattr(args, 'compression_max_seconds', None), getattr(args, 'compression_max_bytes', None))
+    print(f"Chosen {compression} level: {level}")
+    return level
+
+def compress_layer(args, compression, content, profiler=None):
+    level = compression_level(args, compression, content[:AUTO_LEVEL_SAMPLE_SIZE], len(content))
+    strategy = getattr(args, 'compression_strategy', 'default')
+    with profile_layer(profiler, compression, len(content)) as layer:
+        start = time.perf_counter()
+        compressed = compress_content(content, compression, level, strategy)
+        seconds = time.perf_counter() - start
+        html_output = CODECS[compression].wrap(encode_base64(compressed))
+        layer["output_size"] = len(html_output)
+    print(format_compression_stats(compression, level, strategy, len(content), len(compressed), seconds))
+    return html_output
+
+def random_encoding(content, rng=random, profiler=None, encoding_steps=None):
+    html_content = content.decode('utf-8')
+    if encoding_steps is None:
+        encoding_steps = choose_encoding_steps(rng)
+
+    for encoding_type in encoding_steps:
+        with profile_layer(profiler, encoding_type, len(content)) as layer:
+            html_content = encode_layer(encoding_type, content)
+            content = html_content.encode('utf-8')
+            layer["output_size"] = len(content)
     return html_content
 
+def read_input_bytes(data):
+    if hasattr(data, 'read'):
+        data = data.read()
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    return bytes(data)
+
+def encode(data, layers, gzip=False, rng=random):
+    # In-process API: bytes, bytearray, memoryview, str or a binary file object in, encoded HTML bytes out
+    content = read_input_bytes(data)
+    if isinstance(layers, str):
+        layers = choose_encoding_steps(rng) if layers == 'random' else [layers]
+    for encoding_type in layers:
+        content = encode_layer(encoding_type, content).encode('utf-8')
+    if gzip:
+        content = gzip_layer(content).encode('utf-8')
+    return content
+
+def stream_main(args, rng=random, profiler=None, encoding_steps=None):
+    chunks = iter_file_chunks(args.input_file)
+
+    if encoding_steps is None:
+        if args.encoding_type == 'random':
+            encoding_steps = choose_encoding_steps(rng)
+        else:
+            encoding_steps = [args.encoding_type]
+    for encoding_type in encoding_steps:
+        chunks = stream_encoding_layer(encoding_type, chunks)
+
+    compression = compression_format(args)
+    if compression is not None:
+        if getattr(args, 'compression_level', 9) == 'auto':
+            # The layers are not written yet, so the size to compress comes from the same prediction as --max-output-bytes
+            sample, chunks = take_sample(chunks)
+            sizes = predict_output_sizes(predict_first_layer_sizes(iter_file_chunks(args.input_file)), encoding_steps)
+            level = compression_level(args, compression, sample, sizes[-1] or len(sample))
+        else:
+            level = getattr(args, 'compression_level', 9)
+        strategy = getattr(args, 'compression_strategy', 'default')
+        stats = {}
+        encoding_steps = encoding_steps + [compression]
+        chunks = stream_wrap_in_html(CODECS[compression].wrap, stream_base64(stream_compress(chunks, compression, level, strategy, stats)))
+
+    # Streamed layers run interleaved, so the whole pipeline is profiled as one entry
+    with profile_layer(profiler, 'stream:' + '+'.join(encoding_steps), os.path.getsize(args.input_file)) as layer:
+        write_chunks(args.output_file, chunks)
+        layer["output_size"] = os.path.getsize(args.output_file)
+    if compression is not None:
+        print(format_compression_stats(compression, level, strategy, stats["input_size"], stats["output_size"], stats["seconds"]))
+
 def main(args):
-    content = read_file(args.input_file)
-
-    if args.encoding_type == 'base64':
-        encoded_content = encode_base64(content)
-        html_output = base64_wrap_in_html(encoded_content)
-    elif args.encoding_type == 'unicode':
-        html_content = content.decode('utf-8')
-        encoded_content = encode_unicode(html_content)
-        html_output = unicode_wrap_in_html(encoded_content)
-    elif args.encoding_type == 'uri':
-        html_content = content.decode('utf-8')
-        encoded_content = encode_uri_all_chars(html_content)
-        html_output = uri_wrap_in_html(encoded_content)
-    elif args.encoding_type == 'random':
-        html_output = random_encoding(content)
+    rng = make_rng(getattr(args, 'seed', None))
+    profiler = LayerProfiler() if getattr(args, 'profile', False) else None
+    max_output_bytes = getattr(args, 'max_output_bytes', None)
+    encoding_steps = plan_encoding(args, rng, max_output_bytes) if max_output_bytes is not None else None
+
+    if getattr(args, 'stream', False):
+        stream_main(args, rng, profiler, encoding_steps)
+    else:
+        content = read_file(args.input_file)
+
+        if args.encoding_type == 'random':
+            html_output = random_encoding(content, rng, profiler, encoding_steps)
+        else:
+            with profile_layer(profiler, args.encoding_type, len(content)) as layer:
+                html_output = encode_layer(args.encoding_type, content)
+                layer["output_size"] = len(html_output)
+
+        compression = compression_format(args)
+        if compression is not None:
+            html_output = compress_layer(args, compression, html_output.encode('utf-8'), profiler)
+
+        write_file(args.output_file, html_output, mode='w', encoding='utf-8')
+
+    if profiler is not None:
+        profile_output_file = args.output_file + "_profile.json"
+        profiler.write_report(profile_output_file)
+        print(profiler.format_table())
+        print(f"\nProfile JSON saved to: {profile_output_file}")
+
+def collect_batch_inputs(source, manifest=False):
+    if manifest:
+        inputs = []
+        base_dir = os.path.dirname(os.path.abspath(source))
+        with open(source, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                path, _, seed = line.partition('\t')
+                inputs.append((os.path.join(base_dir, path), seed or None))
+        return inputs
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source)]
     else:
-        raise ValueError(f"Unsupported encoding type: {args.encoding_type}")
+        paths = glob.glob(source, recursive=True)
+    return [(path, None) for path in sorted(paths) if os.path.isfile(path)]
+
+def batch_source_root(source, manifest=False):
+    # Outputs keep their path below this directory, so files with the same name in different folders do not clash
+    if manifest:
+        return os.path.dirname(os.path.abspath(source))
+    root = source
+    while glob.has_magic(root):
+        root = os.path.dirname(root)
+    if not os.path.isdir(root or os.curdir):
+        root = os.path.dirname(root)
+    return root or os.curdir
+
+def batch_output_name(input_file, root):
+    name = os.path.relpath(input_file, root)
+    if os.path.isabs(name) or name.split(os.sep)[0] == os.pardir:
+        # A manifest entry outside the manifest's folder keeps only its file name
+        name = os.path.basename(input_file)
+    return name.replace(os.sep, '/')
+
+def encode_batch_file(job):
+    encoding_type, input_file, output_file, use_gzip, stream, seed, max_output_bytes, compression_options = job
+    start = time.perf_counter()
+    input_size = output_size = 0
+    try:
+        # Inside the try, so a missing input is reported for this file instead of aborting the batch
+        input_size = os.path.getsize(input_file)
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        main(argparse.Namespace(encoding_type=encoding_type, input_file=input_file, output_file=output_file, gzip=use_gzip, stream=stream, seed=seed, max_output_bytes=max_output_bytes, **compression_options))
+        error = None
+        output_size = os.path.getsize(output_file)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return input_file, input_size, output_size, time.perf_counter() - start, error
+
+def batch_main(args):
+    inputs = collect_batch_inputs(args.source, args.manifest)
+    root = batch_source_root(args.source, args.manifest)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    compression_options = {name: getattr(args, name) for name in COMPRESSION_OPTIONS if hasattr(args, name)}
+    jobs = []
+    results = []
+    output_names = set()
+    for input_file, seed in inputs:
+        name = batch_output_name(input_file, root)
+        if name in output_names:
+            # Only left for manifest entries from outside its folder, and only that file fails
+            results.append((input_file, 0, 0, 0.0, f"ValueError: Duplicate output file name in batch: {name}"))
+            continue
+        output_names.add(name)
+        # Seeds are per file so the result does not depend on which worker picks the file up
+        if seed is None and args.seed is not None:
+            seed = f"{args.seed}:{name}"
+        jobs.append((args.encoding_type, input_file, os.path.join(args.output_dir, *name.split('/')), args.gzip, args.stream, seed, args.max_output_bytes, compression_options))
 
-    if args.gzip:
-        html_output = gzip_content(html_output.encode('utf-8'))
-        html_output = encode_base64(html_output)
-        html_output = gzip_wrap_in_html(html_output)
+    workers = max(1, args.workers or 1)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending_jobs = iter(jobs)
+        in_flight = set()
+        while True:
+            # Keep a bounded number of jobs submitted instead of queueing the whole batch up front
+            for job in pending_jobs:
+                in_flight.add(executor.submit(encode_batch_file, job))
+                if len(in_flight) >= 2 * workers:
+                    break
+            if not in_flight:
+                break
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            results.extend(future.result() for future in done)
+    elapsed = time.perf_counter() - start
 
-    write_file(args.output_file, html_output, mode='w', encoding='utf-8')
+    failures = [(input_file, error) for input_file, _, _, _, error in results if error]
+    bytes_in = sum(result[1] for result in results)
+    bytes_out = sum(result[2] for result in results)
+    print(f"Encoded files: {len(results) - len(failures)}")
+    print(f"Failed files: {len(failures)}")
+    print(f"Input: {bytes_in / 1024 ** 2:.2f} MB, output: {bytes_out / 1024 ** 2:.2f} MB")
+    if elapsed > 0:
+        print(f"Elapsed: {elapsed:.2f} s, {bytes_in / 1024 ** 2 / elapsed:.2f} MB/s, {len(results) / elapsed:.2f} files/s")
+    for input_file, error in sorted(failures):
+        print(f"Failed: {input_file}: {error}")
+    return results
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        results = batch_main(parse_batch_arguments(sys.argv[2:]))
+        sys.exit(1 if any(result[4] for result in results) else 0)
     main(parse_arguments())
@@ -3,7 +3,8 @@ from io import BytesIO, StringIO
 import os
 import tempfile
 from unittest.mock import patch
-from encoder import argparse, read_file, write_file, gzip_content, encode_base64, encode_unicode, encode_uri_chars, encode_uri_all_chars, unicode_wrap_in_html, base64_wrap_in_html, uri_wrap_in_html, gzip_wrap_in_html, random_encoding, main
+from profiling import LayerProfiler
+from encoder import argparse, read_file, write_file, gzip_content, encode_base64, encode_unicode, encode_uri_chars, encode_uri_all_chars, escape_unicode_per_char, escape_uri_per_char, unicode_wrap_in_html, base64_wrap_in_html, uri_wrap_in_html, gzip_wrap_in_html, random_encoding, main, encode, encode_layer, make_rng, choose_encoding_steps, predict_first_layer_sizes, predict_output_sizes, predict_gzip_size, max_layer_size, plan_encoding, collect_batch_inputs, parse_batch_arguments, batch_main, stream_base64, stream_unicode, stream_uri_all_chars, stream_encoding_layer
 
 class TestEncoder(unittest.TestCase):
 
@@ -41,6 +42,14 @@ class TestEncoder(unittest.TestCase):
         encoded_content = encode_uri_all_chars(content)
         self.assertEqual(encoded_content, "%74%65%73%74%5F%63%6F%6E%74%65%6E%74")
 
+    def test_encode_unicode_matches_per_char(self):
+        for content in ["", "tést", "\U0001f600 smile \U0001f600", "\ud800 lone surrogate"]:
+            self.assertEqual(encode_unicode(content), escape_unicode_per_char(content))
+
+    def test_encode_uri_all_chars_matches_per_char(self):
+        for content in ["", "tést", "\u4e2d\u6587 text", "\U0001f600"]:
+            self.assertEqual(encode_uri_all_chars(content), escape_uri_per_char(content))
+
     def test_unicode_wrap_in_html(self):
         content = "\\u0074\\u0065\\u0073\\u0074\\u005f\\u0063\\u006f\\u006e\\u0074\\u0065\\u006e\\u0074"
         wrapped_content = unicode_wrap_in_html(content)
@@ -98,6 +107,207 @@ class TestEncoder(unittest.TestCase):
         encoded_content = random_encoding(content)
         self.assertTrue(encoded_content.startswith('<html><head><script>'))
 
+    def test_stream_base64(self):
+        chunks = [b"test", b"_con", b"tent"]
+        encoded_content = b''.join(stream_base64(chunks)).decode('utf-8')
+        self.assertEqual(encoded_content, "dGVzdF9jb250ZW50")
+
+    def test_stream_unicode(self):
+        chunks = ["tést_".encode('utf-8')[:2], "tést_".encode('utf-8')[2:], b"content"]
+        encoded_content = b''.join(stream_unicode(chunks)).decode('utf-8')
+        self.assertEqual(encoded_content, encode_unicode("tést_content"))
+
+    def test_stream_uri_all_chars(self):
+        chunks = [b"test_", b"content"]
+        encoded_content = b''.join(stream_uri_all_chars(chunks)).decode('utf-8')
+        self.assertEqual(encoded_content, "%74%65%73%74%5F%63%6F%6E%74%65%6E%74")
+
+    def test_stream_encoding_layer(self):
+        chunks = stream_encoding_layer('unicode', stream_encoding_layer('base64', [b"test_content"]))
+        expected_output = unicode_wrap_in_html(encode_unicode(base64_wrap_in_html(encode_base64(b"test_content"))))
+        self.assertEqual(b''.join(chunks).decode('utf-8'), expected_output)
+
+    def test_stream_encoding_layer_registry_codecs(self):
+        for encoding_type in ('uri_component', 'full_uri', 'charcode'):
+            chunks = stream_encoding_layer(encoding_type, [b"<p>te", b"st</p>"])
+            self.assertEqual(b''.join(chunks), encode(b"<p>test</p>", [encoding_type]))
+        self.assertEqual(encode_layer('charcode', b"Hi"), '<html><head><script>document.write(String.fromCharCode(0x48,0x69))</script></head></html>')
+
+    def test_main_stream(self):
+        with tempfile.NamedTemporaryFile(mode='w+', encoding='utf-8', delete=False) as input_file:
+            input_file.write("test_content")
+        outputs = []
+        for stream in (False, True):
+            output_file = tempfile.NamedTemporaryFile(mode='w+', encoding='utf-8', delete=False)
+            output_file.close()
+            mock_args = argparse.Namespace(encoding_type='uri', input_file=input_file.name, output_file=output_file.name, gzip=False, stream=stream)
+            main(mock_args)
+            outputs.append(read_file(output_file.name, mode='r', encoding='utf-8'))
+            os.remove(output_file.name)
+        os.remove(input_file.name)
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_main_compression(self):
+        with tempfile.NamedTemporaryFile(mode='w+', encoding='utf-8', delete=False) as input_file:
+            input_file.write("test_content " * 100)
+        for compression in ('gzip', 'zlib', 'deflate'):
+            outputs = []
+            for stream in (False, True):
+                output_file = tempfile.NamedTemporaryFile(mode='w+', encoding='utf-8', delete=False)
+                output_file.close()
+                mock_args = argparse.Namespace(encoding_type='uri', input_file=input_file.name, output_file=output_file.name, gzip=False, stream=stream,
+                                               compression=compression, compression_level=1, compression_strategy='rle')
+                with patch('builtins.print') as mock_print:
+                    main(mock_args)
+                self.assertIn(f"Compression: {compression} level 1, rle strategy", mock_print.call_args[0][0])
+                outputs.append(read_file(output_file.name, mode='r', encoding='utf-8'))
+                os.remove(output_file.name)
+            self.assertEqual(outputs[0], outputs[1])
+            self.assertEqual('pako.inflateRaw(' in outputs[0], compression == 'deflate')
+        os.remove(input_file.name)
+
+    def test_encode(self):
+        expected_output = base64_wrap_in_html(encode_base64(uri_wrap_in_html(encode_uri_all_chars("test_content")).encode('utf-8')))
+        for data in (b"test_content", memoryview(b"test_content"), BytesIO(b"test_content"), "test_content"):
+            self.assertEqual(encode(data, ['uri', 'base64']), expected_output.encode('utf-8'))
+
+    def test_encode_gzip(self):
+        html_output = encode(b"test_content", 'unicode', gzip=True)
+        self.assertIn(b"data:application/octet-stream;base64,", html_output)
+
+    def test_encode_random_seed(self):
+        self.assertEqual(encode(b"test_content", 'random', rng=make_rng(3)), encode(b"test_content", 'random', rng=make_rng(3)))
+
+    def test_encode_layer_unsupported(self):
+        with self.assertRaises(ValueError):
+            encode_layer('rot13', b"test_content")
+
+    def test_random_encoding_seed(self):
+        content = b"test_content"
+        self.assertEqual(random_encoding(content, make_rng("seed")), random_encoding(content, make_rng("seed")))
+
+    def test_random_encoding_profiler(self):
+        profiler = LayerProfiler()
+        random_encoding(b"test_content", make_rng("seed"), profiler)
+        self.assertGreaterEqual(len(profiler.layers), 1)
+        self.assertEqual(profiler.layers[0]["input_size"], len(b"test_content"))
+
+    def test_predict_output_sizes(self):
+        content = "tést \u4e2d \U0001f600".encode('utf-8')
+        first_layer_sizes = predict_first_layer_sizes([content])
+        for encoding_steps in (['base64'], ['unicode', 'base64'], ['uri', 'uri', 'unicode'], ['base64', 'unicode', 'unicode']):
+            html_output = random_encoding(content, encoding_steps=encoding_steps)
+            self.assertEqual(predict_output_sizes(first_layer_sizes, encoding_steps)[-1], len(html_output.encode('utf-8')))
+
+    def test_predict_gzip_size(self):
+        html_output = random_encoding(b"test_content", make_rng("gzip"))
+        gzip_output = gzip_wrap_in_html(encode_base64(gzip_content(html_output.encode('utf-8'))))
+        self.assertLessEqual(len(gzip_output), predict_gzip_size(len(html_output)))
+
+    def test_predict_first_layer_sizes_binary(self):
+        first_layer_sizes = predict_first_layer_sizes([b"\xff\xfe\x00"])
+        self.assertIsNone(first_layer_sizes['unicode'])
+        self.assertEqual(first_layer_sizes['base64'], len(base64_wrap_in_html(encode_base64(b"\xff\xfe\x00"))))
+
+    def test_choose_encoding_steps_budget(self):
+        content = b"test_content" * 100
+        first_layer_sizes = predict_first_layer_sizes([content])
+        for seed in range(20):
+            encoding_steps = choose_encoding_steps(make_rng(seed), first_layer_sizes, 20000)
+            self.assertGreaterEqual(len(encoding_steps), 1)
+            self.assertLessEqual(max(predict_output_sizes(first_layer_sizes, encoding_steps)), 20000)
+        # Without a budget the same seed draws the same steps as before
+        self.assertEqual(choose_encoding_steps(make_rng(1)), choose_encoding_steps(make_rng(1), first_layer_sizes, None))
+
+    def test_plan_encoding_over_budget(self):
+        with tempfile.NamedTemporaryFile(mode='w+', encoding='utf-8', delete=False) as input_file:
+            input_file.write("test_content")
+        args = argparse.Namespace(encoding_type='unicode', input_file=input_file.name, gzip=False)
+        with self.assertRaises(ValueError):
+            plan_encoding(args, make_rng(1), 10)
+        os.remove(input_file.name)
+
+    def test_plan_encoding_budget_with_gzip(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_file = os.path.join(tmp_dir, "tiny.txt")
+            write_file(input_file, "test_content", mode='w', encoding='utf-8')
+            budget = max_layer_size(2500, 'gzip')
+            self.assertLessEqual(predict_gzip_size(budget), 2500)
+            self.assertGreater(predict_gzip_size(budget + 1), 2500)
+            for seed in range(5):
+                output_file = os.path.join(tmp_dir, f"out{seed}.html")
+                args = argparse.Namespace(encoding_type='random', input_file=input_file, output_file=output_file, gzip=True, seed=str(seed), max_output_bytes=2500)
+                with patch('sys.stdout', new=StringIO()):
+                    main(args)
+                self.assertLessEqual(os.path.getsize(output_file), 2500)
+            # The base64 layer alone is well under 400 bytes, but the gzip wrapper is not
+            args = argparse.Namespace(encoding_type='base64', input_file=input_file, gzip=True)
+            self.assertEqual(max_layer_size(400, 'gzip'), -1)
+            with self.assertRaises(ValueError):
+                plan_encoding(args, make_rng(1), 400)
+
+    def test_collect_batch_inputs_manifest(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manifest = os.path.join(tmp_dir, "manifest.txt")
+            write_file(manifest, "a.html\t7\n# comment\n\nb.html\n", mode='w', encoding='utf-8')
+            inputs = collect_batch_inputs(manifest, manifest=True)
+            self.assertEqual(inputs, [(os.path.join(tmp_dir, "a.html"), "7"), (os.path.join(tmp_dir, "b.html"), None)])
+
+    def test_batch_main(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_dir = os.path.join(tmp_dir, "in")
+            os.makedirs(input_dir)
+            write_file(os.path.join(input_dir, "good.html"), "test_content", mode='w', encoding='utf-8')
+            write_file(os.path.join(input_dir, "bad.html"), b"\xff\xfe", mode='wb')
+            outputs = []
+            for run in ("out1", "out2"):
+                args = parse_batch_arguments(['random', input_dir, os.path.join(tmp_dir, run), '--seed', '1', '--workers', '1'])
+                with patch('sys.stdout', new=StringIO()):
+                    results = batch_main(args)
+                errors = {os.path.basename(result[0]): result[4] for result in results}
+                self.assertIsNone(errors["good.html"])
+                self.assertIn("UnicodeDecodeError", errors["bad.html"])
+                outputs.append(read_file(os.path.join(tmp_dir, run, "good.html")))
+            self.assertEqual(outputs[0], outputs[1])
+
+    def test_batch_main_manifest_missing_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            write_file(os.path.join(tmp_dir, "good.html"), "test_content", mode='w', encoding='utf-8')
+            manifest = os.path.join(tmp_dir, "list.txt")
+            write_file(manifest, "good.html\nmissing.html\n", mode='w', encoding='utf-8')
+            args = parse_batch_arguments(['base64', manifest, os.path.join(tmp_dir, "out"), '--manifest', '--workers', '1'])
+            with patch('sys.stdout', new=StringIO()):
+                results = batch_main(args)
+            errors = {os.path.basename(result[0]): result[4] for result in results}
+            self.assertIsNone(errors["good.html"])
+            self.assertIn("FileNotFoundError", errors["missing.html"])
+            self.assertTrue(os.path.exists(os.path.join(tmp_dir, "out", "good.html")))
+
+    def test_batch_main_same_name_in_subfolders(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for folder in ("a", "b"):
+                os.makedirs(os.path.join(tmp_dir, "samples", folder))
+                write_file(os.path.join(tmp_dir, "samples", folder, "index.html"), f"test_{folder}", mode='w', encoding='utf-8')
+            outputs = []
+            for run in ("out1", "out2"):
+                args = parse_batch_arguments(['random', os.path.join(tmp_dir, "samples", "**", "*.html"), os.path.join(tmp_dir, run), '--seed', '1', '--workers', '1'])
+                with patch('sys.stdout', new=StringIO()):
+                    results = batch_main(args)
+                self.assertEqual([result[4] for result in results], [None, None])
+                outputs.append([read_file(os.path.join(tmp_dir, run, folder, "index.html")) for folder in ("a", "b")])
+            self.assertEqual(outputs[0], outputs[1])
+
+            # Entries from outside the manifest's folder keep only their file name, so a clash fails that file alone
+            manifest = os.path.join(tmp_dir, "lists", "list.txt")
+            os.makedirs(os.path.dirname(manifest))
+            write_file(manifest, "../samples/a/index.html\n../samples/b/index.html\n", mode='w', encoding='utf-8')
+            args = parse_batch_arguments(['base64', manifest, os.path.join(tmp_dir, "out3"), '--manifest', '--workers', '1'])
+            with patch('sys.stdout', new=StringIO()):
+                results = batch_main(args)
+            errors = sorted(result[4] or "" for result in results)
+            self.assertEqual(errors[0], "")
+            self.assertIn("Duplicate output file name in batch: index.html", errors[1])
+
     @patch('sys.argv', ['encoder.py', 'base64', 'input_file.txt', 'output_file.html'])
     def test_main_base64(self):
         with tempfile.NamedTemporaryFile(mode='w+', encoding='utf-8', delete=False) as input_file:
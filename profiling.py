@@ -0,0 +1,65 @@
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+class LayerProfiler:
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.layers = []
+
+    @contextmanager
+    def layer(self, encoding_type, input_size):
+        record = {"encoding_type": encoding_type, "input_size": input_size, "output_size": 0}
+        started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        completed = False
+        try:
+            # The caller fills in output_size before the block ends, or sets skipped when nothing was done
+            yield record
+            completed = True
+        finally:
+            record["wall_seconds"] = time.perf_counter() - start
+            record["expansion_ratio"] = record["output_size"] / record["input_size"] if record["input_size"] else None
+            if self.trace_memory:
+                record["peak_alloc_bytes"] = max(0, tracemalloc.get_traced_memory()[1] - baseline)
+                if started_tracing:
+                    tracemalloc.stop()
+            # Layers that failed or were skipped are left out, so the report matches the decoding flow
+            if completed and not record.pop("skipped", False):
+                self.layers.append(record)
+
+    def report(self):
+        return {
+            "layers": self.layers,
+            "total_wall_seconds": sum(layer["wall_seconds"] for layer in self.layers),
+            "peak_alloc_bytes": max((layer.get("peak_alloc_bytes", 0) for layer in self.layers), default=0),
+        }
+
+    def to_json(self):
+        return json.dumps(self.report(), indent=2)
+
+    def format_table(self):
+        lines = [f"{'Layer':>5}  {'Encoding':<10} {'Input bytes':>14} {'Output bytes':>14} {'Ratio':>7} {'Time (ms)':>10} {'Peak alloc (KB)':>16}"]
+        for index, layer in enumerate(self.layers, 1):
+            ratio = f"{layer['expansion_ratio']:.2f}" if layer["expansion_ratio"] is not None else "-"
+            peak = f"{layer['peak_alloc_bytes'] / 1024:.1f}" if "peak_alloc_bytes" in layer else "-"
+            lines.append(f"{index:>5}  {layer['encoding_type']:<10} {layer['input_size']:>14} {layer['output_size']:>14} {ratio:>7} {layer['wall_seconds'] * 1000:>10.2f} {peak:>16}")
+        report = self.report()
+        lines.append(f"Total: {report['total_wall_seconds'] * 1000:.2f} ms, peak allocation {report['peak_alloc_bytes'] / 1024:.1f} KB")
+        return "\n".join(lines)
+
+    def write_report(self, output_file):
+        with open(output_file, 'w', encoding='utf-8') as f:
+            f.write(self.to_json())
+
+def profile_layer(profiler, encoding_type, input_size):
+    if profiler is None:
+        return nullcontext({})
+    return profiler.layer(encoding_type, input_size)
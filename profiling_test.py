@@ -0,0 +1,55 @@
+import unittest
+import json
+import os
+import tempfile
+from profiling import LayerProfiler, profile_layer
+
+class TestProfiling(unittest.TestCase):
+
+    def test_layer_records(self):
+        profiler = LayerProfiler()
+        with profiler.layer("unicode", 10) as layer:
+            data = "x" * 60
+            layer["output_size"] = len(data)
+        self.assertEqual(len(profiler.layers), 1)
+        record = profiler.layers[0]
+        self.assertEqual(record["encoding_type"], "unicode")
+        self.assertEqual(record["expansion_ratio"], 6.0)
+        self.assertGreaterEqual(record["wall_seconds"], 0)
+        self.assertIn("peak_alloc_bytes", record)
+
+    def test_layer_without_memory_tracing(self):
+        profiler = LayerProfiler(trace_memory=False)
+        with profiler.layer("base64", 0):
+            pass
+        self.assertNotIn("peak_alloc_bytes", profiler.layers[0])
+        self.assertIsNone(profiler.layers[0]["expansion_ratio"])
+        self.assertIn("base64", profiler.format_table())
+
+    def test_skipped_and_failed_layers_are_left_out(self):
+        profiler = LayerProfiler(trace_memory=False)
+        with profiler.layer("unescape", 5) as layer:
+            layer["skipped"] = True
+        with self.assertRaises(ValueError):
+            with profiler.layer("gzip", 5):
+                raise ValueError("bad data")
+        self.assertEqual(profiler.layers, [])
+
+    def test_profile_layer_disabled(self):
+        with profile_layer(None, "base64", 3) as layer:
+            layer["output_size"] = 4
+
+    def test_write_report(self):
+        profiler = LayerProfiler()
+        with profiler.layer("uri", 4) as layer:
+            layer["output_size"] = 12
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            report_file = os.path.join(tmp_dir, "profile.json")
+            profiler.write_report(report_file)
+            with open(report_file, encoding='utf-8') as f:
+                report = json.load(f)
+        self.assertEqual(report["layers"][0]["output_size"], 12)
+        self.assertIn("total_wall_seconds", report)
+
+if __name__ == '__main__':
+    unittest.main()